@@ -0,0 +1,90 @@
+"""
+域激活结果缓存：同一话题的连续几轮通常激活几乎相同的域片段。
+- 键：(域名, 域版本, 信任阶段) + 查询（用户输入 + 检索到的记忆）的语义向量
+- 命中：同一键下存在与新查询余弦相似度不低于 DOMAIN_ACTIVATION_CACHE_THRESHOLD 的条目
+- 失效：域内容变化（from_dict / update_domains）会改变域版本；信任阶段变化与域更新时主动清除旧条目
+命中次数与省下的激活耗时记入 domain_activation_cache.* 指标。
+"""
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+import config
+from logger import logger
+from metrics import metrics
+from embedding_model import get_embedding_model
+
+DOMAIN_ACTIVATION_CACHE = getattr(config, "DOMAIN_ACTIVATION_CACHE", True)
+DOMAIN_ACTIVATION_CACHE_THRESHOLD = getattr(config, "DOMAIN_ACTIVATION_CACHE_THRESHOLD", 0.9)
+# 每个键下保留的最近激活结果数
+DOMAIN_ACTIVATION_CACHE_SIZE = getattr(config, "DOMAIN_ACTIVATION_CACHE_SIZE", 16)
+
+CacheKey = Tuple[str, int, Optional[str]]
+
+
+class ActivationCache:
+    """按语义相似度复用的域激活结果缓存（线程安全）；缓存的结果只读，调用方不应修改"""
+
+    def __init__(self, threshold: float = DOMAIN_ACTIVATION_CACHE_THRESHOLD,
+                 max_entries: int = DOMAIN_ACTIVATION_CACHE_SIZE, embedding_model=None):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.embedding_model = embedding_model or get_embedding_model()
+        # 键 -> [(查询向量, 激活结果, 计算耗时)]，最近使用的在末尾
+        self._entries: "OrderedDict[CacheKey, List[Tuple[np.ndarray, Any, float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def encode(self, query: str) -> np.ndarray:
+        return self.embedding_model.encode([query])[0]
+
+    def lookup(self, key: CacheKey, vector: np.ndarray) -> Optional[Any]:
+        """返回与查询足够相似的已缓存激活结果，未命中返回 None"""
+        with self._lock:
+            entries = self._entries.get(key, [])
+            best, best_score = None, self.threshold
+            for i, (cached_vector, _, _) in enumerate(entries):
+                score = float(cached_vector @ vector)
+                if score >= best_score:
+                    best, best_score = i, score
+            if best is not None:
+                entries.append(entries.pop(best))
+                self._entries.move_to_end(key)
+                _, result, saved = entries[-1]
+        if best is None:
+            metrics.incr("domain_activation_cache.miss")
+            return None
+        metrics.incr("domain_activation_cache.hit")
+        metrics.observe("domain_activation_cache.saved_seconds", saved)
+        return result
+
+    def store(self, key: CacheKey, vector: np.ndarray, result: Any, seconds: float) -> None:
+        with self._lock:
+            # 同一域只保留当前版本/阶段的条目
+            for stale in [k for k in self._entries if k[0] == key[0] and k != key]:
+                del self._entries[stale]
+            entries = self._entries.setdefault(key, [])
+            entries.append((vector, result, seconds))
+            del entries[:-self.max_entries]
+
+    def invalidate(self, domain: Optional[str] = None) -> None:
+        """清除指定域（None 表示全部）的缓存条目"""
+        with self._lock:
+            stale = [k for k in self._entries if domain is None or k[0] == domain]
+            for key in stale:
+                del self._entries[key]
+        if stale:
+            metrics.incr("domain_activation_cache.invalidations")
+            logger.info(f"域激活缓存已失效：{domain or '全部'}")
+
+    def stats(self) -> Dict[str, float]:
+        hits = metrics.get("domain_activation_cache.hit")
+        misses = metrics.get("domain_activation_cache.miss")
+        with self._lock:
+            entries = sum(len(v) for v in self._entries.values())
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "invalidations": metrics.get("domain_activation_cache.invalidations"),
+            "entries": entries,
+        }
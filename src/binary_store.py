@@ -0,0 +1,258 @@
+"""
+记忆二进制段（segment）格式，作为 JSONL 的只读快照加速加载：
+
+    [Header 32B]  magic(8) version(u16) flags(u16) record_count(u32)
+                  source_offset(u64) source_crc(u32) source_lines(u32)
+    [Records]     每条：length(u32) + payload
+                  payload = presence(u8)
+                          + topic / content / create_time / update_time（各为 u32 长度 + UTF-8，按 presence 位出现）
+                          + keywords：count(u32) + 字符串表下标(u32) * count
+                          + extras：u32 长度 + JSON（保存非标准字段，保证无损）
+    [String table] count(u32) + (u32 长度 + UTF-8) * count   —— 关键词去重存放
+    [Offset index] 每条记录的绝对偏移（u64）* record_count   —— 按记忆 id（序号）O(1) 随机访问
+    [Footer 24B]  string_table_offset(u64) index_offset(u64) magic(8)
+
+source_* 字段记录该段覆盖的 JSONL 前缀（字节数、整个前缀的 CRC、行数），
+用于判断段文件是否仍是 JSONL 的有效快照（前缀中任何位置被改写都会使段失效）；JSONL 始终是权威数据源。
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import zlib
+from typing import Any, Dict, Iterator, List, Optional
+from logger import logger
+
+SEGMENT_MAGIC = b"MEMSEG\x00\x01"
+FOOTER_MAGIC = b"MEMSEGFT"
+SEGMENT_VERSION = 2  # 2：source_crc 覆盖整个前缀（1 只校验末尾 256 字节）
+FLAG_SOURCE_UNTERMINATED = 0x1  # 源 JSONL 在 source_offset 处缺少换行符
+
+_HEADER = struct.Struct("<8sHHIQII")
+_FOOTER = struct.Struct("<QQ8s")
+_U32 = struct.Struct("<I")
+_U64 = struct.Struct("<Q")
+
+# presence 位：标准字段（类型符合预期时按位存放，否则进入 extras）
+_STR_FIELDS = ("topic", "content", "create_time", "update_time")
+_BIT = {"topic": 1, "content": 2, "create_time": 4, "update_time": 8, "keywords": 16}
+_FIELD_ORDER = ("topic", "content", "keywords", "create_time", "update_time")
+
+
+def source_prefix_crc(path: str, offset: int, chunk_size: int = 1 << 20) -> int:
+    """JSONL 前 offset 字节的 CRC（分块读取），用于校验段文件对应的源前缀是否被改写"""
+    crc = 0
+    remaining = offset
+    with open(path, "rb") as f:
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            remaining -= len(chunk)
+    return crc
+
+
+def _encode_record(memory: Dict[str, Any], strings: Dict[str, int]) -> bytes:
+    presence = 0
+    parts: List[bytes] = []
+    extras = {}
+    for field in _STR_FIELDS:
+        value = memory.get(field)
+        if isinstance(value, str):
+            presence |= _BIT[field]
+            data = value.encode("utf-8")
+            parts.append(_U32.pack(len(data)) + data)
+        elif field in memory:
+            extras[field] = value
+    keywords = memory.get("keywords")
+    if isinstance(keywords, list) and all(isinstance(k, str) for k in keywords):
+        presence |= _BIT["keywords"]
+        ids = [strings.setdefault(k, len(strings)) for k in keywords]
+        parts.append(_U32.pack(len(ids)) + struct.pack(f"<{len(ids)}I", *ids))
+    elif "keywords" in memory:
+        extras["keywords"] = keywords
+    for key, value in memory.items():
+        if key not in _BIT:
+            extras[key] = value
+    extra_data = json.dumps(extras, ensure_ascii=False).encode("utf-8") if extras else b""
+    parts.append(_U32.pack(len(extra_data)) + extra_data)
+    return bytes([presence]) + b"".join(parts)
+
+
+def write_segment(path: str, memories: List[Dict[str, Any]], source_offset: int = 0,
+                  source_crc: int = 0, source_lines: int = 0, flags: int = 0) -> None:
+    """将记忆写成段文件（先写临时文件再原子替换）"""
+    strings: Dict[str, int] = {}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, flags, len(memories),
+                             source_offset, source_crc, source_lines))
+        offsets = []
+        for memory in memories:
+            payload = _encode_record(memory, strings)
+            offsets.append(f.tell())
+            f.write(_U32.pack(len(payload)) + payload)
+        string_table_offset = f.tell()
+        f.write(_U32.pack(len(strings)))
+        for s in strings:  # dict 保持插入顺序，与下标一致
+            data = s.encode("utf-8")
+            f.write(_U32.pack(len(data)) + data)
+        index_offset = f.tell()
+        f.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+        f.write(_FOOTER.pack(string_table_offset, index_offset, FOOTER_MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class SegmentReader:
+    """内存映射读取段文件：按序号 O(1) 随机访问，也可顺序遍历"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            (magic, version, self.flags, self.record_count, self.source_offset,
+             self.source_crc, self.source_lines) = _HEADER.unpack_from(self._mm, 0)
+            if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+                raise ValueError(f"不是有效的记忆段文件：{path}")
+            string_table_offset, self._index_offset, footer_magic = _FOOTER.unpack_from(
+                self._mm, len(self._mm) - _FOOTER.size)
+            if footer_magic != FOOTER_MAGIC:
+                raise ValueError(f"记忆段文件尾部损坏：{path}")
+            self._strings = self._read_string_table(string_table_offset)
+        except Exception:
+            self.close()
+            raise
+
+    def _read_string_table(self, offset: int) -> List[str]:
+        (count,) = _U32.unpack_from(self._mm, offset)
+        pos = offset + 4
+        strings = []
+        for _ in range(count):
+            (length,) = _U32.unpack_from(self._mm, pos)
+            strings.append(self._mm[pos + 4:pos + 4 + length].decode("utf-8"))
+            pos += 4 + length
+        return strings
+
+    def __len__(self) -> int:
+        return self.record_count
+
+    def __enter__(self) -> "SegmentReader":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        mm = getattr(self, "_mm", None)
+        if mm is not None:
+            mm.close()
+            self._mm = None
+        self._file.close()
+
+    def _decode_at(self, offset: int) -> Dict[str, Any]:
+        mm = self._mm
+        pos = offset + 4  # 跳过记录长度
+        presence = mm[pos]
+        pos += 1
+        values: Dict[str, Any] = {}
+        for field in _STR_FIELDS:
+            if presence & _BIT[field]:
+                (length,) = _U32.unpack_from(mm, pos)
+                values[field] = mm[pos + 4:pos + 4 + length].decode("utf-8")
+                pos += 4 + length
+        if presence & _BIT["keywords"]:
+            (count,) = _U32.unpack_from(mm, pos)
+            ids = struct.unpack_from(f"<{count}I", mm, pos + 4)
+            values["keywords"] = [self._strings[i] for i in ids]
+            pos += 4 + 4 * count
+        (extra_len,) = _U32.unpack_from(mm, pos)
+        if extra_len:
+            values.update(json.loads(mm[pos + 4:pos + 4 + extra_len].decode("utf-8")))
+        # 标准字段按 Memory 的字段顺序输出，其余字段保持原有顺序
+        memory = {k: values.pop(k) for k in _FIELD_ORDER if k in values}
+        memory.update(values)
+        return memory
+
+    def get(self, memory_id: int) -> Dict[str, Any]:
+        """按记忆 id（即在段中的序号）读取一条记忆"""
+        if not 0 <= memory_id < self.record_count:
+            raise IndexError(f"记忆 id 越界：{memory_id}")
+        (offset,) = _U64.unpack_from(self._mm, self._index_offset + 8 * memory_id)
+        return self._decode_at(offset)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        offsets = struct.unpack_from(f"<{self.record_count}Q", self._mm, self._index_offset)
+        for offset in offsets:
+            yield self._decode_at(offset)
+
+    def load_all(self) -> List[Dict[str, Any]]:
+        return list(self)
+
+
+def load_segment_for(jsonl_path: str, segment_path: str) -> Optional[SegmentReader]:
+    """打开段文件，并校验它仍是当前 JSONL 的有效前缀快照；无效时返回 None"""
+    if not os.path.exists(segment_path) or not os.path.exists(jsonl_path):
+        return None
+    try:
+        reader = SegmentReader(segment_path)
+    except Exception as e:
+        logger.warning(f"记忆段文件不可用：{str(e)}")
+        return None
+    if (reader.source_offset > os.path.getsize(jsonl_path)
+            or source_prefix_crc(jsonl_path, reader.source_offset) != reader.source_crc):
+        logger.info("记忆段文件与 JSONL 不一致，忽略")
+        reader.close()
+        return None
+    return reader
+
+
+# ===================== JSONL <-> 段文件 转换 =====================
+def jsonl_to_segment(jsonl_path: str, segment_path: str) -> int:
+    """将 JSONL 无损转换为段文件，返回记录数（无法解析的行会被跳过并记录日志）"""
+    memories = []
+    lines = 0
+    with open(jsonl_path, "rb") as f:
+        data = f.read()
+    for raw in data.splitlines():
+        lines += 1
+        line = raw.decode("utf-8", errors="replace").strip()
+        if not line:
+            continue
+        try:
+            memories.append(json.loads(line))
+        except json.JSONDecodeError as e:
+            logger.error(f"第 {lines} 行 JSON 解析失败: {e.msg}，原始内容: {line}")
+    flags = FLAG_SOURCE_UNTERMINATED if data and not data.endswith(b"\n") else 0
+    write_segment(segment_path, memories, source_offset=len(data),
+                  source_crc=zlib.crc32(data), source_lines=lines, flags=flags)
+    return len(memories)
+
+
+def segment_to_jsonl(segment_path: str, jsonl_path: str) -> int:
+    """将段文件还原为 JSONL，返回记录数"""
+    with SegmentReader(segment_path) as reader, open(jsonl_path, "w", encoding="utf-8") as f:
+        for memory in reader:
+            f.write(json.dumps(memory, ensure_ascii=False) + "\n")
+        return len(reader)
+
+
+def _main() -> None:
+    parser = argparse.ArgumentParser(description="记忆 JSONL 与二进制段文件互转")
+    parser.add_argument("command", choices=["to-segment", "to-jsonl"])
+    parser.add_argument("src")
+    parser.add_argument("dst")
+    args = parser.parse_args()
+    if args.command == "to-segment":
+        count = jsonl_to_segment(args.src, args.dst)
+    else:
+        count = segment_to_jsonl(args.src, args.dst)
+    print(f"已转换 {count} 条记忆：{args.src} -> {args.dst}")
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,143 @@
+"""
+话题边界快速预判：用共享的句向量模型计算新一轮对话与当前 buffer 质心的余弦相似度，
+- 相似度 >= 上阈值：判定话题未更换
+- 相似度 <= 下阈值：判定话题已更换
+- 介于两者之间：无法确定，交给 LLM 判断
+全部在本地 CPU 上完成，命中时省去一次携带完整对话历史的 LLM 调用。
+
+开启 BOUNDARY_REPLAY_LOG_PATH 后，每次 LLM 边界判断都会记录为一条标注样本，
+可用 `python src/boundary_classifier.py 样本.jsonl` 回放，评估快速预判的跳过率与分歧率。
+"""
+import argparse
+import json
+import threading
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import config
+from logger import logger
+from embedding_model import get_embedding_model
+
+BOUNDARY_FAST_PATH = getattr(config, "BOUNDARY_FAST_PATH", True)
+# 相似度不低于该值时直接判定话题未更换
+BOUNDARY_SAME_TOPIC_THRESHOLD = getattr(config, "BOUNDARY_SAME_TOPIC_THRESHOLD", 0.75)
+# 相似度不高于该值时直接判定话题已更换
+BOUNDARY_NEW_TOPIC_THRESHOLD = getattr(config, "BOUNDARY_NEW_TOPIC_THRESHOLD", 0.2)
+# 影子模式：快速预判命中时仍调用 LLM，只统计两者的分歧，不影响结果
+BOUNDARY_FAST_PATH_SHADOW = getattr(config, "BOUNDARY_FAST_PATH_SHADOW", False)
+# LLM 边界判断的标注样本记录路径（None 表示不记录）
+BOUNDARY_REPLAY_LOG_PATH = getattr(config, "BOUNDARY_REPLAY_LOG_PATH", None)
+
+
+class BoundaryClassifier:
+    """基于 buffer 质心相似度的话题边界预判器（质心随 buffer 追加增量更新）"""
+
+    def __init__(self, same_threshold: float = BOUNDARY_SAME_TOPIC_THRESHOLD,
+                 new_threshold: float = BOUNDARY_NEW_TOPIC_THRESHOLD, embedding_model=None):
+        self.same_threshold = same_threshold
+        self.new_threshold = new_threshold
+        self.embedding_model = embedding_model or get_embedding_model()
+        self._rounds: List[str] = []  # 已计入质心的对话轮次
+        self._sum: Optional[np.ndarray] = None  # 已计入轮次的向量和
+        self._lock = threading.Lock()
+
+    def _sync(self, buffer: List[str]) -> None:
+        """让质心与 buffer 保持一致：buffer 只是追加时增量计入，否则重新计算"""
+        n = len(self._rounds)
+        if len(buffer) < n or buffer[:n] != self._rounds:
+            self._rounds, self._sum = [], None
+            n = 0
+        new_rounds = buffer[n:]
+        if not new_rounds:
+            return
+        vectors = self.embedding_model.encode(new_rounds)
+        total = vectors.sum(axis=0)
+        self._sum = total if self._sum is None else self._sum + total
+        self._rounds.extend(new_rounds)
+
+    def similarity(self, buffer: List[str], new_messages: str) -> float:
+        """新消息与 buffer 质心的余弦相似度"""
+        with self._lock:
+            self._sync(buffer)
+            centroid = self._sum
+        vector = self.embedding_model.encode([new_messages])[0]
+        norm = float(np.linalg.norm(centroid))
+        return float(vector @ centroid) / norm if norm else 0.0
+
+    def decide(self, similarity: float) -> Optional[bool]:
+        """根据阈值给出判断：True 话题更换 / False 未更换 / None 无法确定"""
+        if similarity >= self.same_threshold:
+            return False
+        if similarity <= self.new_threshold:
+            return True
+        return None
+
+    def confidence(self, similarity: float) -> float:
+        """预判结果的置信度（0.5~1）：相似度越过阈值的幅度占阈值到极值（1 或 0）距离的比例"""
+        if similarity >= self.same_threshold:
+            margin, span = similarity - self.same_threshold, 1.0 - self.same_threshold
+        elif similarity <= self.new_threshold:
+            margin, span = self.new_threshold - similarity, self.new_threshold
+        else:
+            return 0.0
+        return 0.5 + 0.5 * min(1.0, margin / span) if span > 0 else 1.0
+
+    def classify(self, buffer: List[str], new_messages: str) -> Tuple[Optional[bool], float]:
+        """返回 (判断结果, 相似度)；buffer 为空时无法判断"""
+        if not buffer:
+            return None, 0.0
+        similarity = self.similarity(buffer, new_messages)
+        return self.decide(similarity), similarity
+
+
+_record_lock = threading.Lock()
+
+
+def record_labelled_sample(buffer: List[str], new_messages: str, topic_changed: bool) -> None:
+    """将一次 LLM 边界判断追加为标注样本（未配置记录路径时不做任何事）"""
+    if not BOUNDARY_REPLAY_LOG_PATH:
+        return
+    sample = {"history": buffer, "new_messages": new_messages, "topic_changed": topic_changed}
+    try:
+        with _record_lock, open(BOUNDARY_REPLAY_LOG_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(sample, ensure_ascii=False) + "\n")
+    except OSError as e:
+        logger.warning(f"边界标注样本记录失败：{str(e)}")
+
+
+def replay(samples: List[Dict], classifier: BoundaryClassifier) -> Dict[str, float]:
+    """在标注样本上回放快速预判，统计跳过 LLM 的比例与判断分歧"""
+    total = skipped = disagreed = 0
+    for sample in samples:
+        if not sample.get("history"):
+            continue
+        total += 1
+        verdict, _ = classifier.classify(sample["history"], sample["new_messages"])
+        if verdict is None:
+            continue
+        skipped += 1
+        if verdict != bool(sample["topic_changed"]):
+            disagreed += 1
+    return {
+        "samples": total,
+        "skipped": skipped,
+        "skip_rate": skipped / total if total else 0.0,
+        "disagreed": disagreed,
+        "disagree_rate": disagreed / skipped if skipped else 0.0,
+    }
+
+
+def _main() -> None:
+    parser = argparse.ArgumentParser(description="话题边界快速预判的标注样本回放评估")
+    parser.add_argument("samples", help="标注样本 JSONL（history / new_messages / topic_changed）")
+    parser.add_argument("--same", type=float, default=BOUNDARY_SAME_TOPIC_THRESHOLD, help="判定未更换的相似度阈值")
+    parser.add_argument("--new", type=float, default=BOUNDARY_NEW_TOPIC_THRESHOLD, help="判定已更换的相似度阈值")
+    args = parser.parse_args()
+    with open(args.samples, "r", encoding="utf-8") as f:
+        samples = [json.loads(line) for line in f if line.strip()]
+    stats = replay(samples, BoundaryClassifier(same_threshold=args.same, new_threshold=args.new))
+    print(f"样本 {stats['samples']} 条，跳过 LLM {stats['skipped']} 条（{stats['skip_rate']:.1%}），"
+          f"其中与标注不一致 {stats['disagreed']} 条（{stats['disagree_rate']:.1%}）")
+
+
+if __name__ == "__main__":
+    _main()
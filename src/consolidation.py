@@ -0,0 +1,196 @@
+"""
+后台记忆整理：回复流式输出后，话题边界检测、记忆构建与保存都交给后台线程，
+主循环立即接受下一轮输入。
+
+- 每个会话固定分配到同一个工作线程（按 session_id 哈希分片），同一会话的任务严格按提交顺序执行
+- 队列有界：积压过多时 submit 会阻塞（背压），避免无限堆积
+- 整理出的记忆先暂存，工作线程的队列处理空时再用 save_memories 一次性写入（积压时多条记忆合并为一次提交）
+- close() 会先处理完所有排队任务，再对各会话剩余的 buffer 生成最终记忆并一次性保存
+"""
+import queue
+import threading
+import zlib
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional
+import config
+from logger import logger
+from metrics import metrics
+from memory_builder import MemoryBuilder
+from memory_structures import Memory
+
+CONSOLIDATION_ASYNC = getattr(config, "CONSOLIDATION_ASYNC", True)
+CONSOLIDATION_WORKERS = getattr(config, "CONSOLIDATION_WORKERS", 1)
+CONSOLIDATION_QUEUE_SIZE = getattr(config, "CONSOLIDATION_QUEUE_SIZE", 64)
+
+_STOP = object()
+
+
+class ConsolidationWorker:
+    """记忆整理工作器（异步模式下为后台线程池，同步模式下在提交时直接执行）"""
+
+    def __init__(self, memory_store, builder_factory: Callable[[], MemoryBuilder] = MemoryBuilder,
+                 async_mode: bool = CONSOLIDATION_ASYNC, num_workers: int = CONSOLIDATION_WORKERS,
+                 max_queue_size: int = CONSOLIDATION_QUEUE_SIZE):
+        self.memory_store = memory_store
+        self.builder_factory = builder_factory
+        self.async_mode = async_mode
+        self._builders: Dict[str, MemoryBuilder] = {}
+        self._pending: Dict[str, List[str]] = {}  # 已提交但尚未整理的对话轮次
+        self._unsaved: List[Memory] = []  # 已整理出、等待批量写入的记忆
+        self._lock = threading.Lock()
+        self._closed = False
+        self._queues: List[queue.Queue] = []
+        self._threads: List[threading.Thread] = []
+        if async_mode:
+            for i in range(max(1, num_workers)):
+                q: queue.Queue = queue.Queue(maxsize=max_queue_size)
+                thread = threading.Thread(target=self._run, args=(q,), name=f"memory-consolidation-{i}", daemon=True)
+                thread.start()
+                self._queues.append(q)
+                self._threads.append(thread)
+
+    # ===================== 会话状态 =====================
+    def builder(self, session_id: str = "default") -> MemoryBuilder:
+        """获取（必要时创建）会话的记忆构建器"""
+        with self._lock:
+            builder = self._builders.get(session_id)
+            if builder is None:
+                builder = self.builder_factory()
+                self._builders[session_id] = builder
+                self._pending[session_id] = []
+            return builder
+
+    def get_chat_history(self, session_id: str = "default") -> str:
+        """当前话题的对话历史（摘要 + 最近轮次），包含已提交但后台尚未整理完的轮次"""
+        builder = self.builder(session_id)
+        with self._lock:
+            dialogs = builder.dialogs
+            # 后台已追加进 buffer、但还未从 _pending 移除的轮次只保留一份（按对象身份判断，内容相同的不同轮次不受影响）
+            buffered = {id(r) for r in dialogs}
+            rounds = dialogs + [r for r in self._pending[session_id] if id(r) not in buffered]
+        return "\n\n".join(rounds)
+
+    # ===================== 任务提交 =====================
+    def _queue_for(self, session_id: str) -> queue.Queue:
+        return self._queues[zlib.crc32(session_id.encode("utf-8")) % len(self._queues)]
+
+    def submit(self, session_id: str, fn: Callable, *args, **kwargs) -> Future:
+        """提交任务；同一会话的任务按提交顺序执行"""
+        future: Future = Future()
+        if self._closed:
+            future.set_exception(RuntimeError("记忆整理器已关闭"))
+            return future
+        if not self.async_mode:
+            self._execute(future, fn, args, kwargs)
+            return future
+        q = self._queue_for(session_id)
+        if q.full():
+            logger.warning("记忆整理队列已满，等待后台处理")
+        q.put((future, fn, args, kwargs))
+        return future
+
+    def submit_round(self, session_id: str, user_input: str, agent_response: str) -> Future:
+        """提交一轮已完成的对话：后台处理话题边界、生成并保存记忆"""
+        builder = self.builder(session_id)
+        round_text = builder._format_round_dialog(user_input, agent_response)
+        with self._lock:
+            self._pending[session_id].append(round_text)
+        return self.submit(session_id, self._consolidate_round, session_id, round_text, user_input, agent_response)
+
+    def submit_speculation(self, session_id: str, user_input: str) -> Optional[Future]:
+        """
+        用户消息到达时发起推测式话题边界检测：不进入会话队列，直接基于当前buffer快照在构建器线程池中执行；
+        该会话仍有未整理完的轮次时buffer即将变化，推测结果必然过期，直接跳过
+        """
+        builder = self.builder(session_id)
+        with self._lock:
+            if self._closed or self._pending[session_id]:
+                metrics.incr("boundary.speculation_skipped")
+                return None
+            return builder.speculate_boundary(user_input)
+
+    def _consolidate_round(self, session_id: str, round_text: str, user_input: str, agent_response: str) -> None:
+        builder = self.builder(session_id)
+        try:
+            new_memory = builder.process_dialog(user_input=user_input, agent_response=agent_response,
+                                                current_round=round_text)
+        finally:
+            with self._lock:
+                self._pending[session_id].remove(round_text)
+        if not new_memory:
+            return
+        if not self.async_mode:
+            self.memory_store.save_memory(new_memory)
+            return
+        with self._lock:
+            self._unsaved.append(new_memory)
+
+    def _save_unsaved(self) -> None:
+        """将暂存的记忆批量写入存储"""
+        with self._lock:
+            memories, self._unsaved = self._unsaved, []
+        if not memories:
+            return
+        try:
+            self.memory_store.save_memories(memories)
+        except Exception as e:
+            logger.error(f"批量保存 {len(memories)} 条记忆失败：{str(e)}", exc_info=True)
+
+    # ===================== 执行与关闭 =====================
+    @staticmethod
+    def _execute(future: Future, fn: Callable, args, kwargs) -> None:
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            logger.error(f"记忆整理任务失败：{str(e)}", exc_info=True)
+            future.set_exception(e)
+
+    def _run(self, q: queue.Queue) -> None:
+        while True:
+            item = q.get()
+            try:
+                if item is _STOP:
+                    return
+                self._execute(*item)
+                if q.empty():
+                    self._save_unsaved()
+            finally:
+                q.task_done()
+
+    def flush(self) -> None:
+        """等待所有已提交的任务处理完成"""
+        for q in self._queues:
+            q.join()
+
+    def pending_count(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def close(self, finalize: bool = True) -> None:
+        """处理完排队任务后停止工作线程；finalize 为 True 时为每个会话保存剩余 buffer 生成的记忆"""
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        for q in self._queues:
+            q.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        if finalize:
+            with self._lock:
+                builders = list(self._builders.items())
+            final_memories = []
+            for session_id, builder in builders:
+                try:
+                    final_memory = builder.finalize_memory()
+                    if final_memory:
+                        final_memories.append(final_memory)
+                except Exception as e:
+                    logger.error(f"会话 {session_id} 的最终记忆生成失败：{str(e)}", exc_info=True)
+            if final_memories:
+                try:
+                    self.memory_store.save_memories(final_memories)
+                except Exception as e:
+                    logger.error(f"最终记忆保存失败：{str(e)}", exc_info=True)
+        logger.info("记忆整理器已关闭")
@@ -1,9 +1,26 @@
+import asyncio
+import copy
 import os
-from typing import Dict, Any, Optional
+import threading
+import time
+from typing import Dict, Any, List, Optional, Tuple, Union, Callable, Awaitable
 import json
 from datetime import datetime, timedelta
+import config
 from logger import logger
+from metrics import metrics
 from llm_client import LLMClient
+from domain_patch import apply_patch
+from domain_persistence import DomainStore, atomic_write
+from activation_cache import DOMAIN_ACTIVATION_CACHE, ActivationCache, CacheKey
+from domain_fragments import (
+    DOMAIN_ACTIVATION_MODE,
+    DOMAIN_FRAGMENT_ALWAYS,
+    DOMAIN_FRAGMENT_SHORTLIST_K,
+    DOMAIN_FRAGMENT_TOP_K,
+    FragmentIndex,
+    build_query
+)
 import prompt
 
 # 持久化文件路径（运行时保存/加载的文件）
@@ -18,6 +35,13 @@ DEFAULT_SELF_DOMAIN_JSON = os.path.join(DATA_DIR, "init/self_domain.json")
 # 确保数据目录存在
 os.makedirs(DATA_DIR, exist_ok=True)
 
+# 域更新方式：incremental（只处理上次更新后的新记忆，模型输出 JSON Patch 增量）/ full（全部记忆 + 重写整个域）
+DOMAIN_UPDATE_MODE = getattr(config, "DOMAIN_UPDATE_MODE", "incremental")
+# 增量更新时每次 LLM 调用处理的新记忆条数
+DOMAIN_UPDATE_BATCH_SIZE = getattr(config, "DOMAIN_UPDATE_BATCH_SIZE", 20)
+# 各域已整理到的记忆位置（高水位：已整理记忆中最新的 create_time）
+DOMAIN_UPDATE_STATE_PATH = getattr(config, "DOMAIN_UPDATE_STATE_PATH", os.path.join(DATA_DIR, "domain_update_state.json"))
+
 # ===================== 通用工具函数 =====================
 def load_json_file(file_path: str) -> Optional[Dict[str, Any]]:
     """加载JSON文件，处理异常并返回字典（失败返回None）"""
@@ -40,12 +64,15 @@ class UserDomain:
     def __init__(self, persist_path: str = DEFAULT_USER_DOMAIN_JSON, default_json_path: str = DEFAULT_USER_DOMAIN_JSON):
         self.persist_path = persist_path
         self.default_json_path = default_json_path
+        # 原子写入、写合并与版本历史
+        self.store = DomainStore(persist_path, "用户域")
         
         # 仅保留业务四层结构，无meta_info
         self.meta_layer: Dict[str, Any] = {}
         self.cognitive_layer: Dict[str, Any] = {}
         self.behavior_layer: Dict[str, Any] = {}
         self.concrete_layer: Dict[str, Any] = {}
+        self.version = 0  # 内容版本：每次 from_dict 递增，供激活缓存判断失效
 
         # 核心逻辑：优先加载持久化文件 → 无则加载默认JSON → 保存初始数据
         if not self._load_from_persist_file():
@@ -78,21 +105,9 @@ class UserDomain:
         self.behavior_layer = default_data.get("Behavior_Layer", {})
         self.concrete_layer = default_data.get("Concrete_Layer", {})
 
-    def save_to_file(self) -> None:
-        """保存数据到持久化文件（仅保存四层结构）"""
-        try:
-            # 组装的字典仅包含业务四层，无meta_info
-            save_data = {
-                "Meta_Layer": self.meta_layer,
-                "Cognitive_Layer": self.cognitive_layer,
-                "Behavior_Layer": self.behavior_layer,
-                "Concrete_Layer": self.concrete_layer
-            }
-            with open(self.persist_path, "w", encoding="utf-8") as f:
-                json.dump(save_data, f, ensure_ascii=False, indent=2)
-            logger.info(f"用户域数据已保存到：{self.persist_path}")
-        except Exception as e:
-            logger.error(f"保存用户域数据失败：{e}", exc_info=True)
+    def save_to_file(self, immediate: bool = True) -> None:
+        """保存数据到持久化文件（仅保存四层结构）；immediate 为 False 时与短时间内的其他修改合并写入"""
+        self.store.save(self.to_dict(), immediate=immediate)
     
     def to_dict(self) -> Dict[str, Any]:
         """转换为字典（供LLM调用，无meta_info）"""
@@ -109,6 +124,13 @@ class UserDomain:
         self.cognitive_layer = data.get("Cognitive_Layer", self.cognitive_layer)
         self.behavior_layer = data.get("Behavior_Layer", self.behavior_layer)
         self.concrete_layer = data.get("Concrete_Layer", self.concrete_layer)
+        self.version += 1
+
+    def clone(self) -> "UserDomain":
+        """写时复制：返回内容独立的副本（不读写文件），后台更新在副本上修改，完成后整体替换"""
+        clone = copy.copy(self)
+        clone.from_dict(copy.deepcopy(self.to_dict()))
+        return clone
 
 # ===================== 自我域类（无meta_info） =====================
 class SelfDomain:
@@ -117,12 +139,15 @@ class SelfDomain:
     def __init__(self, persist_path: str = DEFAULT_SELF_DOMAIN_JSON, default_json_path: str = DEFAULT_SELF_DOMAIN_JSON):
         self.persist_path = persist_path
         self.default_json_path = default_json_path
+        # 原子写入、写合并与版本历史
+        self.store = DomainStore(persist_path, "自我域")
         
         # 仅保留业务四层结构，无meta_info
         self.meta_layer: Dict[str, Any] = {}
         self.cognitive_layer: Dict[str, Any] = {}
         self.behavior_layer: Dict[str, Any] = {}
         self.concrete_layer: Dict[str, Any] = {}
+        self.version = 0  # 内容版本：每次 from_dict 递增，供激活缓存判断失效
 
         # 核心逻辑：优先加载持久化文件 → 无则加载默认JSON → 保存初始数据
         if not self._load_from_persist_file():
@@ -155,20 +180,9 @@ class SelfDomain:
         self.behavior_layer = default_data.get("Behavior_Layer", {})
         self.concrete_layer = default_data.get("Concrete_Layer", {})
 
-    def save_to_file(self) -> None:
-        """保存数据到持久化文件（仅保存四层结构）"""
-        try:
-            save_data = {
-                "Meta_Layer": self.meta_layer,
-                "Cognitive_Layer": self.cognitive_layer,
-                "Behavior_Layer": self.behavior_layer,
-                "Concrete_Layer": self.concrete_layer
-            }
-            with open(self.persist_path, "w", encoding="utf-8") as f:
-                json.dump(save_data, f, ensure_ascii=False, indent=2)
-            logger.info(f"自我域数据已保存到：{self.persist_path}")
-        except Exception as e:
-            logger.error(f"保存自我域数据失败：{e}", exc_info=True)
+    def save_to_file(self, immediate: bool = True) -> None:
+        """保存数据到持久化文件（仅保存四层结构）；immediate 为 False 时与短时间内的其他修改合并写入"""
+        self.store.save(self.to_dict(), immediate=immediate)
     
     def to_dict(self) -> Dict[str, Any]:
         """转换为字典（供LLM调用，无meta_info）"""
@@ -185,6 +199,13 @@ class SelfDomain:
         self.cognitive_layer = data.get("Cognitive_Layer", self.cognitive_layer)
         self.behavior_layer = data.get("Behavior_Layer", self.behavior_layer)
         self.concrete_layer = data.get("Concrete_Layer", self.concrete_layer)
+        self.version += 1
+
+    def clone(self) -> "SelfDomain":
+        """写时复制：返回内容独立的副本（不读写文件），后台更新在副本上修改，完成后整体替换"""
+        clone = copy.copy(self)
+        clone.from_dict(copy.deepcopy(self.to_dict()))
+        return clone
 
 # ===================== 域管理器（无meta_info相关逻辑） =====================
 class DomainManager:
@@ -193,91 +214,372 @@ class DomainManager:
     def __init__(self):
         self.user_domain = UserDomain()
         self.self_domain = SelfDomain()
-        self.llm_client = LLMClient()
+        self.llm_client = LLMClient(kind="domain_activation")
+        # 片段索引：域内容变化后的首次激活时重建
+        self.user_fragments = FragmentIndex("用户域")
+        self.self_fragments = FragmentIndex("自我域")
+        self.activation_cache = ActivationCache()
 
         self.last_update_time = datetime.now()
         self.update_interval = timedelta(hours=24)  # 每天更新一次
+        # 增量更新的高水位：{"user": create_time, "self": create_time}
+        self.update_watermarks: Dict[str, str] = load_json_file(DOMAIN_UPDATE_STATE_PATH) or {}
+        self._update_lock = threading.Lock()  # 同一时间只进行一次域更新
+        self._domain_lock = threading.Lock()  # 替换/修改 user_domain、self_domain 的写者（更新、回滚）共用
 
     def _save_domains(self) -> None:
         """保存用户域和自我域"""
         self.user_domain.save_to_file()
         self.self_domain.save_to_file()
     
-    def activate_user_domain(self, user_input: str, conversation_history: str) -> UserDomain:
-        """激活用户域：基于用户输入和对话历史更新"""
+    def flush(self) -> None:
+        """立即写入尚未落盘（合并等待中）的域修改，退出前调用"""
+        self.user_domain.store.flush()
+        self.self_domain.store.flush()
+    
+    def domain_versions(self) -> Dict[str, List[Dict[str, str]]]:
+        """两个域的历史版本（从旧到新）"""
+        return {"user": self.user_domain.store.versions(), "self": self.self_domain.store.versions()}
+    
+    def rollback_domain(self, name: str, version_hash: str) -> bool:
+        """
+        将域回滚到历史版本（回滚本身也会作为新版本记录）
+        :param name: user / self
+        :param version_hash: 版本哈希（可为前缀）
+        """
+        # 不等待进行中的后台更新；更新替换时发现域已被回滚会放弃该域的结果
+        with self._domain_lock:
+            domain = {"user": self.user_domain, "self": self.self_domain}.get(name)
+            data = domain.store.load_version(version_hash) if domain is not None else None
+            if data is None:
+                logger.warning(f"找不到域版本：{name} {version_hash}")
+                return False
+            restored = domain.clone()
+            restored.from_dict(data)
+            if name == "user":
+                self.user_domain = restored
+            else:
+                self.self_domain = restored
+            self.activation_cache.invalidate(name)
+            restored.save_to_file()
+        logger.info(f"{name} 域已回滚到版本 {version_hash}")
+        return True
+    
+    # ===================== 域激活 =====================
+    # 激活结果按 (域, 域版本, 信任阶段) + 查询语义缓存，相似的连续输入直接复用
+    # 激活本身不修改域；计算期间域被替换（更新/回滚）时结果不入缓存，避免以过期内容占用新版本的键
+    def _cached_activation(self, key_fn: Callable[[], CacheKey], query: str, compute: Callable[[], Any]) -> Any:
+        if not DOMAIN_ACTIVATION_CACHE:
+            return compute()
+        key = key_fn()
+        vector = self.activation_cache.encode(query)
+        cached = self.activation_cache.lookup(key, vector)
+        if cached is not None:
+            return cached
+        start = time.perf_counter()
+        result = compute()
+        self._store_activation(key_fn, key, vector, result, time.perf_counter() - start)
+        return result
+    
+    async def _acached_activation(self, key_fn: Callable[[], CacheKey], query: str,
+                                  compute: Callable[[], Awaitable[Any]]) -> Any:
+        if not DOMAIN_ACTIVATION_CACHE:
+            return await compute()
+        key = key_fn()
+        vector = await asyncio.to_thread(self.activation_cache.encode, query)
+        cached = self.activation_cache.lookup(key, vector)
+        if cached is not None:
+            return cached
+        start = time.perf_counter()
+        result = await compute()
+        self._store_activation(key_fn, key, vector, result, time.perf_counter() - start)
+        return result
+    
+    def _store_activation(self, key_fn: Callable[[], CacheKey], key: CacheKey, vector: Any,
+                          result: Any, seconds: float) -> None:
+        if key_fn() != key:
+            metrics.incr("domain_activation_cache.stale_skips")
+            logger.info(f"{key[0]} 域在激活期间发生变化，结果不缓存")
+            return
+        self.activation_cache.store(key, vector, result, seconds)
+    
+    # llm 模式：完整域交给 LLM 筛选；
+    # fragments 模式：本地按向量相似度选出 top-k 片段，不调用 LLM；
+    # fragments+llm 模式：本地选出候选片段，再由 LLM 仅在候选片段上精筛
+    def activate_user_domain(self, user_input: str, conversation_history: str) -> Dict[str, Any]:
+        """激活用户域：返回与用户输入和对话历史相关的部分组成的字典，不修改用户域本身"""
         logger.info("激活用户域...")
-        
-        activation_prompt = prompt.get_user_domain_activation_prompt(
-            current_user_domain=self.user_domain.to_dict(),
+        key_fn = lambda: ("user", self.user_domain.version, None)
+        query = build_query(user_input, conversation_history)
+        return self._cached_activation(key_fn, query, lambda: self._compute_user_activation(user_input, conversation_history))
+    
+    def _compute_user_activation(self, user_input: str, conversation_history: str) -> Dict[str, Any]:
+        candidates = self._user_candidates(user_input, conversation_history)
+        if DOMAIN_ACTIVATION_MODE == "fragments":
+            return candidates
+        result = self.llm_client.call_non_stream(
+            prompt=self._user_activation_prompt(candidates, user_input, conversation_history))
+        return self._apply_user_activation(result, candidates)
+    
+    async def aactivate_user_domain(self, user_input: str, conversation_history: str) -> Dict[str, Any]:
+        """activate_user_domain 的异步版本"""
+        logger.info("激活用户域...")
+        key_fn = lambda: ("user", self.user_domain.version, None)
+        query = build_query(user_input, conversation_history)
+        return await self._acached_activation(
+            key_fn, query, lambda: self._acompute_user_activation(user_input, conversation_history))
+    
+    async def _acompute_user_activation(self, user_input: str,
+                                        conversation_history: str) -> Dict[str, Any]:
+        # 片段选择是本地 CPU 计算，放到线程中执行，不阻塞事件循环
+        candidates = await asyncio.to_thread(self._user_candidates, user_input, conversation_history)
+        if DOMAIN_ACTIVATION_MODE == "fragments":
+            return candidates
+        # 激活位于回复路径上，延迟敏感，使用对冲请求
+        result = await self.llm_client.acall_non_stream(
+            prompt=self._user_activation_prompt(candidates, user_input, conversation_history),
+            hedge=True)
+        return self._apply_user_activation(result, candidates)
+    
+    def _user_candidates(self, user_input: str, conversation_history: str) -> Optional[Dict[str, Any]]:
+        """片段模式下的候选片段（llm 模式返回 None）"""
+        if DOMAIN_ACTIVATION_MODE == "llm":
+            return None
+        top_k = DOMAIN_FRAGMENT_TOP_K if DOMAIN_ACTIVATION_MODE == "fragments" else DOMAIN_FRAGMENT_SHORTLIST_K
+        return self.user_fragments.select(self.user_domain.to_dict(), build_query(user_input, conversation_history),
+                                          top_k=top_k, always=DOMAIN_FRAGMENT_ALWAYS)
+    
+    def _user_activation_prompt(self, candidates: Optional[Dict[str, Any]], user_input: str,
+                                conversation_history: str) -> str:
+        return prompt.get_user_domain_activation_prompt(
+            current_user_domain=self.user_domain.to_dict() if candidates is None else candidates,
             user_input=user_input,
             conversation_history=conversation_history
         )
-        
-        result = self.llm_client.call_non_stream(prompt=activation_prompt)
+    
+    def _apply_user_activation(self, result: Any, candidates: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        # 激活结果只是本轮相关的子集，不写回用户域（写回会让持久化的用户域逐轮缩小）
         if isinstance(result, dict):
-            self.user_domain.from_dict(result)
-        
-        return self.user_domain
+            return result
+        # 失败时以候选片段（llm 模式为全量数据）作为保底
+        return self.user_domain.to_dict() if candidates is None else candidates
 
     def activate_self_domain(self, user_input: str, conversation_history: str, trust: int = 0) -> Dict[str, Any]:
             """激活自我域：仅返回激活后的字典，不覆盖原始全量数据"""
             logger.info("激活自我域...")
-            
-            # 始终使用全量数据进行激活计算
-            current_full_data = self.self_domain.to_dict()
-            
-            activation_prompt = prompt.get_self_domain_activation_prompt(
-                current_self_domain=current_full_data,
-                user_input=user_input,
-                conversation_history=conversation_history,
-                trust=trust
-            )
-            
-            result = self.llm_client.call_non_stream(prompt=activation_prompt)
-            
-            # 如果 LLM 正常返回，返回这个激活后的局部字典
-            if isinstance(result, dict):
-                logger.info(f"成功获取激活域片段")
-                return result
-            
-            # 如果失败，返回全量数据作为保底
-            return current_full_data
+            key_fn = lambda: ("self", self.self_domain.version, prompt.get_attitude_stage(trust))
+            query = build_query(user_input, conversation_history)
+            return self._cached_activation(
+                key_fn, query, lambda: self._compute_self_activation(user_input, conversation_history, trust))
+    
+    def _compute_self_activation(self, user_input: str, conversation_history: str, trust: int) -> Dict[str, Any]:
+            # llm 模式始终使用全量数据进行激活计算
+            current_data = self._self_candidates(user_input, conversation_history, trust)
+            if DOMAIN_ACTIVATION_MODE == "fragments":
+                return current_data
+            result = self.llm_client.call_non_stream(
+                prompt=self._self_activation_prompt(current_data, user_input, conversation_history, trust))
+            return self._select_self_activation(result, current_data)
+    
+    async def aactivate_self_domain(self, user_input: str, conversation_history: str, trust: int = 0) -> Dict[str, Any]:
+        """activate_self_domain 的异步版本"""
+        logger.info("激活自我域...")
+        key_fn = lambda: ("self", self.self_domain.version, prompt.get_attitude_stage(trust))
+        query = build_query(user_input, conversation_history)
+        return await self._acached_activation(
+            key_fn, query, lambda: self._acompute_self_activation(user_input, conversation_history, trust))
+    
+    async def _acompute_self_activation(self, user_input: str, conversation_history: str, trust: int) -> Dict[str, Any]:
+        current_data = await asyncio.to_thread(self._self_candidates, user_input, conversation_history, trust)
+        if DOMAIN_ACTIVATION_MODE == "fragments":
+            return current_data
+        result = await self.llm_client.acall_non_stream(
+            prompt=self._self_activation_prompt(current_data, user_input, conversation_history, trust),
+            hedge=True)
+        return self._select_self_activation(result, current_data)
+    
+    async def aactivate_domains(self, user_input: str, conversation_history: str,
+                                trust: int = 0) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """并发激活用户域与自我域，返回 (激活后的用户域片段, 激活后的自我域片段)"""
+        return await asyncio.gather(
+            self.aactivate_user_domain(user_input=user_input, conversation_history=conversation_history),
+            self.aactivate_self_domain(user_input=user_input, conversation_history=conversation_history, trust=trust)
+        )
+    
+    def _self_candidates(self, user_input: str, conversation_history: str, trust: int) -> Dict[str, Any]:
+        """自我域候选数据：llm 模式为全量数据；片段模式下始终包含当前阶段的态度，排除其他阶段的态度"""
+        full_data = self.self_domain.to_dict()
+        if DOMAIN_ACTIVATION_MODE == "llm":
+            return full_data
+        attitude = ("Cognitive_Layer", "Attitude_towards_User")
+        stage = prompt.get_attitude_stage(trust)
+        top_k = DOMAIN_FRAGMENT_TOP_K if DOMAIN_ACTIVATION_MODE == "fragments" else DOMAIN_FRAGMENT_SHORTLIST_K
+        return self.self_fragments.select(full_data, build_query(user_input, conversation_history), top_k=top_k,
+                                          always=list(DOMAIN_FRAGMENT_ALWAYS) + [attitude + (stage,)],
+                                          exclude=[attitude])
+    
+    @staticmethod
+    def _self_activation_prompt(current_data: Dict[str, Any], user_input: str,
+                                conversation_history: str, trust: int) -> str:
+        return prompt.get_self_domain_activation_prompt(
+            current_self_domain=current_data,
+            user_input=user_input,
+            conversation_history=conversation_history,
+            trust=trust
+        )
+    
+    @staticmethod
+    def _select_self_activation(result: Any, current_data: Dict[str, Any]) -> Dict[str, Any]:
+        # 如果 LLM 正常返回，返回这个激活后的局部字典
+        if isinstance(result, dict):
+            logger.info(f"成功获取激活域片段")
+            return result
+        
+        # 如果失败，返回全量数据（片段模式下为候选片段）作为保底
+        return current_data
     
     def should_update_domains(self) -> bool:
         """判断是否需要更新域（基于时间间隔）"""
         return datetime.now() - self.last_update_time >= self.update_interval
     
-    def update_domains(self, memory_store: "MemoryStore") -> None:
-        """更新域：基于累积的记忆更新"""
-        logger.info("开始更新域...")
-        
-        recent_memories = memory_store.load_all_memories()
-        if not recent_memories:
-            logger.info("没有记忆可用于更新域")
-            return
-        
+    def pending_memory_count(self, memory_store: "MemoryStore") -> int:
+        """尚未整理进域的新记忆条数（以两个域中较旧的高水位计）"""
+        watermark = min(self.update_watermarks.get("user", ""), self.update_watermarks.get("self", ""))
+        return sum(1 for m in memory_store.load_all_memories() if m.get("create_time", "") > watermark)
+    
+    def update_domains(self, memory_store: "MemoryStore") -> bool:
+        """
+        更新域：基于累积的记忆更新
+        在两个域的副本上完成全部 LLM 调用与修改，结束后整体替换，进行中的激活始终读到一致的旧版本；
+        替换时若某个域已被其他写者修改（如回滚），放弃该域的结果，其新记忆留待下次更新
+        :return: 待整理的记忆是否已全部整理进域（没有新记忆时为 True；已有更新在进行、结果解析失败、
+                 只完成部分批次或结果被放弃时为 False）
+        """
+        if not self._update_lock.acquire(blocking=False):
+            logger.info("域更新已在进行中，跳过")
+            return False
+        try:
+            logger.info("开始更新域...")
+            
+            recent_memories = memory_store.load_all_memories()
+            watermark = min(self.update_watermarks.get("user", ""), self.update_watermarks.get("self", ""))
+            if not recent_memories or (DOMAIN_UPDATE_MODE != "full" and
+                                       not any(m.get("create_time", "") > watermark for m in recent_memories)):
+                logger.info("没有记忆可用于更新域")
+                self.last_update_time = datetime.now()
+                return True
+            
+            with self._domain_lock:
+                bases = {"user": (self.user_domain, self.user_domain.version),
+                         "self": (self.self_domain, self.self_domain.version)}
+                user_domain, self_domain = self.user_domain.clone(), self.self_domain.clone()
+            watermarks = dict(self.update_watermarks)
+            if DOMAIN_UPDATE_MODE == "full":
+                complete = self._full_update(user_domain, self_domain, recent_memories, watermarks)
+            else:
+                complete = self._incremental_update(user_domain, self_domain, recent_memories, watermarks)
+            
+            # 原子替换：引用赋值，读者要么读到旧版本，要么读到新版本
+            with self._domain_lock:
+                for name, updated in (("user", user_domain), ("self", self_domain)):
+                    base, version = bases[name]
+                    current = self.user_domain if name == "user" else self.self_domain
+                    if current is not base or current.version != version:
+                        logger.warning(f"{name} 域在更新期间已被修改，放弃本次更新结果")
+                        metrics.incr("domain_update.conflicts")
+                        watermarks[name] = self.update_watermarks.get(name, "")
+                        complete = False
+                        continue
+                    if name == "user":
+                        self.user_domain = updated
+                    else:
+                        self.self_domain = updated
+                    self.activation_cache.invalidate(name)
+                    updated.save_to_file()
+                self.update_watermarks = watermarks
+            self.last_update_time = datetime.now()
+            # 域落盘后再保存高水位，中途退出时最多重复整理一批记忆
+            self._save_watermarks()
+            logger.info("域更新完成" if complete else "域更新部分完成，剩余记忆留待下次更新")
+            return complete
+        finally:
+            self._update_lock.release()
+    
+    def _full_update(self, user_domain: UserDomain, self_domain: "SelfDomain",
+                     recent_memories: List[Dict[str, Any]], watermarks: Dict[str, str]) -> bool:
+        """全量更新：全部记忆 + 完整域交给 LLM，重写整个域；返回两个域是否都更新成功"""
         # 更新用户域
         user_update_prompt = prompt.get_user_domain_update_prompt(
-            current_user_domain=self.user_domain.to_dict(),
+            current_user_domain=user_domain.to_dict(),
             recent_memories=recent_memories
         )
-        user_result = self.llm_client.call_non_stream(prompt=user_update_prompt)
+        user_result = self.llm_client.call_non_stream(prompt=user_update_prompt, kind="domain_update")
         if isinstance(user_result, dict):
-            self.user_domain.from_dict(user_result)
+            user_domain.from_dict(user_result)
         
         # 更新自我域
         self_update_prompt = prompt.get_self_domain_update_prompt(
-            current_self_domain=self.self_domain.to_dict(),
-            user_domain=self.user_domain.to_dict(),
+            current_self_domain=self_domain.to_dict(),
+            user_domain=user_domain.to_dict(),
             recent_memories=recent_memories
         )
-        self_result = self.llm_client.call_non_stream(prompt=self_update_prompt)
+        self_result = self.llm_client.call_non_stream(prompt=self_update_prompt, kind="domain_update")
         if isinstance(self_result, dict):
-            self.self_domain.from_dict(self_result)
+            self_domain.from_dict(self_result)
         
-        self.last_update_time = datetime.now()
-        self._save_domains() 
-        logger.info("域更新完成")
+        # 更新成功的域已整理了全部记忆
+        latest = max(m.get("create_time", "") for m in recent_memories)
+        if isinstance(user_result, dict):
+            watermarks["user"] = latest
+        if isinstance(self_result, dict):
+            watermarks["self"] = latest
+        return isinstance(user_result, dict) and isinstance(self_result, dict)
+    
+    def _incremental_update(self, user_domain: UserDomain, self_domain: "SelfDomain",
+                            memories: List[Dict[str, Any]], watermarks: Dict[str, str]) -> bool:
+        """增量更新：只处理各域高水位之后的新记忆（分批），模型输出 JSON Patch，在本地应用；返回是否全部整理完成"""
+        user_complete = self._update_domain_incrementally("user", user_domain, memories, watermarks, lambda batch: (
+            prompt.get_user_domain_delta_prompt(current_user_domain=user_domain.to_dict(), new_memories=batch)))
+        # 自我域参考已更新的用户域；Meta_Layer 不允许修改
+        self_complete = self._update_domain_incrementally("self", self_domain, memories, watermarks, lambda batch: (
+            prompt.get_self_domain_delta_prompt(current_self_domain=self_domain.to_dict(),
+                                                user_domain=user_domain.to_dict(), new_memories=batch)),
+            protected=("Meta_Layer",))
+        return user_complete and self_complete
+    
+    def _update_domain_incrementally(self, name: str, domain: Union[UserDomain, "SelfDomain"],
+                                     memories: List[Dict[str, Any]], watermarks: Dict[str, str],
+                                     build_prompt: Callable[[List[Dict[str, Any]]], str],
+                                     protected: Tuple[str, ...] = ()) -> bool:
+        watermark = watermarks.get(name, "")
+        new_memories = [m for m in memories if m.get("create_time", "") > watermark]
+        if not new_memories:
+            logger.info(f"{name} 域没有新记忆需要整理")
+            return True
+        logger.info(f"{name} 域增量更新：{len(new_memories)} 条新记忆")
+        for start in range(0, len(new_memories), DOMAIN_UPDATE_BATCH_SIZE):
+            batch = new_memories[start:start + DOMAIN_UPDATE_BATCH_SIZE]
+            result = self.llm_client.call_non_stream(prompt=build_prompt(batch), kind="domain_update")
+            ops = result.get("ops") if isinstance(result, dict) else result
+            if not isinstance(ops, list):
+                # 高水位不前进，下次更新时重试这一批
+                logger.warning(f"{name} 域增量更新结果解析失败，剩余 {len(new_memories) - start} 条记忆留待下次更新")
+                return False
+            patched, applied = apply_patch(domain.to_dict(), ops, protected=protected)
+            if applied:
+                domain.from_dict(patched)
+            metrics.incr("domain_update.patch_ops", applied)
+            metrics.incr("domain_update.memories", len(batch))
+            watermarks[name] = max(m.get("create_time", "") for m in batch)
+        return True
+    
+    def _save_watermarks(self) -> None:
+        """原子写入域更新进度，中途崩溃不会留下截断的进度文件"""
+        try:
+            atomic_write(DOMAIN_UPDATE_STATE_PATH,
+                         json.dumps(self.update_watermarks, ensure_ascii=False).encode("utf-8"))
+        except Exception as e:
+            logger.error(f"保存域更新进度失败：{e}", exc_info=True)
     
     def is_memory_worthy(self, memory_content: Dict[str, Any]) -> bool:
         """判断记忆是否值得保存"""
@@ -289,7 +591,7 @@ class DomainManager:
             self_domain=self.self_domain.to_dict()
         )
         
-        result = self.llm_client.call_non_stream(prompt=prompt_text)
+        result = self.llm_client.call_non_stream(prompt=prompt_text, kind="worthiness")
         if isinstance(result, dict) and "is_worthy" in result:
             return result["is_worthy"]
         
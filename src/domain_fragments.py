@@ -0,0 +1,110 @@
+"""
+域片段索引：把用户域/自我域按键路径拆成可寻址的片段（每个非字典值为一个片段），
+域内容变化时整体向量化一次（未变化的片段命中向量缓存），每轮对话只在本地按相似度选出 top-k 片段，
+再按原有层级拼回字典，代替把完整域 JSON 发给 LLM 做筛选。
+"""
+import json
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+import config
+from logger import logger
+from metrics import metrics
+from embedding_model import get_embedding_model
+from domain_persistence import domain_hash
+
+# 域激活方式：llm（完整域交给 LLM 筛选）/ fragments（本地向量选片段）/ fragments+llm（本地初筛后由 LLM 在候选片段上精筛）
+DOMAIN_ACTIVATION_MODE = getattr(config, "DOMAIN_ACTIVATION_MODE", "fragments")
+DOMAIN_FRAGMENT_TOP_K = getattr(config, "DOMAIN_FRAGMENT_TOP_K", 8)
+# fragments+llm 模式下交给 LLM 精筛的候选片段数
+DOMAIN_FRAGMENT_SHORTLIST_K = getattr(config, "DOMAIN_FRAGMENT_SHORTLIST_K", 20)
+# 始终激活的路径前缀（如身份信息），不占 top-k 名额
+DOMAIN_FRAGMENT_ALWAYS = getattr(config, "DOMAIN_FRAGMENT_ALWAYS", [["Meta_Layer"]])
+# 检索查询中对话历史保留的最大字符数（取最近部分）
+DOMAIN_FRAGMENT_HISTORY_CHARS = getattr(config, "DOMAIN_FRAGMENT_HISTORY_CHARS", 500)
+
+Path = Tuple[str, ...]
+
+
+def split_fragments(data: Any, prefix: Path = ()) -> List[Tuple[Path, Any]]:
+    """按键路径拆分：递归展开字典，其余值（字符串、列表、数字）各为一个片段"""
+    if isinstance(data, dict) and data:
+        return [fragment for key, value in data.items() for fragment in split_fragments(value, prefix + (str(key),))]
+    return [(prefix, data)] if prefix else []
+
+
+def assemble_fragments(fragments: Iterable[Tuple[Path, Any]]) -> Dict[str, Any]:
+    """把片段按路径拼回嵌套字典"""
+    result: Dict[str, Any] = {}
+    for path, value in fragments:
+        node = result
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        node[path[-1]] = value
+    return result
+
+
+def fragment_text(path: Path, value: Any) -> str:
+    """片段的向量化文本：路径 + 值"""
+    text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+    return f"{' / '.join(path)}：{text}"
+
+
+def build_query(user_input: str, conversation_history: str) -> str:
+    """检索查询：用户输入 + 最近的对话历史（非字符串，如检索到的记忆列表，按 JSON 文本处理）"""
+    if not isinstance(conversation_history, str):
+        conversation_history = json.dumps(conversation_history, ensure_ascii=False, default=str) if conversation_history else ""
+    history = conversation_history[-DOMAIN_FRAGMENT_HISTORY_CHARS:]
+    return f"{user_input}\n{history}" if history else user_input
+
+
+def _under(path: Path, prefixes: List[Path]) -> bool:
+    return any(path[:len(prefix)] == prefix for prefix in prefixes)
+
+
+class FragmentIndex:
+    """单个域的片段索引；域内容哈希变化时重建，version 随之递增"""
+
+    def __init__(self, name: str, embedding_model=None):
+        self.name = name
+        self.embedding_model = embedding_model or get_embedding_model()
+        self.version = 0
+        self.hash: Optional[str] = None
+        self._fragments: List[Tuple[Path, Any]] = []
+        self._matrix: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+
+    def sync(self, data: Dict[str, Any]) -> None:
+        """确保索引与域内容一致（内容未变时不做任何事）"""
+        digest = domain_hash(data)
+        with self._lock:
+            if digest == self.hash:
+                return
+            fragments = split_fragments(data)
+            matrix = self.embedding_model.encode([fragment_text(p, v) for p, v in fragments]) if fragments else None
+            self._fragments, self._matrix = fragments, matrix
+            self.hash = digest
+            self.version += 1
+        metrics.incr("domain_fragments.rebuilds")
+        logger.info(f"{self.name}片段索引已重建：{len(fragments)} 个片段（版本 {self.version}）")
+
+    def select(self, data: Dict[str, Any], query: str, top_k: int = DOMAIN_FRAGMENT_TOP_K,
+               always: Iterable[Path] = (), exclude: Iterable[Path] = ()) -> Dict[str, Any]:
+        """
+        选出与查询最相关的 top_k 个片段，连同 always 前缀下的片段拼回字典（保持原有顺序）
+        :param always: 始终激活的路径前缀
+        :param exclude: 不参与排序的路径前缀（always 优先）
+        """
+        self.sync(data)
+        with self._lock:
+            fragments, matrix = self._fragments, self._matrix
+        if not fragments:
+            return {}
+        always, exclude = [tuple(p) for p in always], [tuple(p) for p in exclude]
+        chosen = {i for i, (path, _) in enumerate(fragments) if _under(path, always)}
+        scores = matrix @ self.embedding_model.encode([query])[0]
+        ranked = [int(i) for i in np.argsort(-scores, kind="stable")
+                  if int(i) not in chosen and not _under(fragments[i][0], exclude)]
+        chosen.update(ranked[:top_k])
+        metrics.observe("domain_fragments.selected", len(chosen))
+        return assemble_fragments(fragments[i] for i in sorted(chosen))
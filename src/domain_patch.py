@@ -0,0 +1,99 @@
+"""
+域增量更新的补丁应用：支持 JSON Patch（RFC 6902）中的 add / replace / remove 三种操作，
+路径为 JSON Pointer（如 /Cognitive_Layer/Preference/food）。
+补丁在副本上应用，无效的操作（路径不存在、越过受保护的层等）逐条跳过并记录日志，不影响其余操作。
+"""
+import copy
+from typing import Any, Dict, Iterable, List, Tuple
+from logger import logger
+
+DOMAIN_LAYERS = ("Meta_Layer", "Cognitive_Layer", "Behavior_Layer", "Concrete_Layer")
+
+
+class PatchError(ValueError):
+    """单条补丁操作无法应用"""
+
+
+def parse_pointer(path: str) -> List[str]:
+    """JSON Pointer -> 键列表（处理 ~1 与 ~0 转义）"""
+    if not isinstance(path, str) or not path.startswith("/"):
+        raise PatchError(f"非法路径：{path}")
+    return [token.replace("~1", "/").replace("~0", "~") for token in path[1:].split("/")]
+
+
+def _list_index(container: list, token: str, allow_end: bool) -> int:
+    if allow_end and token == "-":
+        return len(container)
+    if not token.isdigit():
+        raise PatchError(f"非法列表下标：{token}")
+    index = int(token)
+    if index > len(container) or (index == len(container) and not allow_end):
+        raise PatchError(f"列表下标越界：{token}")
+    return index
+
+
+def _apply_op(doc: Dict[str, Any], op: Dict[str, Any]) -> None:
+    kind = op.get("op")
+    tokens = parse_pointer(op.get("path"))
+    if kind not in ("add", "replace", "remove"):
+        raise PatchError(f"不支持的操作：{kind}")
+    if kind != "remove" and "value" not in op:
+        raise PatchError("缺少 value")
+    parent: Any = doc
+    for i, token in enumerate(tokens[:-1]):
+        if isinstance(parent, dict):
+            if token not in parent:
+                # add 时自动补全中间层级（模型常直接给出新字段的完整路径）
+                if kind != "add":
+                    raise PatchError(f"路径不存在：{op['path']}")
+                parent[token] = {}
+            parent = parent[token]
+        elif isinstance(parent, list):
+            parent = parent[_list_index(parent, token, allow_end=False)]
+        else:
+            raise PatchError(f"路径不存在：{op['path']}")
+    last = tokens[-1]
+    if isinstance(parent, dict):
+        if kind != "add" and last not in parent:
+            raise PatchError(f"路径不存在：{op['path']}")
+        if kind == "remove":
+            del parent[last]
+        else:
+            parent[last] = op["value"]
+    elif isinstance(parent, list):
+        index = _list_index(parent, last, allow_end=kind == "add")
+        if kind == "add":
+            parent.insert(index, op["value"])
+        elif kind == "replace":
+            parent[index] = op["value"]
+        else:
+            del parent[index]
+    else:
+        raise PatchError(f"路径不存在：{op['path']}")
+
+
+def apply_patch(doc: Dict[str, Any], ops: Iterable[Dict[str, Any]],
+                protected: Tuple[str, ...] = ()) -> Tuple[Dict[str, Any], int]:
+    """
+    在 doc 的副本上应用补丁
+    :param doc: 域字典（四层结构）
+    :param ops: 补丁操作列表
+    :param protected: 不允许修改的顶层（如自我域的 Meta_Layer）
+    :return: (应用后的字典, 成功应用的操作数)
+    """
+    result = copy.deepcopy(doc)
+    applied = 0
+    for op in ops:
+        try:
+            if not isinstance(op, dict):
+                raise PatchError(f"非法操作：{op}")
+            tokens = parse_pointer(op.get("path"))
+            if len(tokens) < 2 or tokens[0] not in DOMAIN_LAYERS:
+                raise PatchError(f"只能修改四层结构内的字段：{op.get('path')}")
+            if tokens[0] in protected:
+                raise PatchError(f"{tokens[0]} 不允许修改")
+            _apply_op(result, op)
+            applied += 1
+        except PatchError as e:
+            logger.warning(f"跳过域补丁操作：{str(e)}")
+    return result, applied
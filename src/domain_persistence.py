@@ -0,0 +1,160 @@
+"""
+域持久化：
+- 原子写入：先写同目录临时文件并 fsync，再 os.replace 替换，崩溃时文件要么是旧版本要么是新版本
+- 写合并：save() 只记录最新内容，同一文件在 DOMAIN_SAVE_INTERVAL 秒内最多写一次；flush() 立即落盘
+- 版本历史：每次内容变化时在 <文件名>.history/ 下保留一份带内容哈希的快照（最多 DOMAIN_HISTORY_SIZE 份），可按哈希回滚
+- 紧凑序列化：默认不缩进（DOMAIN_PERSIST_INDENT），内容未变化时跳过写入
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+import config
+from logger import logger
+from metrics import metrics
+
+DOMAIN_SAVE_INTERVAL = getattr(config, "DOMAIN_SAVE_INTERVAL", 5.0)
+DOMAIN_HISTORY_SIZE = getattr(config, "DOMAIN_HISTORY_SIZE", 20)
+DOMAIN_PERSIST_INDENT = getattr(config, "DOMAIN_PERSIST_INDENT", None)
+
+
+def domain_hash(data: Dict[str, Any]) -> str:
+    """域内容哈希（紧凑、键排序的 JSON，与格式无关）"""
+    payload = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def serialize(data: Dict[str, Any], indent: Optional[int] = DOMAIN_PERSIST_INDENT) -> bytes:
+    separators = (",", ":") if indent is None else None
+    return json.dumps(data, ensure_ascii=False, indent=indent, separators=separators).encode("utf-8")
+
+
+def atomic_write(path: str, payload: bytes) -> None:
+    """临时文件 + fsync + rename 的原子写入"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    # 目录项也落盘，保证 rename 在崩溃后可见（部分平台不支持打开目录，忽略）
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+class DomainStore:
+    """单个域文件的持久化：写合并 + 原子写入 + 版本历史（线程安全）"""
+
+    def __init__(self, path: str, name: str, interval: float = DOMAIN_SAVE_INTERVAL,
+                 history_size: int = DOMAIN_HISTORY_SIZE):
+        self.path = path
+        self.name = name
+        self.interval = interval
+        self.history_size = history_size
+        self.history_dir = os.path.splitext(path)[0] + ".history"
+        self._pending: Optional[Dict[str, Any]] = None
+        self._last_hash: Optional[str] = None
+        self._last_write = 0.0
+        self._timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+
+    def save(self, data: Dict[str, Any], immediate: bool = False) -> None:
+        """
+        保存域内容；非 immediate 时合并到下一次写入（距上次写入不足 interval 秒时延后）
+        :param data: 域字典（调用方之后不应原地修改其中的内容）
+        """
+        with self._lock:
+            self._pending = data
+            delay = self.interval - (time.monotonic() - self._last_write)
+            if not immediate and delay > 0:
+                if self._timer is None:
+                    self._timer = threading.Timer(delay, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                metrics.incr("domain_persist.coalesced")
+                return
+        self.flush()
+
+    def flush(self) -> None:
+        """立即写入尚未落盘的内容"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            data, self._pending = self._pending, None
+            if data is None:
+                return
+            digest = domain_hash(data)
+            self._last_write = time.monotonic()
+            if digest == self._last_hash:
+                return
+            try:
+                payload = serialize(data)
+                self._record_version(digest, payload)
+                atomic_write(self.path, payload)
+                self._last_hash = digest
+                metrics.incr("domain_persist.writes")
+                logger.info(f"{self.name}数据已保存到：{self.path}（版本 {digest[:12]}）")
+            except Exception as e:
+                logger.error(f"保存{self.name}数据失败：{e}", exc_info=True)
+
+    # ===================== 版本历史 =====================
+    def _record_version(self, digest: str, payload: bytes) -> None:
+        """保存一份历史快照并淘汰超出数量的最旧版本（调用方持有锁）"""
+        if self.history_size <= 0:
+            return
+        versions = self._version_files()
+        if versions and versions[-1].endswith(f"-{digest[:12]}.json"):
+            return
+        name = f"{datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{digest[:12]}.json"
+        atomic_write(os.path.join(self.history_dir, name), payload)
+        for stale in (versions + [name])[:-self.history_size]:
+            try:
+                os.remove(os.path.join(self.history_dir, stale))
+            except OSError:
+                pass
+
+    def _version_files(self) -> List[str]:
+        if not os.path.isdir(self.history_dir):
+            return []
+        return sorted(f for f in os.listdir(self.history_dir) if f.endswith(".json"))
+
+    def versions(self) -> List[Dict[str, str]]:
+        """历史版本列表（从旧到新）：保存时间与内容哈希前缀"""
+        with self._lock:
+            files = self._version_files()
+        result = []
+        for file_name in files:
+            saved_at, _, digest = file_name[:-len(".json")].partition("-")
+            result.append({"saved_at": saved_at, "hash": digest})
+        return result
+
+    def load_version(self, hash_prefix: str) -> Optional[Dict[str, Any]]:
+        """按哈希前缀读取历史版本（匹配多个时取最新的一个）"""
+        with self._lock:
+            matches = [f for f in self._version_files() if f[:-len(".json")].partition("-")[2].startswith(hash_prefix)]
+        if not hash_prefix or not matches:
+            return None
+        with open(os.path.join(self.history_dir, matches[-1]), "r", encoding="utf-8") as f:
+            return json.load(f)
@@ -0,0 +1,169 @@
+"""
+后台域更新调度：域更新需要数次大型 LLM 调用，放在交互路径之外的后台线程中执行。
+触发条件（满足任一）：
+- 定时：距上次更新超过 DomainManager.update_interval（默认 24 小时）
+- 空闲：用户超过 DOMAIN_UPDATE_IDLE_SECONDS 秒没有输入，且有不少于 DOMAIN_UPDATE_MIN_NEW_MEMORIES 条新记忆
+- 手动：调用 trigger()（交互中输入 `update domains`）
+自动触发的更新失败或只完成一部分时（如结果解析失败，新记忆仍未整理），按指数退避推迟下一次自动更新，
+避免每个检查周期都重复发起大型 LLM 调用；手动触发不受退避限制，更新完整成功后退避清零。
+更新在域的副本上进行，完成后整体替换（见 DomainManager.update_domains），不影响进行中的激活。
+"""
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional
+import config
+from logger import logger
+from metrics import metrics
+
+# 是否自动（定时/空闲）触发；关闭后只响应手动触发
+DOMAIN_SCHEDULER_ENABLED = getattr(config, "DOMAIN_SCHEDULER_ENABLED", True)
+DOMAIN_UPDATE_IDLE_SECONDS = getattr(config, "DOMAIN_UPDATE_IDLE_SECONDS", 300)
+DOMAIN_UPDATE_MIN_NEW_MEMORIES = getattr(config, "DOMAIN_UPDATE_MIN_NEW_MEMORIES", 5)
+# 后台线程检查触发条件的间隔（秒）
+DOMAIN_SCHEDULER_POLL_SECONDS = getattr(config, "DOMAIN_SCHEDULER_POLL_SECONDS", 30)
+# 更新未完整成功后的退避：首次等待 DOMAIN_UPDATE_RETRY_SECONDS 秒，之后每次翻倍，最长 DOMAIN_UPDATE_RETRY_MAX_SECONDS 秒
+DOMAIN_UPDATE_RETRY_SECONDS = getattr(config, "DOMAIN_UPDATE_RETRY_SECONDS", 300)
+DOMAIN_UPDATE_RETRY_MAX_SECONDS = getattr(config, "DOMAIN_UPDATE_RETRY_MAX_SECONDS", 6 * 3600)
+
+
+class DomainUpdateScheduler:
+    """域更新后台调度器（单个守护线程）"""
+
+    def __init__(self, domain_manager, memory_store, auto: bool = DOMAIN_SCHEDULER_ENABLED,
+                 idle_seconds: float = DOMAIN_UPDATE_IDLE_SECONDS, min_new_memories: int = DOMAIN_UPDATE_MIN_NEW_MEMORIES,
+                 poll_seconds: float = DOMAIN_SCHEDULER_POLL_SECONDS, retry_seconds: float = DOMAIN_UPDATE_RETRY_SECONDS,
+                 retry_max_seconds: float = DOMAIN_UPDATE_RETRY_MAX_SECONDS):
+        self.domain_manager = domain_manager
+        self.memory_store = memory_store
+        self.auto = auto
+        self.idle_seconds = idle_seconds
+        self.min_new_memories = min_new_memories
+        self.poll_seconds = poll_seconds
+        self.retry_seconds = retry_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self._last_activity = time.monotonic()
+        self._manual = False
+        self._running = False
+        self._runs = 0
+        self._last_run: Optional[datetime] = None
+        self._last_trigger: Optional[str] = None
+        self._last_duration: Optional[float] = None
+        self._last_error: Optional[str] = None
+        self._failures = 0  # 连续未完整成功的次数
+        self._retry_at = 0.0  # 退避结束时间（monotonic），之前不自动触发
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="domain-update-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """停止调度，最多等待 timeout 秒；未完成的更新只作用于副本，放弃后域保持原样"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def touch(self) -> None:
+        """记录一次用户活动（空闲计时从此刻重新开始）"""
+        with self._lock:
+            self._last_activity = time.monotonic()
+
+    def trigger(self) -> None:
+        """手动触发一次更新（在后台执行，立即返回）"""
+        with self._lock:
+            self._manual = True
+        self._wakeup.set()
+
+    # ===================== 调度 =====================
+    def _due(self) -> Optional[str]:
+        """返回触发原因，未到更新时机时返回 None"""
+        with self._lock:
+            if self._manual:
+                self._manual = False
+                return "手动"
+            now = time.monotonic()
+            idle = now - self._last_activity
+            backing_off = now < self._retry_at
+        if not self.auto or backing_off:
+            return None
+        if self.domain_manager.should_update_domains():
+            return "定时"
+        if idle >= self.idle_seconds and \
+                self.domain_manager.pending_memory_count(self.memory_store) >= self.min_new_memories:
+            return "空闲"
+        return None
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.poll_seconds)
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                return
+            try:
+                reason = self._due()
+            except Exception as e:
+                logger.error(f"域更新触发条件检查失败：{str(e)}", exc_info=True)
+                continue
+            if reason:
+                self._update(reason)
+
+    def _update(self, reason: str) -> None:
+        logger.info(f"后台域更新开始（{reason}触发）")
+        with self._lock:
+            self._running = True
+            self._last_trigger = reason
+        start = time.perf_counter()
+        error = None
+        try:
+            if not self.domain_manager.update_domains(self.memory_store):
+                error = "更新未完整完成"
+        except Exception as e:
+            error = str(e)
+            logger.error(f"后台域更新失败：{error}", exc_info=True)
+        duration = time.perf_counter() - start
+        metrics.incr("domain_scheduler.runs")
+        metrics.observe("domain_scheduler.update_seconds", duration)
+        with self._lock:
+            self._running = False
+            self._runs += 1
+            self._last_run = datetime.now()
+            self._last_duration = duration
+            self._last_error = error
+            if error is None:
+                self._failures, self._retry_at = 0, 0.0
+                return
+            self._failures += 1
+            delay = min(self.retry_seconds * 2 ** (self._failures - 1), self.retry_max_seconds)
+            self._retry_at = time.monotonic() + delay
+            failures = self._failures
+        metrics.incr("domain_scheduler.failures")
+        logger.warning(f"域更新未完整成功（连续 {failures} 次），{delay:.0f} 秒内不再自动触发")
+
+    def status(self) -> Dict[str, Any]:
+        """调度状态（供交互命令展示）"""
+        with self._lock:
+            status = {
+                "auto": self.auto,
+                "running": self._running,
+                "runs": self._runs,
+                "last_trigger": self._last_trigger,
+                "last_run": self._last_run.isoformat(timespec="seconds") if self._last_run else None,
+                "last_duration_seconds": round(self._last_duration, 2) if self._last_duration is not None else None,
+                "last_error": self._last_error,
+                "consecutive_failures": self._failures,
+                "retry_in_seconds": max(0, round(self._retry_at - time.monotonic())),
+                "idle_seconds": round(time.monotonic() - self._last_activity),
+            }
+        status["next_scheduled"] = (self.domain_manager.last_update_time
+                                    + self.domain_manager.update_interval).isoformat(timespec="seconds")
+        status["pending_memories"] = self.domain_manager.pending_memory_count(self.memory_store)
+        status["domain_versions"] = {"user": self.domain_manager.user_domain.version,
+                                     "self": self.domain_manager.self_domain.version}
+        return status
@@ -0,0 +1,129 @@
+"""
+按内容寻址的向量缓存：键为 sha1(模型标识 + 规范化文本)。
+- 内存层：LRU，容量由 config.EMBEDDING_CACHE_SIZE 控制
+- 磁盘层（可选）：SQLite，由 config.EMBEDDING_CACHE_DISK_PATH 指定，跨进程/重启复用
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+import numpy as np
+import config
+from logger import logger
+from metrics import metrics
+
+EMBEDDING_CACHE_SIZE = getattr(config, "EMBEDDING_CACHE_SIZE", 10000)
+EMBEDDING_CACHE_DISK_PATH = getattr(config, "EMBEDDING_CACHE_DISK_PATH", None)
+
+
+def normalize_text(text: str) -> str:
+    """规范化文本：去除首尾空白并合并连续空白"""
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def cache_key(model_id: str, text: str) -> str:
+    return hashlib.sha1(f"{model_id}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """两级向量缓存（内存 LRU + 可选 SQLite），线程安全"""
+
+    def __init__(self, max_entries: int = EMBEDDING_CACHE_SIZE, disk_path: Optional[str] = EMBEDDING_CACHE_DISK_PATH):
+        self.max_entries = max_entries
+        self._lru: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if disk_path:
+            try:
+                os.makedirs(os.path.dirname(disk_path) or ".", exist_ok=True)
+                self._db = sqlite3.connect(disk_path, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vec BLOB NOT NULL)")
+                self._db.commit()
+            except Exception as e:
+                logger.error(f"向量磁盘缓存初始化失败，仅使用内存缓存：{str(e)}", exc_info=True)
+                self._db = None
+
+    def _remember(self, key: str, vector: np.ndarray) -> None:
+        """写入内存层并按 LRU 淘汰（调用方持有锁）"""
+        self._lru[key] = vector
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def get_many(self, model_id: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """批量查询缓存，未命中的位置为 None"""
+        keys = [cache_key(model_id, t) for t in texts]
+        found: Dict[str, np.ndarray] = {}
+        with self._lock:
+            for key in keys:
+                if key in self._lru:
+                    self._lru.move_to_end(key)
+                    found[key] = self._lru[key]
+            missing = [k for k in dict.fromkeys(keys) if k not in found]
+            if missing and self._db is not None:
+                try:
+                    for lo in range(0, len(missing), 500):
+                        chunk = missing[lo:lo + 500]
+                        rows = self._db.execute(
+                            f"SELECT key, vec FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                        ).fetchall()
+                        for key, blob in rows:
+                            vector = np.frombuffer(blob, dtype=np.float32)
+                            found[key] = vector
+                            self._remember(key, vector)
+                            metrics.incr("embedding_cache.disk_hit")
+                except Exception as e:
+                    logger.error(f"读取向量磁盘缓存失败：{str(e)}", exc_info=True)
+        results = [found.get(k) for k in keys]
+        hits = sum(v is not None for v in results)
+        metrics.incr("embedding_cache.hit", hits)
+        metrics.incr("embedding_cache.miss", len(results) - hits)
+        return results
+
+    def put_many(self, model_id: str, texts: List[str], vectors: np.ndarray) -> None:
+        """批量写入缓存"""
+        items = [(cache_key(model_id, t), np.ascontiguousarray(v, dtype=np.float32)) for t, v in zip(texts, vectors)]
+        with self._lock:
+            for key, vector in items:
+                self._remember(key, vector)
+            if self._db is not None:
+                try:
+                    self._db.executemany("INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)",
+                                         [(k, v.tobytes()) for k, v in items])
+                    self._db.commit()
+                except Exception as e:
+                    logger.error(f"写入向量磁盘缓存失败：{str(e)}", exc_info=True)
+
+    def stats(self) -> Dict[str, float]:
+        """命中统计；estimated_saved_seconds 按平均单条编码耗时估算节省的模型时间"""
+        hits = metrics.get("embedding_cache.hit")
+        misses = metrics.get("embedding_cache.miss")
+        encoded = metrics.get("embedding.encoded_texts")
+        encode_seconds = metrics.snapshot()["observations"].get("embedding.encode_seconds", {}).get("sum", 0.0)
+        with self._lock:
+            size = len(self._lru)
+        return {
+            "hits": hits,
+            "disk_hits": metrics.get("embedding_cache.disk_hit"),
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "memory_entries": size,
+            "estimated_saved_seconds": hits * (encode_seconds / encoded) if encoded else 0.0,
+        }
+
+
+_cache: Optional[EmbeddingCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """获取进程内共享的向量缓存"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache()
+        return _cache
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+from typing import Callable, Dict, List, Optional
+import numpy as np
+from logger import logger
+
+
+def memory_text(memory: Dict) -> str:
+    """将记忆拼接成用于向量表示的文本"""
+    return f"{memory['topic']} {memory['content']} {' '.join(memory['keywords'])}"
+
+
+def memory_id(memory: Dict) -> str:
+    """记忆的稳定标识：创建时间 + 文本内容的哈希"""
+    raw = f"{memory.get('create_time', '')}\n{memory_text(memory)}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+class EmbeddingIndex:
+    """
+    持久化的记忆向量索引，与 JSONL 放在同一目录：
+    - <name>.emb.f32：按行存储的 float32 矩阵（已归一化，内存映射读取）
+    - <name>.emb.ids：与矩阵逐行对应的记忆 id（追加写）
+    - <name>.emb.json：元信息（模型标识、向量维度）
+    """
+
+    def __init__(self, memory_path: str, model_id: str):
+        base = os.path.splitext(memory_path)[0]
+        self.matrix_path = base + ".emb.f32"
+        self.ids_path = base + ".emb.ids"
+        self.meta_path = base + ".emb.json"
+        self.model_id = model_id
+        self.dim: Optional[int] = None
+        self.ids: List[str] = []
+        self._matrix: Optional[np.ndarray] = None
+        # 上次 sync 已逐条核对过 id 的记忆对象（与 self.ids 前缀逐行对应），再次核对时同一对象无需重新哈希
+        self._verified: List[Dict] = []
+        # 矩阵被整体替换（重建/清空）时递增，供上层检索后端判断是否需要重置
+        self.generation = 0
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """当前的向量矩阵（N x dim），为空时返回 0 行矩阵"""
+        if self._matrix is None:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return self._matrix
+
+    def _load(self) -> None:
+        """从磁盘加载索引，任何不一致都视为空索引（后续 sync 时重建）"""
+        try:
+            if not (os.path.exists(self.meta_path) and os.path.exists(self.ids_path) and os.path.exists(self.matrix_path)):
+                return
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("model_id") != self.model_id:
+                logger.info("向量索引模型不一致，等待重建")
+                return
+            dim = int(meta["dim"])
+            with open(self.ids_path, "r", encoding="utf-8") as f:
+                ids = [line.strip() for line in f if line.strip()]
+            rows = os.path.getsize(self.matrix_path) // (dim * 4)
+            if rows != len(ids):
+                logger.warning(f"向量索引行数({rows})与 id 数({len(ids)})不一致，等待重建")
+                return
+            self.dim = dim
+            self.ids = ids
+            self._open_matrix()
+            logger.info(f"已加载向量索引：{len(self.ids)} 条")
+        except Exception as e:
+            logger.error(f"加载向量索引失败：{str(e)}", exc_info=True)
+            self.dim, self.ids, self._matrix = None, [], None
+
+    def _open_matrix(self) -> None:
+        """以只读方式内存映射向量矩阵"""
+        if not self.ids:
+            self._matrix = None
+            return
+        self._matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r", shape=(len(self.ids), self.dim))
+
+    def _write_meta(self) -> None:
+        with open(self.meta_path, "w", encoding="utf-8") as f:
+            json.dump({"model_id": self.model_id, "dim": self.dim}, f)
+
+    def rebuild(self, memories: List[Dict], encode: Callable[[List[str]], np.ndarray]) -> None:
+        """全量重建索引"""
+        logger.info(f"重建向量索引：{len(memories)} 条记忆")
+        self.generation += 1
+        self._matrix = None
+        embeddings = encode([memory_text(m) for m in memories]) if memories else None
+        ids = [memory_id(m) for m in memories]
+        if embeddings is not None:
+            self.dim = int(embeddings.shape[1])
+        with open(self.matrix_path, "wb") as f:
+            if embeddings is not None:
+                f.write(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+        with open(self.ids_path, "w", encoding="utf-8") as f:
+            f.writelines(i + "\n" for i in ids)
+        if self.dim is not None:
+            self._write_meta()
+        self.ids = ids
+        self._verified = list(memories)
+        self._open_matrix()
+
+    def append(self, memories: List[Dict], encode: Callable[[List[str]], np.ndarray]) -> None:
+        """增量追加记忆向量（先写矩阵再写 id，中途崩溃会在下次加载时被识别并重建）"""
+        if not memories:
+            return
+        embeddings = np.ascontiguousarray(encode([memory_text(m) for m in memories]), dtype=np.float32)
+        if self.dim is None:
+            self.dim = int(embeddings.shape[1])
+            self._write_meta()
+        self._matrix = None
+        with open(self.matrix_path, "ab") as f:
+            f.write(embeddings.tobytes())
+        new_ids = [memory_id(m) for m in memories]
+        with open(self.ids_path, "a", encoding="utf-8") as f:
+            f.writelines(i + "\n" for i in new_ids)
+        self.ids.extend(new_ids)
+        self._open_matrix()
+
+    def sync(self, memories: List[Dict], encode: Callable[[List[str]], np.ndarray]) -> None:
+        """
+        保证索引与记忆列表一致（逐条比对完整的 id 序列，中间任意一条被改写都能发现）：
+        - 完全一致：不做任何事
+        - 记忆只在末尾新增：只对新增部分编码并追加
+        - 其他情况（清空、外部改写、模型变更）：全量重建
+        """
+        n = len(self.ids)
+        if n <= len(memories) and self._prefix_matches(memories, n):
+            if n < len(memories):
+                self.append(memories[n:], encode)
+                self._verified = memories[:len(self.ids)]
+            return
+        self.rebuild(memories, encode)
+
+    def _prefix_matches(self, memories: List[Dict], n: int) -> bool:
+        """memories 的前 n 条是否与索引的 id 逐条一致（记忆写入后不再修改，上次核对过的同一对象直接复用结果）"""
+        verified = self._verified
+        for i in range(n):
+            memory = memories[i]
+            if i < len(verified) and memory is verified[i]:
+                continue
+            if memory_id(memory) != self.ids[i]:
+                return False
+        self._verified = memories[:n]
+        return True
+
+    def clear(self) -> None:
+        """删除索引文件"""
+        self.generation += 1
+        self._matrix = None
+        self.ids = []
+        self._verified = []
+        for path in (self.matrix_path, self.ids_path, self.meta_path):
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,113 @@
+"""
+进程级句向量模型注册表：
+- 延迟加载：首次编码（或显式预热）时才加载模型，不拖慢启动
+- 共享：同一 (路径, 后端) 在进程内只加载一份，所有 MemoryStore 等组件共用
+- 可选推理后端：torch（默认）/ int8（torch 动态量化）/ onnx / onnx-int8（ONNX Runtime CPU）
+"""
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import config
+from logger import logger
+from metrics import metrics
+from embedding_cache import get_embedding_cache
+
+EMBEDDING_MODEL_PATH = getattr(config, "EMBEDDING_MODEL_PATH",
+                               "/amax/xidian_ty/ln/memory/models/paraphrase-multilingual-MiniLM-L12-v2")
+EMBEDDING_BACKEND = getattr(config, "EMBEDDING_BACKEND", "torch")
+# onnx-int8 后端使用的量化模型文件（相对模型目录）
+EMBEDDING_ONNX_INT8_FILE = getattr(config, "EMBEDDING_ONNX_INT8_FILE", "onnx/model_quint8_avx2.onnx")
+EMBEDDING_BATCH_SIZE = getattr(config, "EMBEDDING_BATCH_SIZE", 32)
+
+SUPPORTED_BACKENDS = ("torch", "int8", "onnx", "onnx-int8")
+
+
+class EmbeddingModel:
+    """延迟加载的句向量模型封装，encode 统一返回归一化的 float32 矩阵"""
+
+    def __init__(self, path: str, backend: str = "torch"):
+        if backend not in SUPPORTED_BACKENDS:
+            raise ValueError(f"不支持的向量模型后端：{backend}")
+        self.path = path
+        self.backend = backend
+        # 模型标识：不同后端的向量存在细微差异，向量索引需按标识区分
+        name = os.path.basename(os.path.normpath(path))
+        self.model_id = name if backend == "torch" else f"{name}@{backend}"
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    def _load(self):
+        """加载模型（线程安全，只加载一次）"""
+        with self._lock:
+            if self._model is not None:
+                return self._model
+            start = time.perf_counter()
+            # 延迟导入：sentence_transformers/torch 本身的导入就需要数秒
+            from sentence_transformers import SentenceTransformer
+            if self.backend == "onnx":
+                model = SentenceTransformer(self.path, device="cpu", backend="onnx")
+            elif self.backend == "onnx-int8":
+                model = SentenceTransformer(self.path, device="cpu", backend="onnx",
+                                            model_kwargs={"file_name": EMBEDDING_ONNX_INT8_FILE})
+            else:
+                model = SentenceTransformer(self.path)
+                if self.backend == "int8":
+                    import torch
+                    model = model.to("cpu")
+                    model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            self._model = model
+            logger.info(f"向量模型已加载：{self.model_id}，耗时 {time.perf_counter() - start:.2f}s")
+            return model
+
+    def preload_in_background(self) -> threading.Thread:
+        """在后台线程预热模型，首次检索时无需再等待加载"""
+        thread = threading.Thread(target=self._load, name="embedding-preload", daemon=True)
+        thread.start()
+        return thread
+
+    def _encode_uncached(self, texts: List[str]) -> np.ndarray:
+        model = self._model or self._load()
+        start = time.perf_counter()
+        embeddings = model.encode(texts, batch_size=EMBEDDING_BATCH_SIZE, convert_to_numpy=True,
+                                  normalize_embeddings=True, show_progress_bar=False)
+        metrics.observe("embedding.encode_seconds", time.perf_counter() - start)
+        metrics.incr("embedding.encoded_texts", len(texts))
+        return np.asarray(embeddings, dtype=np.float32).reshape(len(texts), -1)
+
+    def encode(self, texts: List[str], use_cache: bool = True) -> np.ndarray:
+        """将文本编码为归一化的 float32 向量（N x dim），命中缓存的文本不再经过模型"""
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        if not use_cache:
+            return self._encode_uncached(texts)
+        cache = get_embedding_cache()
+        cached = cache.get_many(self.model_id, texts)
+        # 未命中的文本去重后一次批量编码
+        missing = list(dict.fromkeys(t for t, v in zip(texts, cached) if v is None))
+        if missing:
+            encoded = self._encode_uncached(missing)
+            cache.put_many(self.model_id, missing, encoded)
+            fresh = dict(zip(missing, encoded))
+            cached = [v if v is not None else fresh[t] for t, v in zip(texts, cached)]
+        return np.stack(cached).astype(np.float32, copy=False)
+
+
+_registry: Dict[Tuple[str, str], EmbeddingModel] = {}
+_registry_lock = threading.Lock()
+
+
+def get_embedding_model(path: Optional[str] = None, backend: Optional[str] = None) -> EmbeddingModel:
+    """获取进程内共享的向量模型（不会触发加载）"""
+    key = (path or EMBEDDING_MODEL_PATH, backend or EMBEDDING_BACKEND)
+    with _registry_lock:
+        model = _registry.get(key)
+        if model is None:
+            model = EmbeddingModel(*key)
+            _registry[key] = model
+        return model
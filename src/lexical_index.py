@@ -0,0 +1,110 @@
+"""
+增量倒排索引 + BM25 打分，用于记忆的词法检索。
+中文没有空格分词，这里对连续的中日韩字符取字二元组（单字片段保留单字），
+对英文/数字按词切分，足以区分“鹰愁涧”“银角大王”这类专有名词。
+"""
+import math
+import re
+from collections import Counter, defaultdict
+from typing import Dict, List, Tuple
+
+_TOKEN_RE = re.compile(r"[㐀-䶿一-鿿豈-﫿]+|[a-z0-9]+")
+_CJK_RE = re.compile(r"[㐀-䶿一-鿿豈-﫿]")
+
+# 各字段在文档中的重复次数（即字段权重）
+FIELD_WEIGHTS = {"topic": 2, "content": 1, "keywords": 2}
+
+
+def tokenize(text: str) -> List[str]:
+    """中文取字二元组，英文/数字按词切分（统一小写）"""
+    tokens = []
+    for run in _TOKEN_RE.findall(text.lower()):
+        if _CJK_RE.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+def memory_tokens(memory: Dict) -> List[str]:
+    """按字段权重拼接 topic / content / keywords 的词项"""
+    tokens = []
+    for field, weight in FIELD_WEIGHTS.items():
+        value = memory.get(field, "")
+        text = " ".join(value) if isinstance(value, list) else str(value)
+        tokens.extend(tokenize(text) * weight)
+    return tokens
+
+
+class BM25Index:
+    """增量 BM25 倒排索引：文档 id 为加入顺序，与记忆列表下标一致"""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.reset()
+
+    def __len__(self) -> int:
+        return len(self._doc_lengths)
+
+    def reset(self) -> None:
+        self._postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        self._doc_lengths: List[int] = []
+        self._total_length = 0
+
+    def add(self, memories: List[Dict]) -> None:
+        """追加文档（只会在末尾追加，已有文档的 id 不变）"""
+        for memory in memories:
+            doc_id = len(self._doc_lengths)
+            tokens = memory_tokens(memory)
+            for token, tf in Counter(tokens).items():
+                self._postings[token].append((doc_id, tf))
+            self._doc_lengths.append(len(tokens))
+            self._total_length += len(tokens)
+
+    def search(self, query: str, k: int) -> List[Tuple[int, float]]:
+        """返回 BM25 得分最高的 k 个 (文档 id, 得分)，无词项重合的文档不返回"""
+        n = len(self._doc_lengths)
+        if not n or k <= 0:
+            return []
+        avg_length = self._total_length / n or 1.0
+        scores: Dict[int, float] = defaultdict(float)
+        for token in set(tokenize(query)):
+            postings = self._postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings:
+                norm = self.k1 * (1 - self.b + self.b * self._doc_lengths[doc_id] / avg_length)
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda x: x[1], reverse=True)[:k]
+
+    def coverage(self, query: str, doc_ids: List[int]) -> Dict[int, float]:
+        """
+        查询词项被文档覆盖的比例（按 idf 加权，0~1；索引中没有的词项按最高 idf 计入分母）：
+        只共享“什么”这类常见二元组的文档覆盖率很低，可用作与 BM25 原始分值无关的词法证据强度
+        """
+        n = len(self._doc_lengths)
+        wanted = set(doc_ids)
+        covered: Dict[int, float] = defaultdict(float)
+        total = 0.0
+        for token in set(tokenize(query)):
+            postings = self._postings.get(token, [])
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            total += idf
+            for doc_id, _ in postings:
+                if doc_id in wanted:
+                    covered[doc_id] += idf
+        return {doc_id: covered[doc_id] / total if total else 0.0 for doc_id in wanted}
+
+
+def reciprocal_rank_fusion(rankings: List[List[int]], k: int = 60) -> Dict[int, float]:
+    """倒数排名融合：score(d) = Σ 1 / (k + rank)，rank 从 1 开始"""
+    fused: Dict[int, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, 1):
+            fused[doc_id] += 1.0 / (k + rank)
+    return dict(fused)
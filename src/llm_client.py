@@ -1,41 +1,262 @@
+import asyncio
+import importlib.util
 import json
-from typing import Optional, Dict, Any, Generator
+import threading
+import time
+import weakref
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, Generator, AsyncIterator, Tuple, List, Callable, Awaitable, TypeVar
 import requests
-from openai import OpenAI  # 需安装：pip install openai
+import httpx
+from openai import OpenAI, AsyncOpenAI  # 需安装：pip install openai
 import config
 import re
 from logger import logger
+from metrics import metrics
+from response_cache import LLM_RESPONSE_CACHE, get_response_cache, response_cache_key
+from resilience import (
+    DeadlineExceeded,
+    LatencyTracker,
+    LLM_CALL_DEADLINE,
+    LLM_HEDGING,
+    acall_with_retries,
+    call_with_retries,
+    get_circuit_breaker,
+    get_latency_tracker,
+    hedged
+)
 
-class LLMClient:
-    """大模型客户端：支持非流式（结构化数据提取）和流式（智能体回复）调用"""
-    def __init__(self):
-        self.provider = config.LLM_PROVIDER
-        self.model = config.LLM_MODEL
-        self.api_key = config.LLM_API_KEY
-        self.base_url = config.LLM_BASE_URL
-        self.temperature = config.LLM_TEMPERATURE
-        self.max_tokens = config.LLM_MAX_TOKENS
-        
-        # 初始化对应提供商的客户端
-        if self.provider == "openai":
-            self.client = OpenAI(
-                api_key=self.api_key,
-                base_url=self.base_url
-            )
-        elif self.provider == "zhipu":
-            self.client = OpenAI(
-                api_key=self.api_key,
-                base_url=self.base_url if self.base_url else "https://open.bigmodel.cn/api/paas/v4"
-            )
-        elif self.provider == "qianfan":
-            self.client = OpenAI(
-                api_key=self.api_key.split(":")[0],  # ak:sk 分割
-                api_secret=self.api_key.split(":")[1],
-                base_url=self.base_url if self.base_url else "https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/completions_pro"
-            )
+# HTTP 连接池：同步/异步客户端各自在进程内共享一个连接池（keep-alive 复用 TCP/TLS 连接）
+LLM_HTTP_MAX_CONNECTIONS = getattr(config, "LLM_HTTP_MAX_CONNECTIONS", 20)
+LLM_HTTP_MAX_KEEPALIVE = getattr(config, "LLM_HTTP_MAX_KEEPALIVE", 10)
+LLM_HTTP_KEEPALIVE_EXPIRY = getattr(config, "LLM_HTTP_KEEPALIVE_EXPIRY", 60)
+# 是否启用 HTTP/2（需安装 h2：pip install httpx[http2]，未安装时自动使用 HTTP/1.1）
+LLM_HTTP2 = getattr(config, "LLM_HTTP2", True)
+
+# 多端点路由：LLM_PROVIDERS 定义具名端点（未填写的字段沿用 LLM_PROVIDER / LLM_MODEL 等默认配置），
+# LLM_ROUTES 按调用类型（kind）给出按优先级排列的端点名，前一个出错或过慢时依次回退
+LLM_PROVIDERS = getattr(config, "LLM_PROVIDERS", {})
+LLM_ROUTES = getattr(config, "LLM_ROUTES", {})
+# 存在后备端点时，单个端点最多占用的时间（秒），超过后切换到下一个端点
+LLM_FALLBACK_AFTER = getattr(config, "LLM_FALLBACK_AFTER", 30)
+
+_HTTP2_ENABLED = LLM_HTTP2 and importlib.util.find_spec("h2") is not None
+
+_DEFAULT_BASE_URLS = {
+    "openai": None,
+    "zhipu": "https://open.bigmodel.cn/api/paas/v4",
+    "qianfan": "https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/completions_pro",
+}
+
+
+def _client_kwargs(provider: str, api_key: str, base_url: Optional[str]) -> Dict[str, Any]:
+    """各提供商的客户端参数（同步/异步客户端共用）"""
+    if provider not in _DEFAULT_BASE_URLS:
+        raise ValueError(f"不支持的LLM提供商：{provider}")
+    # 重试由 resilience 统一处理，关闭 SDK 自带的重试
+    kwargs = {"api_key": api_key, "base_url": base_url or _DEFAULT_BASE_URLS[provider], "max_retries": 0}
+    if provider == "qianfan":
+        kwargs["api_key"] = api_key.split(":")[0]  # ak:sk 分割
+        kwargs["api_secret"] = api_key.split(":")[1]
+    return kwargs
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(max_connections=LLM_HTTP_MAX_CONNECTIONS,
+                        max_keepalive_connections=LLM_HTTP_MAX_KEEPALIVE,
+                        keepalive_expiry=LLM_HTTP_KEEPALIVE_EXPIRY)
+
+
+_clients_lock = threading.Lock()
+_http_client: Optional[httpx.Client] = None
+_sync_clients: Dict[Tuple, OpenAI] = {}
+# 异步连接绑定在创建它的事件循环上，按事件循环分别缓存
+_async_http_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple, AsyncOpenAI]]" = weakref.WeakKeyDictionary()
+
+
+def get_openai_client(provider: str, api_key: str, base_url: Optional[str]) -> OpenAI:
+    """获取进程内共享的同步客户端（同一提供商配置只创建一次，所有客户端共用一个连接池）"""
+    global _http_client
+    key = (provider, api_key, base_url)
+    with _clients_lock:
+        client = _sync_clients.get(key)
+        if client is None:
+            if _http_client is None:
+                _http_client = httpx.Client(limits=_http_limits(), http2=_HTTP2_ENABLED)
+            client = OpenAI(http_client=_http_client, **_client_kwargs(provider, api_key, base_url))
+            _sync_clients[key] = client
+        return client
+
+
+def get_async_openai_client(provider: str, api_key: str, base_url: Optional[str]) -> AsyncOpenAI:
+    """获取当前事件循环内共享的异步客户端（须在事件循环中调用）"""
+    loop = asyncio.get_running_loop()
+    key = (provider, api_key, base_url)
+    with _clients_lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            http_client = _async_http_clients.get(loop)
+            if http_client is None:
+                http_client = httpx.AsyncClient(limits=_http_limits(), http2=_HTTP2_ENABLED)
+                _async_http_clients[loop] = http_client
+            client = AsyncOpenAI(http_client=http_client, **_client_kwargs(provider, api_key, base_url))
+            clients[key] = client
+        return client
+
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """进程内常驻的后台事件循环，同步代码通过 run_async 在其上并发执行协程"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="llm-event-loop", daemon=True).start()
+        return _loop
+
+
+def run_async(coro, timeout: Optional[float] = None):
+    """在后台事件循环上执行协程并阻塞等待结果（不可在该事件循环内部调用）"""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result(timeout)
+
+
+def _parse_json_content(raw_content: Optional[str]) -> Optional[Dict[str, Any]]:
+    """从模型输出中提取并解析JSON（兼容带```json和不带的情况）"""
+    if not raw_content:
+        logger.warning("LLM返回空响应")
+        return {}
+
+    json_pattern = re.compile(r'```(?:json)?\s*(.*?)\s*```', re.DOTALL)
+    match = json_pattern.search(raw_content)
+    if match:
+        # 提取代码块内的JSON字符串
+        json_str = match.group(1).strip()
+    else:
+        # 无代码块标记，直接使用原始响应（假设是纯JSON字符串）
+        json_str = raw_content.strip()
+
+    try:
+        result_dict = json.loads(json_str)
+        logger.debug(f"LLM响应解析成功：{result_dict}")
+        return result_dict
+    except json.JSONDecodeError as e:
+        logger.error(f"JSON解析失败：错误位置{e.pos}，原因{e.msg}，原始JSON：{json_str}")
+        return {}
+    except Exception as e:
+        logger.error(f"LLM响应处理异常：{str(e)}", exc_info=True)
+        return {}
+
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class Endpoint:
+    """一个可调用的模型端点：提供商 + 模型 + 生成参数"""
+    name: str
+    provider: str
+    model: str
+    api_key: str
+    base_url: Optional[str]
+    temperature: float
+    max_tokens: int
+
+
+_endpoints: Optional[Dict[str, Endpoint]] = None
+_endpoints_lock = threading.Lock()
+
+
+def get_endpoints() -> Dict[str, Endpoint]:
+    """所有具名端点（含由默认配置生成的 "default"）"""
+    global _endpoints
+    with _endpoints_lock:
+        if _endpoints is None:
+            default = Endpoint("default", config.LLM_PROVIDER, config.LLM_MODEL, config.LLM_API_KEY,
+                               config.LLM_BASE_URL, config.LLM_TEMPERATURE, config.LLM_MAX_TOKENS)
+            endpoints = {"default": default}
+            for name, spec in LLM_PROVIDERS.items():
+                fields = {k: v for k, v in spec.items() if k in Endpoint.__dataclass_fields__}
+                endpoints[name] = Endpoint(**{**default.__dict__, **fields, "name": name})
+            _endpoints = endpoints
+        return _endpoints
+
+
+def resolve_route(kind: str) -> List[Endpoint]:
+    """调用类型对应的端点列表（按优先级）；未配置的类型使用 "default" 路由"""
+    endpoints = get_endpoints()
+    names = LLM_ROUTES.get(kind) or LLM_ROUTES.get("default") or ["default"]
+    route = []
+    for name in names:
+        if name in endpoints:
+            route.append(endpoints[name])
         else:
-            raise ValueError(f"不支持的LLM提供商：{self.provider}")
-    
+            logger.warning(f"LLM 路由 {kind} 引用了未定义的端点：{name}")
+    return route or [endpoints["default"]]
+
+
+def _fallback_budgets(route: List[Endpoint], deadline: Optional[float]):
+    """依次产出 (端点, 可用时长, 是否最后一个)；总时限用完时停止"""
+    deadline_at = time.monotonic() + (deadline or LLM_CALL_DEADLINE)
+    for i, endpoint in enumerate(route):
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded("LLM 调用超出总时限")
+        last = i == len(route) - 1
+        yield endpoint, remaining if last else min(remaining, LLM_FALLBACK_AFTER), last
+
+
+def _log_fallback(endpoint: Endpoint, error: Exception) -> None:
+    logger.warning(f"LLM 端点 {endpoint.name} 调用失败：{str(error)}，切换到下一个端点")
+    metrics.incr("llm.fallbacks")
+
+
+def with_fallbacks(route: List[Endpoint], deadline: Optional[float], run: Callable[[Endpoint, float], T]) -> T:
+    """按路由顺序调用端点，出错或超出单端点时限时回退到下一个端点"""
+    for endpoint, budget, last in _fallback_budgets(route, deadline):
+        try:
+            return run(endpoint, budget)
+        except Exception as e:
+            if last:
+                raise
+            _log_fallback(endpoint, e)
+
+
+async def awith_fallbacks(route: List[Endpoint], deadline: Optional[float],
+                          run: Callable[[Endpoint, float], Awaitable[T]]) -> T:
+    """with_fallbacks 的异步版本"""
+    for endpoint, budget, last in _fallback_budgets(route, deadline):
+        try:
+            return await run(endpoint, budget)
+        except Exception as e:
+            if last:
+                raise
+            _log_fallback(endpoint, e)
+
+
+class LLMClient:
+    """
+    大模型客户端：支持非流式（结构化数据提取）和流式（智能体回复）调用，均提供同步与异步（a 前缀）版本。
+    kind 为调用类型（如 "noise"、"boundary"、"reply"），按 config.LLM_ROUTES 选择端点；
+    各方法也可通过 kind 参数为单次调用指定类型。
+    """
+    def __init__(self, kind: str = "default"):
+        self.kind = kind
+        primary = resolve_route(kind)[0]
+        self.provider = primary.provider
+        self.model = primary.model
+        self.api_key = primary.api_key
+        self.base_url = primary.base_url
+        self.temperature = primary.temperature
+        self.max_tokens = primary.max_tokens
+
+        # 初始化对应提供商的客户端（进程内共享，复用连接池）
+        self.client = get_openai_client(self.provider, self.api_key, self.base_url)
+
     def _parse_response(self, response: str) -> Optional[Dict[str, Any]]:
         """解析大模型的JSON格式输出"""
         # 正则匹配：忽略换行、空格，匹配 ```json 和 ``` 之间的内容
@@ -45,65 +266,174 @@ class LLMClient:
             return None
         # 去除首尾空白字符（避免JSON前后有多余空格）
         return match.group(1).strip()
-    
-    def call_non_stream(self, prompt: str) -> Optional[Dict[str, Any]]:
+
+    @staticmethod
+    def _request_kwargs(endpoint: Endpoint, prompt: str, stream: bool) -> Dict[str, Any]:
+        return {
+            "model": endpoint.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": endpoint.temperature,
+            "max_tokens": endpoint.max_tokens,
+            "stream": stream,
+        }
+
+    @staticmethod
+    def _cache_get(endpoint: Endpoint, prompt: str, use_cache: bool) -> Tuple[Optional[str], Any]:
+        """返回 (缓存键, 缓存结果)；未开启缓存时键为 None（以路由的首选端点为键）"""
+        if not (LLM_RESPONSE_CACHE and use_cache):
+            return None, None
+        key = response_cache_key(endpoint.provider, endpoint.model, endpoint.temperature, endpoint.max_tokens, prompt)
+        return key, get_response_cache().get(key)
+
+    @staticmethod
+    def _cache_put(key: Optional[str], result: Any, answered: Endpoint, primary: Endpoint) -> None:
+        # 只缓存首选端点解析成功的结果：缓存键取自首选端点，回退端点的回答不能记在它名下；
+        # 空响应/解析失败下次仍会重新请求
+        if key is not None and answered is primary and result is not None and result != {}:
+            get_response_cache().put(key, result)
+
+    @staticmethod
+    def _latency(endpoint: Endpoint) -> LatencyTracker:
+        return get_latency_tracker(endpoint.name)
+
+    def _record_latency(self, endpoint: Endpoint, seconds: float) -> None:
+        self._latency(endpoint).record(seconds)
+        metrics.observe("llm.latency_seconds", seconds)
+        metrics.observe(f"llm.latency_seconds.{endpoint.name}", seconds)
+
+    @staticmethod
+    def _record_usage(kind: str, response: Any) -> None:
+        """按调用类型记录服务端返回的实际 token 用量"""
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        metrics.observe(f"llm.prompt_tokens.{kind}", usage.prompt_tokens or 0)
+        metrics.observe(f"llm.completion_tokens.{kind}", usage.completion_tokens or 0)
+
+    def call_non_stream(self, prompt: str, use_cache: bool = True, deadline: Optional[float] = None,
+                        hedge: bool = False, kind: Optional[str] = None) -> Optional[Dict[str, Any]]:
         """
         非流式调用：用于结构化数据提取（Element提取、Topic更新判断）
         :param prompt: 提示词
+        :param use_cache: 是否使用响应缓存（需开启 config.LLM_RESPONSE_CACHE）
+        :param deadline: 含重试与回退的总时限（秒），默认 config.LLM_CALL_DEADLINE
+        :param hedge: 是否对冲请求（延迟敏感的调用使用，需开启 config.LLM_HEDGING）
+        :param kind: 本次调用的类型（决定路由），默认使用客户端的 kind
         :return: 解析后的JSON字典
         """
+        if hedge and LLM_HEDGING:
+            return run_async(self.acall_non_stream(prompt, use_cache=use_cache, deadline=deadline,
+                                                   hedge=True, kind=kind))
+        kind = kind or self.kind
+        route = resolve_route(kind)
+        key, cached = self._cache_get(route[0], prompt, use_cache)
+        if cached is not None:
+            return cached
+
+        def run(endpoint: Endpoint, budget: float) -> Tuple[Endpoint, Optional[str]]:
+            client = get_openai_client(endpoint.provider, endpoint.api_key, endpoint.base_url)
+
+            def attempt(timeout: float) -> Optional[str]:
+                start = time.perf_counter()
+                response = client.chat.completions.create(**self._request_kwargs(endpoint, prompt, stream=False),
+                                                          timeout=timeout)
+                self._record_latency(endpoint, time.perf_counter() - start)
+                self._record_usage(kind, response)
+                return response.choices[0].message.content
 
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=self.temperature,
-            max_tokens=self.max_tokens,
-            stream=False
-        )
-        raw_content = response.choices[0].message.content
-        if not raw_content:
-            logger.warning("LLM返回空响应")
-            return {}
-
-        # 2. 提取代码块中的JSON内容（兼容带```json和不带的情况）
-        json_pattern = re.compile(r'```(?:json)?\s*(.*?)\s*```', re.DOTALL)
-        match = json_pattern.search(raw_content)
-        if match:
-            # 提取代码块内的JSON字符串
-            json_str = match.group(1).strip()
+            return endpoint, call_with_retries(attempt, get_circuit_breaker(endpoint.name), budget)
+
+        answered, content = with_fallbacks(route, deadline, run)
+        result = _parse_json_content(content)
+        self._cache_put(key, result, answered, route[0])
+        return result
+
+    async def acall_non_stream(self, prompt: str, use_cache: bool = True, deadline: Optional[float] = None,
+                               hedge: bool = False, kind: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """call_non_stream 的异步版本（共享配置、路由、响应缓存与容错策略）"""
+        kind = kind or self.kind
+        route = resolve_route(kind)
+        key, cached = self._cache_get(route[0], prompt, use_cache)
+        if cached is not None:
+            return cached
+
+        async def run(endpoint: Endpoint, budget: float) -> Tuple[Endpoint, Optional[str]]:
+            client = get_async_openai_client(endpoint.provider, endpoint.api_key, endpoint.base_url)
+
+            async def attempt(timeout: float) -> Optional[str]:
+                start = time.perf_counter()
+                response = await client.chat.completions.create(
+                    **self._request_kwargs(endpoint, prompt, stream=False), timeout=timeout)
+                self._record_latency(endpoint, time.perf_counter() - start)
+                self._record_usage(kind, response)
+                return response.choices[0].message.content
+
+            return endpoint, await acall_with_retries(attempt, get_circuit_breaker(endpoint.name), budget)
+
+        def call():
+            return awith_fallbacks(route, deadline, run)
+
+        if hedge and LLM_HEDGING:
+            answered, content = await hedged(call, self._latency(route[0]).hedge_delay())
         else:
-            # 无代码块标记，直接使用原始响应（假设是纯JSON字符串）
-            json_str = raw_content.strip()
+            answered, content = await call()
+        result = _parse_json_content(content)
+        self._cache_put(key, result, answered, route[0])
+        return result
 
-        # 3. 解析JSON为字典
-        try:
-            result_dict = json.loads(json_str)
-            logger.debug(f"LLM响应解析成功：{result_dict}")
-            return result_dict
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON解析失败：错误位置{e.pos}，原因{e.msg}，原始JSON：{json_str}")
-            return {}
-        except Exception as e:
-            logger.error(f"LLM响应处理异常：{str(e)}", exc_info=True)
-            return {}
-    
-    def call_stream(self, prompt: str) -> Generator[str, None, None]:
+    def call_stream(self, prompt: str, kind: Optional[str] = None) -> Generator[str, None, None]:
         """
         流式调用：用于智能体回复（逐字/逐句输出）
+        建立连接阶段按容错策略重试并按路由回退；输出中途失败时保留已输出内容并结束
         :param prompt: 提示词
+        :param kind: 本次调用的类型（决定路由），默认使用客户端的 kind
         :return: 字符流生成器
         """
+        def run(endpoint: Endpoint, budget: float):
+            client = get_openai_client(endpoint.provider, endpoint.api_key, endpoint.base_url)
+            return call_with_retries(
+                lambda timeout: client.chat.completions.create(**self._request_kwargs(endpoint, prompt, stream=True),
+                                                               timeout=timeout),
+                get_circuit_breaker(endpoint.name), budget)
+
+        yielded = False
         try:
-            stream = self.client.chat.completions.create(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=self.temperature,
-                max_tokens=self.max_tokens,
-                stream=True
-            )
+            stream = with_fallbacks(resolve_route(kind or self.kind), None, run)
             for chunk in stream:
-                if chunk.choices[0].delta.content:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yielded = True
+                    yield chunk.choices[0].delta.content
+        except Exception as e:
+            logger.error(f"大模型流式调用失败：{str(e)}", exc_info=True)
+            metrics.incr("llm.stream_failures")
+            if not yielded:
+                yield "抱歉，当前无法生成回复，请稍后再试~"
+
+    async def acall_stream(self, prompt: str, kind: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        异步流式调用：返回异步字符流（可直接传给 ChatSpeaker.chat_and_speak）
+        :param prompt: 提示词
+        :param kind: 本次调用的类型（决定路由），默认使用客户端的 kind
+        :return: 异步字符流
+        """
+        async def run(endpoint: Endpoint, budget: float):
+            client = get_async_openai_client(endpoint.provider, endpoint.api_key, endpoint.base_url)
+
+            async def attempt(timeout: float):
+                return await client.chat.completions.create(
+                    **self._request_kwargs(endpoint, prompt, stream=True), timeout=timeout)
+
+            return await acall_with_retries(attempt, get_circuit_breaker(endpoint.name), budget)
+
+        yielded = False
+        try:
+            stream = await awith_fallbacks(resolve_route(kind or self.kind), None, run)
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yielded = True
                     yield chunk.choices[0].delta.content
         except Exception as e:
-            print(f"大模型流式调用失败：{str(e)}")
-            yield "抱歉，当前无法生成回复，请稍后再试~"
\ No newline at end of file
+            logger.error(f"大模型异步流式调用失败：{str(e)}", exc_info=True)
+            metrics.incr("llm.stream_failures")
+            if not yielded:
+                yield "抱歉，当前无法生成回复，请稍后再试~"
@@ -1,14 +1,21 @@
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Optional
 from memory_builder import MemoryBuilder
-from memory_store import MemoryStore
-from llm_client import LLMClient
+from memory_store import create_memory_store
+from llm_client import LLMClient, run_async
 import prompt
 import config
 from logger import logger
-import concurrent.futures
 from domain import DomainManager
 from trust import TrustManager
+from metrics import metrics
+from embedding_cache import get_embedding_cache
+from response_cache import LLM_RESPONSE_CACHE, get_response_cache
+from consolidation import ConsolidationWorker
+from domain_scheduler import DomainUpdateScheduler
+
+SESSION_ID = "default"
 
 def stream_print(response_generator) -> str:
     """流式输出并返回完整回复文本"""
@@ -23,35 +30,97 @@ def stream_print(response_generator) -> str:
 
 def get_current_buffer_status(memory_builder: MemoryBuilder) -> str:
     """获取当前对话buffer状态"""
-    if not memory_builder.对话_buffer:
+    if not memory_builder.buffer:
         return "当前无对话内容"
     
-    return f"当前话题：{memory_builder.current_topic}\n对话轮次：{len(memory_builder.对话_buffer)}"
+    status = f"当前话题：{memory_builder.current_topic}\n对话轮次：{len(memory_builder.buffer)}"
+    if memory_builder.folded_rounds:
+        status += f"\n已折叠进摘要：{memory_builder.folded_rounds} 轮"
+    return status
+
+def score_and_update_trust(llm_client: LLMClient, trust_manager: TrustManager, user_input: str, current_stage: str) -> None:
+    """根据本轮输入计算并更新信任值（回复后在独立线程中执行，下一轮读取信任值前等待其完成）"""
+    score_prompt = prompt.get_trust_scoring_prompt(user_input, current_stage)
+    try:
+        # 获取 LLM 的原始输出
+        raw_score = llm_client.call_non_stream(score_prompt, kind="trust")
+        
+        # 安全转换逻辑：先强转为字符串，再过滤数字
+        score_text = str(raw_score).strip()
+        
+        # 提取数字部分（处理可能带有的 "+" 或 "-"）
+        filtered_score = ''.join(filter(lambda x: x in '-0123456789', score_text))
+        
+        if filtered_score:
+            behavior_score = int(filtered_score)
+        else:
+            behavior_score = 0
+            logger.warning(f"LLM 返回了无法解析的评分内容: {raw_score}")
+
+        # 更新本地文件和内存中的 trust
+        trust_manager.update_trust(user_input, behavior_score)
+        logger.info(f"对话结束，信任值变动: {behavior_score}, 新信任值: {trust_manager.current_trust}")
+    except Exception as e:
+        logger.error(f"延迟更新信任值失败: {e}")
+
+def wait_for_trust(trust_future: Optional[Future]) -> None:
+    """等待上一轮的信任评分完成，保证本轮激活与态度阶段使用最新的信任值"""
+    if trust_future is not None and not trust_future.done():
+        logger.info("等待上一轮信任评分完成...")
+        trust_future.result()
+
+def shutdown_consolidation(consolidation_worker: ConsolidationWorker) -> None:
+    """退出前处理完后台积压的整理任务并保存剩余记忆"""
+    if consolidation_worker.pending_count():
+        print("正在整理记忆...", flush=True)
+    try:
+        consolidation_worker.close()
+    except KeyboardInterrupt:
+        logger.warning("退出时记忆整理被中断")
+
+def shutdown_domain_scheduler(domain_scheduler: DomainUpdateScheduler) -> None:
+    """退出前停止后台域更新（进行中的更新在副本上执行，放弃不会影响已保存的域），并写入合并等待中的域修改"""
+    domain_scheduler.stop(timeout=5)
+    domain_scheduler.domain_manager.flush()
 
 def main():
     # 初始化核心组件
     domain_manager = DomainManager()
-    memory_store = MemoryStore(is_worthy_func=domain_manager.is_memory_worthy)
-    memory_builder = MemoryBuilder()
+    memory_store = create_memory_store(is_worthy_func=domain_manager.is_memory_worthy)
+    # 记忆构建与保存在后台整理线程中执行，不阻塞下一轮输入
+    consolidation_worker = ConsolidationWorker(memory_store)
+    memory_builder = consolidation_worker.builder(SESSION_ID)
+    # 域更新在后台线程中按定时/空闲条件（或手动）触发，不阻塞对话
+    domain_scheduler = DomainUpdateScheduler(domain_manager, memory_store)
+    domain_scheduler.start()
     trust_manager = TrustManager()  # 初始化信任管理器
     
-    llm_client = LLMClient()
+    llm_client = LLMClient(kind="reply")
+    # 信任评分与用户输入下一句并行，但不进入记忆整理队列（避免排在积压的整理任务之后）
+    trust_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trust-scoring")
+    trust_future: Optional[Future] = None
     
     print("========= 齐天大圣孙悟空上线=========")
     print("提示：输入 'exit' 退出，'show trust' 查看当前好感度")
-    print("      输入 'show memories' 查看记忆，'clear memories' 清空记忆\n")
+    print("      输入 'show memories' 查看记忆，'clear memories' 清空记忆")
+    print("      输入 'show metrics' 查看运行指标")
+    print("      输入 'update domains' 后台更新域，'show domains' 查看域更新状态")
+    print("      输入 'show domain versions' 查看域历史版本，'rollback domain user|self 版本哈希' 回滚域\n")
     logger.info("程序启动，进入西游世界交互模式")
+    # 等待用户输入期间在后台加载向量模型，不阻塞启动
+    memory_store.embedding_model.preload_in_background()
     
     try:
         while True:
             # 1. 获取用户输入
             user_input = input("你：").strip()
+            domain_scheduler.touch()
             
             # 2. 基础功能逻辑
             if user_input.lower() == "exit":
-                final_memory = memory_builder.finalize_memory()
-                if final_memory:
-                    memory_store.save_memory(final_memory)
+                wait_for_trust(trust_future)
+                shutdown_consolidation(consolidation_worker)
+                shutdown_domain_scheduler(domain_scheduler)
                 print("孙悟空：既然你要走，俺老孙也不留你。回见！")
                 break
             
@@ -59,7 +128,40 @@ def main():
                 print(f"\n=== 当前对话状态 ===\n{get_current_buffer_status(memory_builder)}\n" + "-"*50 + "\n")
                 continue
 
+            if user_input.lower() == "show metrics":
+                cache_stats = f"向量缓存：{get_embedding_cache().stats()}"
+                if LLM_RESPONSE_CACHE:
+                    cache_stats += f"\nLLM 响应缓存：{get_response_cache().stats()}"
+                cache_stats += f"\n域激活缓存：{domain_manager.activation_cache.stats()}"
+                print(f"\n=== 运行指标 ===\n{metrics.to_json()}\n{cache_stats}\n" + "-"*50 + "\n")
+                continue
+
+            if user_input.lower() == "update domains":
+                domain_scheduler.trigger()
+                print("\n已在后台开始更新域，输入 'show domains' 查看进度\n" + "-"*50 + "\n")
+                continue
+
+            if user_input.lower() == "show domains":
+                status = "\n".join(f"{k}：{v}" for k, v in domain_scheduler.status().items())
+                print(f"\n=== 域更新状态 ===\n{status}\n" + "-"*50 + "\n")
+                continue
+
+            if user_input.lower() == "show domain versions":
+                versions = "\n".join(f"{name}：{', '.join(v['hash'] for v in items) or '无'}"
+                                     for name, items in domain_manager.domain_versions().items())
+                print(f"\n=== 域历史版本（从旧到新） ===\n{versions}\n" + "-"*50 + "\n")
+                continue
+
+            if user_input.lower().startswith("rollback domain"):
+                args = user_input.split()[2:]
+                if len(args) == 2 and domain_manager.rollback_domain(args[0], args[1]):
+                    print(f"\n{args[0]} 域已回滚到版本 {args[1]}\n" + "-"*50 + "\n")
+                else:
+                    print("\n回滚失败，用法：rollback domain user|self 版本哈希\n" + "-"*50 + "\n")
+                continue
+
             if user_input.lower() == "show trust":
+                wait_for_trust(trust_future)
                 current_trust = trust_manager.current_trust
                 stage = trust_manager.get_relationship_stage()
                 print(f"\n[大圣心声] 当前信任值：{current_trust} | 关系阶段：{stage}\n" + "-"*50 + "\n")
@@ -71,31 +173,26 @@ def main():
 
             # ============= 核心逻辑开始 =============
 
-            # 4. 信任值判定 (Trust Scoring)
+            # 话题边界与噪声检测只依赖用户输入和已有buffer，与回复生成并行推测
+            consolidation_worker.submit_speculation(SESSION_ID, user_input)
+
+            # 4. 信任值判定 (Trust Scoring)：上一轮的评分通常已在用户输入期间完成
+            wait_for_trust(trust_future)
             current_trust = trust_manager.current_trust
             current_stage = trust_manager.get_relationship_stage()
 
-            # 组合当前对话历史，即短期记忆
-            formatted_chat_history = "\n\n".join(memory_builder.buffer)
+            # 组合当前对话历史，即短期记忆（含后台尚未整理完的轮次）
+            formatted_chat_history = consolidation_worker.get_chat_history(SESSION_ID)
             
             # 5. 基于当前信任值激活双域
             latest_memory = memory_store.retrieve_related_memories(user_input) or {}
 
-            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-                future_user = executor.submit(
-                    domain_manager.activate_user_domain,
-                    user_input=user_input,
-                    conversation_history=latest_memory
-                )
-                future_self = executor.submit(
-                    domain_manager.activate_self_domain,
-                    user_input=user_input,
-                    conversation_history=latest_memory,
-                    trust=current_trust  # 使用当前值激活
-                )
-
-                activated_user_domain = future_user.result()
-                activated_self_domain = future_self.result()
+            # 两个域的激活在常驻事件循环上并发执行，共享连接池
+            activated_user_domain, activated_self_domain = run_async(domain_manager.aactivate_domains(
+                user_input=user_input,
+                conversation_history=latest_memory,
+                trust=current_trust  # 使用当前值激活
+            ))
 
             # 6. 基于当前状态生成回复
             response_prompt = prompt.get_agent_response_prompt(
@@ -111,57 +208,25 @@ def main():
             response_generator = llm_client.call_stream(prompt=response_prompt)
             agent_response = stream_print(response_generator)
 
-            # 7. 【回复后更新】根据本轮输入计算并更新信任值
-            # 这一步放在回复之后，为下一轮对话做准备
-            score_prompt = prompt.get_trust_scoring_prompt(user_input, current_stage)
-            try:
-                # 获取 LLM 的原始输出
-                raw_score = llm_client.call_non_stream(score_prompt)
-                
-                # 安全转换逻辑：先强转为字符串，再过滤数字
-                score_text = str(raw_score).strip()
-                
-                # 提取数字部分（处理可能带有的 "+" 或 "-"）
-                filtered_score = ''.join(filter(lambda x: x in '-0123456789', score_text))
-                
-                if filtered_score:
-                    behavior_score = int(filtered_score)
-                else:
-                    behavior_score = 0
-                    logger.warning(f"LLM 返回了无法解析的评分内容: {raw_score}")
-
-                # 更新本地文件和内存中的 trust
-                trust_manager.update_trust(user_input, behavior_score)
-                logger.info(f"对话结束，信任值变动: {behavior_score}, 新信任值: {trust_manager.current_trust}")
-            except Exception as e:
-                logger.error(f"延迟更新信任值失败: {e}")
-
-            # 8. 处理对话并更新记忆
-            print("正在处理对话...", end="\r", flush=True)
-            try:
-                # 处理对话，返回需要保存的记忆（如果话题更换）
-                new_memory = memory_builder.process_dialog(
-                    user_input=user_input,
-                    agent_response=agent_response
-                )
-                
-                # 如果有新记忆，保存
-                if new_memory:
-                    memory_store.save_memory(new_memory)
-                
-                print(" " * 20, end="\r", flush=True)
-            except Exception as e:
-                logger.error(f"对话处理失败：{str(e)}", exc_info=True)
-                print("处理对话失败，但不影响后续对话~\n" + "-"*50 + "\n")
-                continue
+            # 7. 【回复后更新】信任值评分在独立线程中进行，为下一轮对话做准备（下一轮激活前等待完成）
+            trust_future = trust_executor.submit(
+                score_and_update_trust, llm_client, trust_manager, user_input, current_stage
+            )
+
+            # 8. 话题边界检测、记忆生成与保存在后台异步完成，立即进入下一轮
+            consolidation_worker.submit_round(SESSION_ID, user_input=user_input, agent_response=agent_response)
     
     except KeyboardInterrupt:
-        final_memory = memory_builder.finalize_memory()
-        if final_memory:
-            memory_store.save_memory(final_memory)
-        print("\n\n孙悟空：已保存记忆，俺回花果山了！")
+        print()
+        trust_executor.shutdown(wait=True)
+        shutdown_consolidation(consolidation_worker)
+        shutdown_domain_scheduler(domain_scheduler)
+        print("\n孙悟空：已保存记忆，俺回花果山了！")
     except Exception as e:
         logger.error(f"程序异常退出：{str(e)}", exc_info=True)
+        trust_executor.shutdown(wait=True)
+        shutdown_consolidation(consolidation_worker)
+        shutdown_domain_scheduler(domain_scheduler)
         print("\n孙悟空：出了点岔子，俺老孙去也！")
 
 if __name__ == "__main__":
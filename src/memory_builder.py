@@ -1,4 +1,6 @@
-from typing import Optional, List
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, Optional, List, Tuple
 from memory_structures import Memory
 from noise_detector import NoiseDetector
 from llm_client import LLMClient
@@ -8,49 +10,198 @@ from prompt import (
     get_noise_detection_prompt,
     get_topic_summary_prompt,
     get_content_summary_prompt,
-    get_keywords_extract_prompt
+    get_keywords_extract_prompt,
+    get_memory_synthesis_prompt,
+    get_rolling_summary_prompt
 )
+import config
 from logger import logger
+from metrics import metrics
+from boundary_classifier import (
+    BoundaryClassifier,
+    BOUNDARY_FAST_PATH,
+    BOUNDARY_FAST_PATH_SHADOW,
+    record_labelled_sample
+)
 import json
 
+# 记忆合成方式："combined" 一次调用同时生成主题/内容/关键词；"separate" 分三次调用
+MEMORY_SYNTHESIS_MODE = getattr(config, "MEMORY_SYNTHESIS_MODE", "combined")
+# 互不依赖的 LLM 调用（记忆字段生成、新话题初始化）的并发上限，1 表示顺序执行
+MEMORY_BUILDER_CONCURRENCY = getattr(config, "MEMORY_BUILDER_CONCURRENCY", 4)
+# 并发调用的超时（秒），超时的调用使用各自的 fallback 结果
+MEMORY_BUILDER_CALL_TIMEOUT = getattr(config, "MEMORY_BUILDER_CALL_TIMEOUT", 60)
+# 滚动窗口：buffer 只保留最近 K 轮原文，更早的轮次增量折叠进摘要（0 表示不限制）
+MEMORY_BUFFER_WINDOW = getattr(config, "MEMORY_BUFFER_WINDOW", 6)
+# 超出窗口的轮次累计到该数量时才一次性折叠（默认与窗口相同），长话题每 N 轮只多一次摘要调用
+MEMORY_FOLD_BATCH = getattr(config, "MEMORY_FOLD_BATCH", MEMORY_BUFFER_WINDOW)
+# 推测式话题边界检测：用户消息到达时即与回复生成并行检测
+SPECULATIVE_BOUNDARY = getattr(config, "SPECULATIVE_BOUNDARY", True)
+# 推测结果置信度低于该值时，结合回复重新检测
+SPECULATIVE_BOUNDARY_MIN_CONFIDENCE = getattr(config, "SPECULATIVE_BOUNDARY_MIN_CONFIDENCE", 0.7)
+
 class MemoryBuilder:
     """记忆构建器：管理对话buffer和记忆生成"""
     
     def __init__(self):
         self.noise_detector = NoiseDetector()
-        self.llm_client = LLMClient()
+        self.llm_client = LLMClient(kind="memory")
         self.buffer: List[str] = []  # 存储当前话题的对话
         self.current_topic: Optional[str] = None  # 当前话题
+        self.summary: str = ""  # 滚动窗口模式下，当前话题中已折叠的早期轮次摘要
+        self.folded_rounds: int = 0  # 已折叠进摘要的轮次数
+        self._executor: Optional[ThreadPoolExecutor] = None  # 并发调用线程池（按需创建）
+        self._speculation: Optional[Dict[str, Any]] = None  # 推测式话题边界检测的进行中任务
+        # 话题边界向量预判（与 MemoryStore 共用进程内的向量模型）
+        self.boundary_classifier: Optional[BoundaryClassifier] = BoundaryClassifier() if BOUNDARY_FAST_PATH else None
     
     def _format_round_dialog(self, user_input: str, agent_response: str) -> str:
         """格式化一轮对话"""
         return f"user: {user_input.strip()}\nagent: {agent_response.strip()}"
     
+    @property
+    def dialogs(self) -> List[str]:
+        """当前话题的对话上下文：已折叠轮次的摘要（如有）+ 最近的原文轮次"""
+        if not self.summary:
+            return list(self.buffer)
+        return [f"此前对话摘要（共 {self.folded_rounds} 轮）：{self.summary}"] + self.buffer
+    
+    def _fold_overflow(self) -> None:
+        """超出窗口的旧轮次累计满 MEMORY_FOLD_BATCH 轮时，一次性折叠进滚动摘要；摘要失败时保留原文，下一轮再试"""
+        if MEMORY_BUFFER_WINDOW <= 0 or len(self.buffer) - MEMORY_BUFFER_WINDOW < max(1, MEMORY_FOLD_BATCH):
+            return
+        overflow = self.buffer[:-MEMORY_BUFFER_WINDOW]
+        try:
+            prompt = get_rolling_summary_prompt(summary=self.summary, dialogs=overflow)
+            result = self.llm_client.call_non_stream(prompt=prompt)
+        except Exception as e:
+            logger.error(f"滚动摘要更新失败：{str(e)}", exc_info=True)
+            return
+        if not isinstance(result, dict) or not isinstance(result.get("summary"), str) or not result["summary"].strip():
+            logger.warning("滚动摘要结果解析失败，暂不折叠")
+            return
+        self.summary = result["summary"].strip()
+        self.folded_rounds += len(overflow)
+        self.buffer = self.buffer[len(overflow):]
+        logger.info(f"已将 {len(overflow)} 轮对话折叠进摘要，共折叠 {self.folded_rounds} 轮")
+    
     def _detect_topic_boundary(self, new_round_dialog: str) -> bool:
         """检测话题是否更换"""
+        return self._boundary_verdict(self.dialogs, new_round_dialog)[0]
+    
+    def _boundary_verdict(self, buffer: List[str], new_messages: str) -> Tuple[bool, float]:
+        """基于给定的对话历史检测话题边界，返回 (是否更换, 置信度)；向量预判能确定时不再调用 LLM"""
+        fast_verdict, fast_confidence = self._fast_boundary_verdict(buffer, new_messages)
+        if fast_verdict is not None and not BOUNDARY_FAST_PATH_SHADOW:
+            metrics.incr("boundary.llm_skipped")
+            return fast_verdict, fast_confidence
+        
+        metrics.incr("boundary.llm_calls")
+        topic_changed, confidence = self._llm_boundary_verdict(buffer, new_messages)
+        if fast_verdict is not None:
+            # 影子模式：统计向量预判与 LLM 的分歧，结果仍以 LLM 为准
+            metrics.incr("boundary.shadow_compared")
+            if fast_verdict != topic_changed:
+                metrics.incr("boundary.fast_path_disagree")
+                logger.info(f"向量预判与 LLM 不一致：预判 {fast_verdict}，LLM {topic_changed}")
+        return topic_changed, confidence
+    
+    def _fast_boundary_verdict(self, buffer: List[str], new_messages: str) -> Tuple[Optional[bool], float]:
+        """向量质心预判，返回 (判断结果, 按相似度越过阈值幅度计算的置信度)；无法确定或不可用时结果为 None"""
+        if self.boundary_classifier is None:
+            return None, 0.0
         try:
-            conversation_history = "\n\n".join(self.buffer) if self.buffer else ""
+            verdict, similarity = self.boundary_classifier.classify(buffer, new_messages)
+        except Exception as e:
+            # 向量模型不可用时关闭预判，之后直接走 LLM
+            logger.warning(f"话题边界向量预判不可用，已关闭：{str(e)}")
+            self.boundary_classifier = None
+            return None, 0.0
+        metrics.observe("boundary.fast_path_similarity", similarity)
+        logger.debug(f"话题边界向量预判：相似度 {similarity:.3f}，结果 {verdict}")
+        return verdict, self.boundary_classifier.confidence(similarity)
+    
+    def _llm_boundary_verdict(self, buffer: List[str], new_messages: str) -> Tuple[bool, float]:
+        """LLM 话题边界检测；失败时默认未更换、置信度为 0"""
+        try:
+            conversation_history = "\n\n".join(buffer) if buffer else ""
             prompt = boundary_detection_prompt(
                 conversation_history=conversation_history,
-                new_messages=new_round_dialog
+                new_messages=new_messages
             )
-            result = self.llm_client.call_non_stream(prompt=prompt)
+            result = self.llm_client.call_non_stream(prompt=prompt, kind="boundary")
             
             if not isinstance(result, dict):
                 logger.warning("话题边界检测结果解析失败，默认未更换")
-                return False
+                return False, 0.0
             
             logger.info(f"话题边界检测结果：{result}")
-            return result.get("topic_changed", False)
+            try:
+                confidence = float(result.get("confidence", 0.0))
+            except (TypeError, ValueError):
+                confidence = 0.0
+            topic_changed = bool(result.get("topic_changed", False))
+            record_labelled_sample(buffer, new_messages, topic_changed)
+            return topic_changed, confidence
         except Exception as e:
             logger.error(f"话题边界检测失败：{str(e)}", exc_info=True)
-            return False
+            return False, 0.0
+    
+    def _speculate(self, buffer: List[str], new_messages: str, topic: Optional[str]) -> Tuple[bool, float, Optional[bool]]:
+        """推测任务：先检测话题边界，话题更换时再检测噪声"""
+        topic_changed, confidence = self._boundary_verdict(buffer, new_messages)
+        is_noise = None
+        if topic_changed:
+            is_noise = self.noise_detector.is_noise(dialog=new_messages, topic_context=f"当前旧主题：{topic}")
+        return topic_changed, confidence, is_noise
     
-    def _initialize_topic(self, first_dialog: str) -> str:
+    def speculate_boundary(self, user_input: str) -> Optional[Future]:
+        """
+        推测式话题边界检测：用户消息一到达就在后台基于当前buffer的快照检测话题边界与噪声，
+        与回复生成并行；process_dialog 时buffer未变化且置信度足够则直接采用结果
+        """
+        self._speculation = None
+        if not SPECULATIVE_BOUNDARY or not self.buffer:
+            return None
+        dialogs = self.dialogs
+        future = self._get_executor().submit(
+            self._speculate, dialogs, f"user: {user_input.strip()}", self.current_topic)
+        self._speculation = {
+            "user_input": user_input,
+            "dialogs": dialogs,
+            "topic": self.current_topic,
+            "future": future,
+        }
+        return future
+    
+    def _take_speculation(self, user_input: str) -> Optional[Tuple[bool, Optional[bool]]]:
+        """取出与当前状态匹配的推测结果 (是否更换, 是否噪声)；无可用结果时返回 None"""
+        speculation, self._speculation = self._speculation, None
+        if speculation is None:
+            return None
+        if (speculation["user_input"] != user_input or speculation["dialogs"] != self.dialogs
+                or speculation["topic"] != self.current_topic):
+            metrics.incr("boundary.speculation_stale")
+            return None
+        try:
+            topic_changed, confidence, is_noise = speculation["future"].result(timeout=MEMORY_BUILDER_CALL_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"推测式话题边界检测不可用：{str(e)}")
+            metrics.incr("boundary.speculation_failed")
+            return None
+        if confidence < SPECULATIVE_BOUNDARY_MIN_CONFIDENCE:
+            # 仅凭用户消息判断不够确定，结合回复重新检测
+            logger.info(f"推测结果置信度 {confidence} 过低，结合回复重新检测")
+            metrics.incr("boundary.speculation_recheck")
+            return None
+        metrics.incr("boundary.speculation_hit")
+        return topic_changed, is_noise
+    
+    def _initialize_topic(self, first_dialog: str, deadline: Optional[float] = None) -> str:
         """初始化话题"""
         try:
             prompt = get_topic_initialize_prompt(first_dialog=first_dialog)
-            result = self.llm_client.call_non_stream(prompt=prompt)
+            result = self.llm_client.call_non_stream(prompt=prompt, deadline=deadline)
             
             if isinstance(result, dict) and "topic" in result:
                 return result["topic"].strip()
@@ -62,11 +213,11 @@ class MemoryBuilder:
             logger.error(f"主题初始化失败：{str(e)}", exc_info=True)
             return first_dialog[:30].strip()
     
-    def _summarize_topic(self) -> str:
+    def _summarize_topic(self, deadline: Optional[float] = None) -> str:
         """总结当前buffer中的对话主题"""
         try:
-            prompt = get_topic_summary_prompt(dialogs=self.buffer)
-            result = self.llm_client.call_non_stream(prompt=prompt)
+            prompt = get_topic_summary_prompt(dialogs=self.dialogs)
+            result = self.llm_client.call_non_stream(prompt=prompt, deadline=deadline)
             
             if isinstance(result, dict) and "topic" in result:
                 return result["topic"].strip()
@@ -78,11 +229,11 @@ class MemoryBuilder:
             logger.error(f"主题总结失败：{str(e)}", exc_info=True)
             return self.current_topic or "未命名主题"
     
-    def _summarize_content(self) -> str:
+    def _summarize_content(self, deadline: Optional[float] = None) -> str:
         """总结当前buffer中的对话内容"""
         try:
-            prompt = get_content_summary_prompt(dialogs=self.buffer)
-            result = self.llm_client.call_non_stream(prompt=prompt)
+            prompt = get_content_summary_prompt(dialogs=self.dialogs)
+            result = self.llm_client.call_non_stream(prompt=prompt, deadline=deadline)
             
             if isinstance(result, dict) and "content" in result:
                 return result["content"].strip()
@@ -94,11 +245,11 @@ class MemoryBuilder:
             logger.error(f"内容总结失败：{str(e)}", exc_info=True)
             return "\n".join(self.buffer[-3:])
     
-    def _extract_keywords(self) -> List[str]:
+    def _extract_keywords(self, deadline: Optional[float] = None) -> List[str]:
         """提取当前buffer中的对话关键词"""
         try:
-            prompt = get_keywords_extract_prompt(dialogs=self.buffer)
-            result = self.llm_client.call_non_stream(prompt=prompt)
+            prompt = get_keywords_extract_prompt(dialogs=self.dialogs)
+            result = self.llm_client.call_non_stream(prompt=prompt, deadline=deadline)
             
             if isinstance(result, dict) and "keywords" in result and isinstance(result["keywords"], list):
                 return [str(k).strip() for k in result["keywords"] if k.strip()]
@@ -109,9 +260,126 @@ class MemoryBuilder:
             logger.error(f"关键词提取失败：{str(e)}", exc_info=True)
             return []
     
-    def process_dialog(self, user_input: str, agent_response: str) -> Optional[Memory]:
-        """处理一轮对话，返回需要保存的记忆（如果有的话）"""
-        current_round = self._format_round_dialog(user_input, agent_response)
+    def _synthesize_combined(self, deadline: Optional[float] = None) -> dict:
+        """一次调用同时生成主题、内容与关键词，只返回格式合法的字段"""
+        try:
+            prompt = get_memory_synthesis_prompt(dialogs=self.dialogs)
+            result = self.llm_client.call_non_stream(prompt=prompt, deadline=deadline)
+        except Exception as e:
+            logger.error(f"记忆合成失败：{str(e)}", exc_info=True)
+            return {}
+        
+        if not isinstance(result, dict):
+            logger.warning("记忆合成结果解析失败")
+            return {}
+        
+        fields = {}
+        if isinstance(result.get("topic"), str) and result["topic"].strip():
+            fields["topic"] = result["topic"].strip()
+        if isinstance(result.get("content"), str) and result["content"].strip():
+            fields["content"] = result["content"].strip()
+        if isinstance(result.get("keywords"), list):
+            fields["keywords"] = [str(k).strip() for k in result["keywords"] if str(k).strip()]
+        return fields
+    
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=max(1, MEMORY_BUILDER_CONCURRENCY),
+                                                thread_name_prefix="memory-builder")
+        return self._executor
+    
+    @staticmethod
+    def _call_within(fn: Callable[[Optional[float]], Any], deadline_at: float) -> Any:
+        """在线程池中执行调用，并把剩余时间作为 LLM 调用的总时限传入，超时后调用自行结束、释放工作线程"""
+        remaining = deadline_at - time.perf_counter()
+        if remaining <= 0:
+            raise FutureTimeoutError()
+        return fn(remaining)
+    
+    def _run_concurrently(self, calls: Dict[str, Tuple[Callable[[Optional[float]], Any], Any]]) -> Dict[str, Any]:
+        """
+        并发执行互不依赖的 LLM 调用并汇总结果
+        :param calls: {名称: (调用函数, fallback 值)}，调用函数接收总时限（秒，None 表示默认），超时或抛出异常时使用 fallback
+        :return: {名称: 结果}
+        """
+        if MEMORY_BUILDER_CONCURRENCY <= 1 or len(calls) <= 1:
+            results = {}
+            for name, (fn, fallback) in calls.items():
+                try:
+                    results[name] = fn()
+                except Exception as e:
+                    logger.error(f"记忆构建调用 {name} 失败：{str(e)}", exc_info=True)
+                    results[name] = fallback
+            return results
+        
+        executor = self._get_executor()
+        start = time.perf_counter()
+        # 超时从统一派发时刻起算：所有调用共享同一截止时间，慢调用不会拖住其他结果
+        deadline = start + MEMORY_BUILDER_CALL_TIMEOUT
+        futures = {name: executor.submit(self._call_within, fn, deadline) for name, (fn, _) in calls.items()}
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result(timeout=max(0.0, deadline - time.perf_counter()))
+            except FutureTimeoutError:
+                logger.warning(f"记忆构建调用 {name} 超时（{MEMORY_BUILDER_CALL_TIMEOUT}s），使用 fallback")
+                results[name] = calls[name][1]
+            except Exception as e:
+                logger.error(f"记忆构建调用 {name} 失败：{str(e)}", exc_info=True)
+                results[name] = calls[name][1]
+        logger.info(f"并发执行 {len(calls)} 个调用，耗时 {time.perf_counter() - start:.2f}s")
+        return results
+    
+    def _field_calls(self, names: List[str]) -> Dict[str, Tuple[Callable[[Optional[float]], Any], Any]]:
+        """分步生成各记忆字段的调用及其 fallback"""
+        available = {
+            "topic": (self._summarize_topic, self.current_topic or "未命名主题"),
+            "content": (self._summarize_content, "\n".join(self.buffer[-3:])),
+            "keywords": (self._extract_keywords, []),
+        }
+        return {name: available[name] for name in names}
+    
+    def _build_memory(self, next_round: Optional[str] = None) -> Tuple[Memory, Optional[str]]:
+        """
+        由当前buffer生成记忆；合成模式下缺失或格式错误的字段单独回退到分步调用
+        :param next_round: 新话题的首轮对话，传入时与记忆生成并发初始化新话题
+        :return: (记忆, 新话题)
+        """
+        calls: Dict[str, Tuple[Callable[[Optional[float]], Any], Any]] = {}
+        if next_round is not None:
+            calls["next_topic"] = (lambda deadline=None: self._initialize_topic(next_round, deadline),
+                                   next_round[:30].strip())
+        
+        if MEMORY_SYNTHESIS_MODE == "combined":
+            calls["combined"] = (self._synthesize_combined, {})
+            results = self._run_concurrently(calls)
+            fields = results.pop("combined")
+            missing = [name for name in ("topic", "content", "keywords") if name not in fields]
+            if missing:
+                if fields:
+                    logger.warning(f"记忆合成结果缺少字段 {missing}，单独生成")
+                fields.update(self._run_concurrently(self._field_calls(missing)))
+        else:
+            calls.update(self._field_calls(["topic", "content", "keywords"]))
+            results = self._run_concurrently(calls)
+            fields = results
+        
+        create_time = Memory.get_current_time()
+        memory = Memory(
+            topic=fields["topic"],
+            content=fields["content"],
+            keywords=fields["keywords"],
+            create_time=create_time,
+            update_time=create_time
+        )
+        return memory, results.get("next_topic")
+    
+    def process_dialog(self, user_input: str, agent_response: str, current_round: Optional[str] = None) -> Optional[Memory]:
+        """
+        处理一轮对话，返回需要保存的记忆（如果有的话）
+        :param current_round: 已格式化的本轮对话（可选）；传入时 buffer 中保存的就是该字符串对象本身
+        """
+        current_round = current_round or self._format_round_dialog(user_input, agent_response)
         logger.info(f"处理对话轮次：{current_round}")
         
         # 1. 首轮对话
@@ -121,13 +389,18 @@ class MemoryBuilder:
             self.current_topic = self._initialize_topic(current_round)
             return None  # 首轮不保存记忆
         
-        # 2. 非首轮对话：检测话题是否更换
-        topic_changed = self._detect_topic_boundary(current_round)
+        # 2. 非首轮对话：检测话题是否更换（优先使用推测结果）
+        speculation = self._take_speculation(user_input)
+        if speculation is not None:
+            topic_changed, is_noise = speculation
+        else:
+            topic_changed, is_noise = self._detect_topic_boundary(current_round), None
         
         if not topic_changed:
-            # 2.1 话题未更换：添加到buffer
+            # 2.1 话题未更换：添加到buffer，超出窗口的旧轮次折叠进摘要
             self.buffer.append(current_round)
             logger.info("话题未更换，已添加到buffer")
+            self._fold_overflow()
             return None
         
         else:
@@ -135,10 +408,11 @@ class MemoryBuilder:
             logger.info("话题已更换，处理当前buffer")
             
             # 判断是否为噪声
-            is_noise = self.noise_detector.is_noise(
-                dialog=current_round,
-                topic_context=f"当前旧主题：{self.current_topic}"
-            )
+            if is_noise is None:
+                is_noise = self.noise_detector.is_noise(
+                    dialog=current_round,
+                    topic_context=f"当前旧主题：{self.current_topic}"
+                )
             
             if is_noise:
                 # 噪声：弃掉该轮对话，不影响当前buffer
@@ -146,26 +420,17 @@ class MemoryBuilder:
                 return None
             
             # 非噪声：生成记忆
-            topic = self._summarize_topic()
-            content = self._summarize_content()
-            keywords = self._extract_keywords()
-            create_time = Memory.get_current_time()
+            memory, next_topic = self._build_memory(next_round=current_round)
             
-            memory = Memory(
-                topic=topic,
-                content=content,
-                keywords=keywords,
-                create_time=create_time,
-                update_time=create_time
-            )
-            
-            # 清空buffer，准备新话题
+            # 清空buffer和摘要，准备新话题
             self.buffer = []
-            self.current_topic = self._initialize_topic(current_round)
+            self.summary = ""
+            self.folded_rounds = 0
+            self.current_topic = next_topic
             # 将当前轮对话添加到新buffer
             self.buffer.append(current_round)
             
-            logger.info(f"已生成记忆并保存：{topic}")
+            logger.info(f"已生成记忆并保存：{memory.topic}")
             return memory
     
     def finalize_memory(self) -> Optional[Memory]:
@@ -176,17 +441,5 @@ class MemoryBuilder:
         logger.info("对话结束，处理剩余buffer内容")
         
         # 生成记忆
-        topic = self._summarize_topic()
-        content = self._summarize_content()
-        keywords = self._extract_keywords()
-        create_time = Memory.get_current_time()
-        
-        memory = Memory(
-            topic=topic,
-            content=content,
-            keywords=keywords,
-            create_time=create_time,
-            update_time=create_time
-        )
-        
+        memory, _ = self._build_memory()
         return memory
\ No newline at end of file
@@ -1,25 +1,185 @@
 import json
 import os
+import threading
 from typing import List, Optional, Dict, Callable
 from memory_structures import Memory
 from logger import logger
 import config
 from domain import DomainManager 
 import numpy as np
-from sentence_transformers import SentenceTransformer, util
-import torch
+from embedding_model import get_embedding_model
+from embedding_index import EmbeddingIndex
+from vector_index import create_vector_index
+from lexical_index import BM25Index, reciprocal_rank_fusion
+from binary_store import FLAG_SOURCE_UNTERMINATED, load_segment_for, source_prefix_crc, write_segment
+
+# 向量检索后端：exact（精确，默认）/ ivf（进程内近似）/ hnsw（需安装 hnswlib）
+VECTOR_INDEX_BACKEND = getattr(config, "VECTOR_INDEX_BACKEND", "exact")
+VECTOR_INDEX_PARAMS = getattr(config, "VECTOR_INDEX_PARAMS", {})
+# 检索模式：vector（纯向量，默认）/ hybrid（BM25 + 向量，倒数排名融合）
+RETRIEVAL_MODE = getattr(config, "RETRIEVAL_MODE", "vector")
+# 混合检索的词法候选数：与向量 top 候选取并集后统一做向量打分（0 表示词法候选数与向量候选数相同）
+HYBRID_PREFILTER_K = getattr(config, "HYBRID_PREFILTER_K", 200)
+HYBRID_RRF_K = getattr(config, "HYBRID_RRF_K", 60)
+# 余弦相似度低于阈值的记忆，只有词法证据足够强时才保留：
+# 查询词项的 idf 加权覆盖率不低于该值，或记忆的某个关键词完整出现在查询中
+HYBRID_LEXICAL_FLOOR = getattr(config, "HYBRID_LEXICAL_FLOOR", 0.5)
+# 存储后端：jsonl（默认）/ sqlite
+MEMORY_BACKEND = getattr(config, "MEMORY_BACKEND", "jsonl")
+# 二进制段快照：冷启动时先加载段文件，只解析其后新增的 JSONL 行
+MEMORY_SEGMENT_ENABLED = getattr(config, "MEMORY_SEGMENT_ENABLED", False)
+# 段快照之后累计解析的 JSONL 行数达到该值时自动重写段文件
+MEMORY_SEGMENT_COMPACT_THRESHOLD = getattr(config, "MEMORY_SEGMENT_COMPACT_THRESHOLD", 1000)
 
 class MemoryStore:
     """记忆存储管理器：负责记忆的持久化存储"""
     
-    def __init__(self, is_worthy_func: Optional[Callable[[Dict], bool]] = None):
-        self.memory_path = config.MEMORY_JSONL_PATH
+    def __init__(self, is_worthy_func: Optional[Callable[[Dict], bool]] = None, memory_path: Optional[str] = None):
+        self.memory_path = memory_path or config.MEMORY_JSONL_PATH
         self.is_worthy_func = is_worthy_func
+        # 缓存与索引的读写锁（记忆可能由后台整理线程保存，同时主线程在检索）
+        self._lock = threading.RLock()
         # 确保存储目录存在
         os.makedirs(os.path.dirname(self.memory_path), exist_ok=True)
-        # 初始化向量模型（用于检索）
-        self.embedding_model = SentenceTransformer('/amax/xidian_ty/ln/memory/models/paraphrase-multilingual-MiniLM-L12-v2')
+        # 向量模型（进程内共享，首次检索时才加载）
+        self.embedding_model = get_embedding_model()
+        # 持久化向量索引（与 JSONL 同目录），避免每轮重复编码全部记忆
+        self.embedding_index = EmbeddingIndex(self.memory_path, model_id=self.embedding_model.model_id)
+        # 检索后端（建立在向量矩阵之上，可按配置切换精确/近似检索）
+        self.vector_index = create_vector_index(VECTOR_INDEX_BACKEND, VECTOR_INDEX_PARAMS)
+        self._vector_index_generation = -1
+        # 已解析的记忆缓存：仅在检测到文件变化时从上次读取的字节偏移处增量读取
+        self._memories: List[Dict] = []
+        self._cache_generation = 0  # 缓存被整体重置时递增
+        self._file_offset = 0  # 已解析到的字节偏移（总是落在完整行之后）
+        self._line_count = 0  # 已读取的行数（用于错误日志定位）
+        self._file_signature: Optional[tuple] = None  # (inode, size, mtime_ns)
+        self._unterminated = False  # 文件末尾是否为缺少换行符的完整记录
+        self.segment_path = os.path.splitext(self.memory_path)[0] + ".seg"
+        self._lines_since_segment = 0  # 段快照之后新增的行数（读取解析的与本进程追加写入的）
+        # 词法倒排索引（混合检索用），随缓存增量更新
+        self.lexical_index = BM25Index()
+        self._lexical_index_generation = -1
+    
+    def _reset_cache(self) -> None:
+        self._cache_generation += 1
+        self._memories = []
+        self._file_offset = 0
+        self._line_count = 0
+        self._file_signature = None
+        self._unterminated = False
+        self._lines_since_segment = 0
+    
+    def _refresh(self) -> None:
+        """
+        检测记忆文件是否被外部修改并同步缓存：
+        - 签名（inode/大小/修改时间）不变：直接使用缓存
+        - 文件变大且 inode 不变：从上次偏移处增量读取新增行
+        - 文件被替换、截断或原地改写：全量重读
+        """
+        try:
+            st = os.stat(self.memory_path)
+        except FileNotFoundError:
+            if self._file_signature is not None or self._memories:
+                self._reset_cache()
+            return
+        signature = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if signature == self._file_signature:
+            return
+        if (self._file_signature is None or st.st_ino != self._file_signature[0]
+                or st.st_size <= self._file_offset):
+            self._reset_cache()
+            if MEMORY_SEGMENT_ENABLED:
+                self._load_segment()
+        self._lines_since_segment += self._read_new_lines()
+        self._file_signature = signature
+        self._maybe_compact()
+    
+    def _maybe_compact(self) -> None:
+        if MEMORY_SEGMENT_ENABLED and self._lines_since_segment >= MEMORY_SEGMENT_COMPACT_THRESHOLD:
+            self.compact()
+    
+    def _load_segment(self) -> None:
+        """全量重读时优先从段快照加载 JSONL 的前缀部分"""
+        reader = load_segment_for(self.memory_path, self.segment_path)
+        if reader is None:
+            return
+        with reader:
+            self._memories = reader.load_all()
+            self._file_offset = reader.source_offset
+            self._line_count = reader.source_lines
+            self._unterminated = bool(reader.flags & FLAG_SOURCE_UNTERMINATED)
+        self._lines_since_segment = 0
+        logger.info(f"已从段文件加载 {len(self._memories)} 条记忆")
+    
+    def compact(self) -> bool:
+        """将当前缓存写为二进制段快照，下次冷启动时无需再逐行解析这部分 JSONL"""
+        try:
+            write_segment(
+                self.segment_path, self._memories,
+                source_offset=self._file_offset,
+                source_crc=source_prefix_crc(self.memory_path, self._file_offset),
+                source_lines=self._line_count,
+                flags=FLAG_SOURCE_UNTERMINATED if self._unterminated else 0
+            )
+            self._lines_since_segment = 0
+            logger.info(f"已写入记忆段文件：{len(self._memories)} 条")
+            return True
+        except Exception as e:
+            logger.error(f"写入记忆段文件失败：{str(e)}", exc_info=True)
+            return False
+    
+    def _read_new_lines(self) -> int:
+        """从当前偏移读取完整的新行并追加到缓存（末尾未写完的半行留待下次读取），返回解析的行数"""
+        loaded = 0
+        with open(self.memory_path, 'rb') as f:
+            f.seek(self._file_offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        lines = data[:end].split(b'\n')[:-1]
+        # 末尾缺少换行符但本身是完整 JSON 的记录（如手工编辑过的文件）也一并读入
+        tail = data[end:]
+        if tail.strip():
+            try:
+                json.loads(tail)
+                lines.append(tail)
+                end = len(data)
+                self._unterminated = True
+            except ValueError:
+                pass
+        for raw in lines:
+            self._line_count += 1
+            line = raw.decode('utf-8', errors='replace').strip()
+            if not line:
+                continue  # 跳过空行
+            try:
+                self._memories.append(json.loads(line))
+                loaded += 1
+            except json.JSONDecodeError as e:
+                logger.error(f"第 {self._line_count} 行 JSON 解析失败: {e.msg}，原始内容: {line}")
+            except Exception as e:
+                logger.error(f"第 {self._line_count} 行读取失败: {str(e)}", exc_info=True)
+        self._file_offset += end
+        logger.info(f"已加载 {loaded} 条新记忆，共 {len(self._memories)} 条")
+        return len(lines)
+    
+    def _sync_vector_index(self) -> None:
+        """让检索后端跟上向量矩阵：矩阵被整体替换时重置，否则只追加新增行"""
+        if self._vector_index_generation != self.embedding_index.generation:
+            self.vector_index.reset()
+            self._vector_index_generation = self.embedding_index.generation
+        self.vector_index.update(self.embedding_index.matrix)
     
+    def _sync_lexical_index(self, memories: List[Dict]) -> None:
+        """让倒排索引跟上记忆缓存：缓存被整体重置时重建，否则只加入新增记忆"""
+        if self._lexical_index_generation != self._cache_generation or len(self.lexical_index) > len(memories):
+            self.lexical_index.reset()
+            self._lexical_index_generation = self._cache_generation
+        self.lexical_index.add(memories[len(self.lexical_index):])
+    
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        """将文本编码为归一化的 float32 向量（N x dim）"""
+        return self.embedding_model.encode(texts)
 
     ########################记忆直接存储方法（不含域约束判断）########################
     # def save_memory(self, memory: Memory) -> bool:
@@ -41,111 +201,211 @@ class MemoryStore:
         :param memory: 要保存的记忆对象
         :return: 是否成功保存
         """
-        # 将记忆转换为字典格式，用于判断
-        memory_dict = memory.to_dict()
-        
-        # 如果有判断函数，先判断
-        if self.is_worthy_func and not self.is_worthy_func(memory_dict):
-            logger.info(f"记忆不符合域约束，不保存：{memory.topic}")
-            return False
+        return self.save_memories([memory]) == 1
+    
+    def save_memories(self, memories: List[Memory]) -> int:
+        """
+        批量保存记忆（逐条做域约束判断，通过的记忆一次性写入）
+        :param memories: 要保存的记忆对象列表
+        :return: 成功保存的条数
+        """
+        memory_dicts = []
+        for memory in memories:
+            # 将记忆转换为字典格式，用于判断
+            memory_dict = memory.to_dict()
+            # 如果有判断函数，先判断
+            if self.is_worthy_func and not self.is_worthy_func(memory_dict):
+                logger.info(f"记忆不符合域约束，不保存：{memory.topic}")
+                continue
+            memory_dicts.append(memory_dict)
+        if not memory_dicts:
+            return 0
         
         # 如果符合约束，执行保存操作
-        try:
-            with open(self.memory_path, 'a', encoding='utf-8') as f:
-                json.dump(memory_dict, f, ensure_ascii=False)
-                f.write('\n')
-            logger.info(f"记忆已保存：{memory.topic}")
-            return True
-        except Exception as e:
-            logger.error(f"保存记忆失败：{str(e)}", exc_info=True)
-            return False
+        with self._lock:
+            try:
+                self._write_memories(memory_dicts)
+                for memory_dict in memory_dicts:
+                    logger.info(f"记忆已保存：{memory_dict['topic']}")
+            except Exception as e:
+                logger.error(f"保存记忆失败：{str(e)}", exc_info=True)
+                return 0
+            
+            # 增量更新向量索引（失败不影响保存结果，检索时会自动重建）
+            try:
+                self.embedding_index.append(memory_dicts, self._encode)
+            except Exception as e:
+                logger.error(f"更新向量索引失败：{str(e)}", exc_info=True)
+        return len(memory_dicts)
+    
+    def _write_memories(self, memory_dicts: List[Dict]) -> None:
+        """将记忆追加写入 JSONL 并同步更新缓存（存储后端需覆盖此方法）"""
+        # 写入前先同步缓存，保证写入后缓存与文件末尾对齐
+        self._refresh()
+        data = ''.join(json.dumps(m, ensure_ascii=False) + '\n' for m in memory_dicts).encode('utf-8')
+        if self._unterminated:
+            data = b'\n' + data
+            self._unterminated = False
+        with open(self.memory_path, 'ab') as f:
+            f.write(data)
+        self._memories.extend(memory_dicts)
+        self._file_offset += len(data)
+        self._line_count += len(memory_dicts)
+        st = os.stat(self.memory_path)
+        if st.st_size == self._file_offset:
+            self._file_signature = (st.st_ino, st.st_size, st.st_mtime_ns)
+            self._lines_since_segment += len(memory_dicts)
+            self._maybe_compact()
+        else:
+            # 写入期间文件被外部修改，下次访问时重新同步
+            self._reset_cache()
     
     def load_all_memories(self) -> List[Dict]:
-        """从JSONL文件加载所有记忆"""
-        memories = []
-        try:
-            if os.path.exists(self.memory_path):
-                with open(self.memory_path, 'r', encoding='utf-8') as f:
-                    for line_num, line in enumerate(f, 1):
-                        line = line.strip()
-                        if not line:
-                            continue  # 跳过空行
-                        try:
-                            memories.append(json.loads(line))
-                        except json.JSONDecodeError as e:
-                            logger.error(f"第 {line_num} 行 JSON 解析失败: {e.msg}，原始内容: {line}")
-                        except Exception as e:
-                            logger.error(f"第 {line_num} 行读取失败: {str(e)}", exc_info=True)
-            logger.info(f"已加载 {len(memories)} 条记忆")
-        except Exception as e:
-            logger.error(f"加载记忆失败：{str(e)}", exc_info=True)
-        return memories
+        """获取所有记忆（读取内存缓存，文件有变化时增量同步）"""
+        with self._lock:
+            try:
+                self._refresh()
+            except Exception as e:
+                logger.error(f"加载记忆失败：{str(e)}", exc_info=True)
+            return list(self._memories)
     
     def get_latest_memory(self) -> Optional[Dict]:
         """获取最新的一条记忆"""
-        memories = self.load_all_memories()
-        return memories[-1] if memories else None
+        with self._lock:
+            try:
+                self._refresh()
+            except Exception as e:
+                logger.error(f"加载记忆失败：{str(e)}", exc_info=True)
+            return self._memories[-1] if self._memories else None
     
     def clear_all_memories(self) -> bool:
         """清空所有记忆"""
-        try:
-            if os.path.exists(self.memory_path):
-                os.remove(self.memory_path)
-            logger.info("所有记忆已清空")
-            return True
-        except Exception as e:
-            logger.error(f"清空记忆失败：{str(e)}", exc_info=True)
-            return False
+        with self._lock:
+            try:
+                if os.path.exists(self.memory_path):
+                    os.remove(self.memory_path)
+                if os.path.exists(self.segment_path):
+                    os.remove(self.segment_path)
+                self._reset_cache()
+                self.embedding_index.clear()
+                logger.info("所有记忆已清空")
+                return True
+            except Exception as e:
+                logger.error(f"清空记忆失败：{str(e)}", exc_info=True)
+                return False
         
-    def retrieve_related_memories(self, query: str, top_k: int = 5) -> List[Dict]:
+    def retrieve_related_memories(self, query: str, top_k: int = 5, mode: Optional[str] = None) -> List[Dict]:
         """
-        根据用户输入检索相关记忆（向量匹配）
+        根据用户输入检索相关记忆（向量匹配或混合检索）
         :param query: 用户输入
         :param top_k: 返回最相关的 top_k 条记忆
+        :param mode: vector / hybrid，默认取 config.RETRIEVAL_MODE
         :return: 按相似度排序的记忆列表
         """
+        return self.retrieve_related_memories_batch([query], top_k=top_k, mode=mode)[0]
+    
+    def retrieve_related_memories_batch(self, queries: List[str], top_k: int = 5,
+                                        mode: Optional[str] = None) -> List[List[Dict]]:
+        """
+        批量检索：多个查询共用一次记忆同步、一次批量编码和一次矩阵-矩阵乘
+        :param queries: 查询文本列表（如用户输入、当前话题、关键词）
+        :param top_k: 每个查询返回最相关的 top_k 条记忆
+        :param mode: vector / hybrid，默认取 config.RETRIEVAL_MODE
+        :return: 与 queries 一一对应的结果列表，每个元素为按相似度排序的记忆列表
+        """
+        if not queries:
+            return []
+        with self._lock:
+            return self._retrieve_batch(queries, top_k, mode)
+    
+    def _retrieve_batch(self, queries: List[str], top_k: int, mode: Optional[str]) -> List[List[Dict]]:
         memories = self.load_all_memories()
         if not memories:
             logger.info("没有记忆可供检索")
-            return []
+            return [[] for _ in queries]
         
         # 限制 top_k 不超过记忆数量
         top_k = min(top_k, len(memories))
         
-        # 将记忆内容拼接成一个字符串（用于向量表示）
-        memory_texts = [
-            f"{mem['topic']} {mem['content']} {' '.join(mem['keywords'])}"
-            for mem in memories
-        ]
-        
-        # 向量化用户输入和记忆文本
-        query_embedding = self.embedding_model.encode(query, convert_to_tensor=True)
-        memory_embeddings = self.embedding_model.encode(memory_texts, convert_to_tensor=True)
+        # 保证向量索引与记忆文件一致（仅对新增记忆编码，不一致时自动重建）
+        self.embedding_index.sync(memories, self._encode)
         
-        # 计算余弦相似度
-        cos_scores = util.cos_sim(query_embedding, memory_embeddings)[0]
+        # 所有查询一次批量编码
+        query_embeddings = self._encode(list(queries))
         
-        # 按相似度排序
-        if torch.is_tensor(cos_scores):
-            # 使用 torch.topk 替代 numpy 的排序，效率更高，且不需要离开 GPU
-            _, top_indices = torch.topk(cos_scores, k=top_k)
-            top_results = top_indices.flatten().tolist()
+        if (mode or RETRIEVAL_MODE) == "hybrid":
+            self._sync_lexical_index(memories)
+            all_results = [
+                self._hybrid_search(query, query_embedding, memories, top_k)
+                for query, query_embedding in zip(queries, query_embeddings)
+            ]
         else:
-            # 原有的 numpy 逻辑作为备选
-            top_results = np.argpartition(-cos_scores, range(top_k))[0:top_k]
+            # 由检索后端返回各自的 top_k（向量已归一化，内积即余弦相似度）
+            self._sync_vector_index()
+            scores, indices = self.vector_index.search(query_embeddings, top_k)
+            
+            all_results = []
+            for query_scores, query_indices in zip(scores.tolist(), indices.tolist()):
+                # 组装结果
+                results = []
+                for score, idx in zip(query_scores, query_indices):
+                    if idx >= 0 and score > 0.3:  # 相似度阈值，可调整
+                        results.append({
+                            "memory": memories[idx],
+                            "similarity": float(score)
+                        })
+                
+                # 按相似度降序排列
+                results.sort(key=lambda x: x["similarity"], reverse=True)
+                all_results.append(results)
         
-        # 组装结果
-        results = []
-        for idx in top_results:
-            if cos_scores[idx] > 0.3:  # 相似度阈值，可调整
-                results.append({
-                    "memory": memories[idx],
-                    "similarity": float(cos_scores[idx].cpu().numpy())
-                })
+        logger.info(f"{len(queries)} 个查询分别检索到 {[len(r) for r in all_results]} 条相关记忆")
+        logger.info(f"相关记忆内容：{all_results}")
+        return all_results
+    
+    def _hybrid_search(self, query: str, query_embedding: np.ndarray, memories: List[Dict], top_k: int) -> List[Dict]:
+        """
+        混合检索：BM25 与余弦相似度两路排名做倒数排名融合。
+        候选集为词法命中与向量 top 候选的并集（只匹配语义的记忆同样参与排名），在候选集上统一计算余弦相似度。
+        """
+        pool = max(top_k * 4, 20)
+        lexical = self.lexical_index.search(query, HYBRID_PREFILTER_K or pool)
+        bm25_scores = dict(lexical)
         
-        # 按相似度降序排列
-        results.sort(key=lambda x: x["similarity"], reverse=True)
+        self._sync_vector_index()
+        _, indices = self.vector_index.search(query_embedding[None, :], pool)
+        candidates = np.array(sorted(set(bm25_scores) | {i for i in indices[0].tolist() if i >= 0}), dtype=np.int64)
+        cos = np.asarray(self.embedding_index.matrix[candidates]) @ query_embedding
+        order = np.argsort(-cos)[:pool]
+        vector_ranking = candidates[order].tolist()
+        vector_scores = dict(zip(candidates.tolist(), cos.tolist()))
         
-        logger.info(f"检索到 {len(results)} 条相关记忆")
-        logger.info(f"相关记忆内容：{results}")
-        return results
\ No newline at end of file
+        fused = reciprocal_rank_fusion([[d for d, _ in lexical[:pool]], vector_ranking], k=HYBRID_RRF_K)
+        # 余弦相似度不足的词法命中需要足够强的词法证据（避免只共享一个常见二元组的记忆混入）
+        weak = [idx for idx in fused if vector_scores[idx] <= 0.3 and idx in bm25_scores]
+        coverage = self.lexical_index.coverage(query, weak) if weak else {}
+        lowered_query = query.lower()
+        results = []
+        for idx, fused_score in sorted(fused.items(), key=lambda x: x[1], reverse=True):
+            similarity = vector_scores[idx]
+            if similarity <= 0.3:
+                keywords = memories[idx].get("keywords") or []
+                keyword_hit = any(len(k) >= 2 and k.lower() in lowered_query for k in keywords if isinstance(k, str))
+                if idx not in bm25_scores or (coverage.get(idx, 0.0) < HYBRID_LEXICAL_FLOOR and not keyword_hit):
+                    continue
+            results.append({
+                "memory": memories[idx],
+                "similarity": float(similarity),
+                "bm25": float(bm25_scores.get(idx, 0.0)),
+                "score": fused_score
+            })
+            if len(results) >= top_k:
+                break
+        return results
+
+def create_memory_store(is_worthy_func: Optional[Callable[[Dict], bool]] = None) -> MemoryStore:
+    """按 config.MEMORY_BACKEND 创建记忆存储"""
+    if MEMORY_BACKEND == "sqlite":
+        from sqlite_store import SQLiteMemoryStore
+        return SQLiteMemoryStore(is_worthy_func=is_worthy_func)
+    return MemoryStore(is_worthy_func=is_worthy_func)
@@ -0,0 +1,48 @@
+import json
+import threading
+from typing import Any, Dict
+
+
+class Metrics:
+    """进程级指标注册表：计数器（incr）与数值观测（observe，记录次数/总和/最大值）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._observations: Dict[str, Dict[str, float]] = {}
+
+    def incr(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            obs = self._observations.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0})
+            obs["count"] += 1
+            obs["sum"] += value
+            obs["max"] = max(obs["max"], value)
+
+    def get(self, name: str, default: float = 0) -> float:
+        with self._lock:
+            return self._counters.get(name, default)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """返回当前所有指标的快照（观测值附带平均值）"""
+        with self._lock:
+            observations = {
+                name: dict(obs, avg=obs["sum"] / obs["count"] if obs["count"] else 0.0)
+                for name, obs in self._observations.items()
+            }
+            return {"counters": dict(self._counters), "observations": observations}
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), ensure_ascii=False, indent=2, sort_keys=True)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._observations.clear()
+
+
+# 全局指标实例（所有模块共享）
+metrics = Metrics()
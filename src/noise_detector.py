@@ -5,7 +5,7 @@ from logger import logger
 
 class NoiseDetector:
     def __init__(self):
-        self.llm_client = LLMClient()
+        self.llm_client = LLMClient(kind="noise")
     
     def is_noise(self, dialog: str, topic_context: str = "") -> bool:
         """
@@ -1,8 +1,8 @@
 """
 Prompt Templates
 """
-import json
 from typing import Dict, Any, Optional
+from token_budget import JsonPart, ListPart, TextPart, build_prompt
 
 def boundary_detection_prompt(conversation_history: str, new_messages: str) -> str:    
     """
@@ -11,7 +11,7 @@ def boundary_detection_prompt(conversation_history: str, new_messages: str) -> s
     :param new_messages: 新增消息
     :return: 完整提示词
     """    
-    return """
+    return build_prompt("boundary_detection", """
     你是一名对话边界检测专家，需要判断新增对话是否与当前主题完全无关（即话题更换），非轻微相关/边缘相关。
 
     当前对话历史：
@@ -71,7 +71,7 @@ def boundary_detection_prompt(conversation_history: str, new_messages: str) -> s
     -若对话历史为空（即当前为第一条消息），返回 false
     -检测到明确话题变更时，即使对话过渡自然，也需拆分
     -每个片段应是独立完整的对话单元，可单独理解
-""".format(conversation_history=conversation_history, new_messages=new_messages) 
+""", shrink_order=("conversation_history",), conversation_history=TextPart(conversation_history), new_messages=new_messages) 
 
 def get_topic_initialize_prompt(first_dialog: str) -> str:
     """
@@ -79,7 +79,7 @@ def get_topic_initialize_prompt(first_dialog: str) -> str:
     :param first_dialog: 第一轮对话文本
     :return: 完整提示词
     """
-    return """
+    return build_prompt("topic_initialize", """
     任务：从用户首轮对话中提炼宏观的情景总结作为主题，主题需包含「时间+核心事件+延伸范围」，避免单一关键词，长度控制在20字内。
     
     特殊处理规则：
@@ -103,13 +103,13 @@ def get_topic_initialize_prompt(first_dialog: str) -> str:
         "topic": "提炼后的主题文本"
     }}
     ```
-    """.format(first_dialog=first_dialog)
+    """, first_dialog=first_dialog)
 
 def get_noise_detection_prompt(dialog: str, topic_context: str) -> str:
     """
     噪声检测提示词：明确噪声定义，避免误判新主题
     """
-    return """
+    return build_prompt("noise_detection", """
     任务：判断用户的对话是否为无意义的临时噪声（不影响对话流程、无实际需求的内容）。
     噪声的严格定义（必须同时满足）：
     1. 临时插入：仅为当前时刻的短期操作，不延续为新的对话主题；
@@ -136,7 +136,7 @@ def get_noise_detection_prompt(dialog: str, topic_context: str) -> str:
         "is_noise": true/false  // 仅为布尔值，true=噪声，false=非噪声
     }}
     ```
-    """.format(dialog=dialog, topic_context=topic_context)
+    """, shrink_order=("topic_context",), dialog=dialog, topic_context=TextPart(topic_context))
 
 def get_topic_summary_prompt(dialogs:list[str]) -> str:
     """
@@ -145,7 +145,7 @@ def get_topic_summary_prompt(dialogs:list[str]) -> str:
     return: 完整提示词
     """
     dialog_text = "\n".join (dialogs)
-    return """任务：对以下多轮对话进行主题提炼，总结出一个简洁明了的主题。
+    return build_prompt("topic_summary", """任务：对以下多轮对话进行主题提炼，总结出一个简洁明了的主题。
     多轮对话：{dialog_text}
 
     输出要求：
@@ -159,7 +159,7 @@ def get_topic_summary_prompt(dialogs:list[str]) -> str:
         "topic": "提炼的主题内容"
     }}
     ```
-    """.format(dialog_text = dialog_text)
+    """, shrink_order=("dialog_text",), dialog_text=TextPart(dialog_text))
 
 def get_content_summary_prompt (dialogs: list [str]) -> str:
     """
@@ -168,7 +168,7 @@ def get_content_summary_prompt (dialogs: list [str]) -> str:
     return: 完整提示词
     """
     dialog_text = "\n".join (dialogs)
-    return """任务：对以下多轮对话进行内容总结，提炼关键信息和主要内容。
+    return build_prompt("content_summary", """任务：对以下多轮对话进行内容总结，提炼关键信息和主要内容。
     多轮对话：{dialog_text}
 
     输出要求：
@@ -183,7 +183,7 @@ def get_content_summary_prompt (dialogs: list [str]) -> str:
         "content": "总结的对话内容"
     }}
     ```
-    """.format(dialog_text = dialog_text)
+    """, shrink_order=("dialog_text",), dialog_text=TextPart(dialog_text))
 
 def get_keywords_extract_prompt (dialogs: list [str]) -> str:
     """
@@ -192,7 +192,7 @@ def get_keywords_extract_prompt (dialogs: list [str]) -> str:
     return: 完整提示词
     """
     dialog_text = "\n".join (dialogs)
-    return """任务：从以下多轮对话中提取关键信息词，反映对话的核心内容。
+    return build_prompt("keywords_extract", """任务：从以下多轮对话中提取关键信息词，反映对话的核心内容。
     多轮对话：{dialog_text}
     输出要求：
     提取 5-10 个最能代表对话 对话核心的关键词或短语
@@ -206,8 +206,59 @@ def get_keywords_extract_prompt (dialogs: list [str]) -> str:
         "keywords": ["关键词1", "关键词2", "关键词3"]
     }}
     ```
-    """.format(dialog_text = dialog_text)
+    """, shrink_order=("dialog_text",), dialog_text=TextPart(dialog_text))
 
+def get_memory_synthesis_prompt (dialogs: list [str]) -> str:
+    """
+    记忆合成提示词：一次性提炼多轮对话的主题、内容与关键词
+    param dialogs: 多轮对话列表
+    return: 完整提示词
+    """
+    dialog_text = "\n".join (dialogs)
+    return build_prompt("memory_synthesis", """任务：对以下多轮对话进行整理，同时提炼主题、总结内容并提取关键词。
+    多轮对话：{dialog_text}
+
+    输出要求：
+    topic：准确概括对话核心内容，长度控制在 30 字以内
+    content：全面涵盖对话的主要内容和关键信息，语言简洁明了，逻辑清晰，一般不超过 300 字
+    keywords：5-10 个最能代表对话核心的关键词或短语，每个控制在 5 字以内，具有代表性和区分性
+    必须严格按照以下 JSON 格式输出，不要添加任何额外文字
+    JSON 内容需严格包裹在 ```json 和 ``` 之间
+    输出格式示例：
+    ```json 
+    {{
+        "topic": "提炼的主题内容",
+        "content": "总结的对话内容",
+        "keywords": ["关键词1", "关键词2", "关键词3"]
+    }}
+    ```
+    """, shrink_order=("dialog_text",), dialog_text=TextPart(dialog_text))
+
+
+def get_rolling_summary_prompt (summary: str, dialogs: list [str]) -> str:
+    """
+    滚动摘要提示词：将较早的对话轮次增量合并进已有摘要
+    param summary: 已有摘要（可能为空）
+    param dialogs: 需要合并的对话轮次
+    return: 完整提示词
+    """
+    dialog_text = "\n".join (dialogs)
+    return build_prompt("rolling_summary", """任务：将以下新的对话内容合并进已有的对话摘要，得到更新后的摘要。
+    已有摘要：{summary}
+    新的对话：{dialog_text}
+
+    输出要求：
+    保留已有摘要中的关键信息，补充新对话中的事实、需求与结论
+    语言简洁明了，按时间顺序组织，一般不超过 300 字
+    必须严格按照以下 JSON 格式输出，不要添加任何额外文字
+    JSON 内容需严格包裹在 ```json 和 ``` 之间
+    输出格式示例：
+    ```json 
+    {{
+        "summary": "更新后的摘要"
+    }}
+    ```
+    """, shrink_order=("dialog_text", "summary"), summary=TextPart(summary or "（无）"), dialog_text=TextPart(dialog_text))
 
 #############################################################
 
@@ -217,7 +268,7 @@ def get_keywords_extract_prompt (dialogs: list [str]) -> str:
 
 def get_user_domain_activation_prompt(current_user_domain: dict, user_input: str, conversation_history: str) -> str:
     """用户域激活提示词"""
-    return """
+    return build_prompt("user_domain_activation", """
     你是一个信息筛选助手。根据用户的输入，从完整的用户域中激活最相关的部分。
     
     完整的用户域：
@@ -238,24 +289,25 @@ def get_user_domain_activation_prompt(current_user_domain: dict, user_input: str
     必须严格按照以下JSON格式输出激活的用户域信息，不要添加任何额外文字！
     1. JSON内容需严格包裹在 ```json 和 ``` 之间
     2. 请生成一个完整的 JSON，不要省略任何字段，确保所有引号和括号都闭合。
-    """.format(current_user_domain=json.dumps(current_user_domain, ensure_ascii=False),user_input=user_input,conversation_history=conversation_history)
+    """, shrink_order=("conversation_history", "current_user_domain"), current_user_domain=JsonPart(current_user_domain), user_input=user_input, conversation_history=TextPart(conversation_history))
+
+def get_attitude_stage(trust: int) -> str:
+    """信任值对应的自我域态度阶段（Cognitive_Layer.Attitude_towards_User 下的键）"""
+    if trust < 30:
+        return "Initial"
+    if trust < 80:
+        return "Process"
+    return "Final"
 
 def get_self_domain_activation_prompt(current_self_domain: dict, user_input: str, conversation_history: str, trust: int) -> str:
     """
     根据信任值区间强制激活自我域中的态度阶段
     """
     # 逻辑层判断：将态度提取出来作为核心指令
-    if trust < 30:
-        stage = "Initial"
-        relation_description = current_self_domain["Cognitive_Layer"]["Attitude_towards_User"]["Initial"]
-    elif 30 <= trust < 80:
-        stage = "Process"
-        relation_description = current_self_domain["Cognitive_Layer"]["Attitude_towards_User"]["Process"]
-    else:
-        stage = "Final"
-        relation_description = current_self_domain["Cognitive_Layer"]["Attitude_towards_User"]["Final"]
+    stage = get_attitude_stage(trust)
+    relation_description = current_self_domain["Cognitive_Layer"]["Attitude_towards_User"][stage]
 
-    return """
+    return build_prompt("self_domain_activation", """
     你是一个信息筛选助手。根据用户的输入和当前关系阶段，从完整的自我域中激活最相关的部分。
     
     【当前关系判定】
@@ -280,20 +332,21 @@ def get_self_domain_activation_prompt(current_self_domain: dict, user_input: str
     输出要求：
     必须严格按照以下JSON格式输出，不要添加任何额外文字！
     1. JSON内容需严格包裹在 ```json 和 ``` 之间。
-    """.format(
+    """,
+        shrink_order=("conversation_history", "current_self_domain"),
         stage=stage,
         relation_description=relation_description,
         trust=trust,
-        current_self_domain=json.dumps(current_self_domain, ensure_ascii=False),
-        user_input=user_input, 
-        conversation_history=conversation_history
+        current_self_domain=JsonPart(current_self_domain),
+        user_input=user_input,
+        conversation_history=TextPart(conversation_history)
     )
 
 def get_user_domain_update_prompt (current_user_domain: dict, recent_memories: list) -> str:
     """
     用户域更新提示词（基于记忆）
     """
-    return """
+    return build_prompt("user_domain_update", """
     任务：基于最近的对话记忆，更新用户域信息。这是一个总结和反思的过程，类似人类睡前整理一天的经历。
     当前用户域：{current_user_domain}
     最近的对话记忆：{recent_memories}
@@ -313,13 +366,13 @@ def get_user_domain_update_prompt (current_user_domain: dict, recent_memories: l
         "Concrete_Layer": {{...}}
     }}
     ```
-    """.format(current_user_domain=json.dumps(current_user_domain, ensure_ascii=False),recent_memories=json.dumps(recent_memories, ensure_ascii=False))
+    """, shrink_order=("recent_memories", "current_user_domain"), current_user_domain=JsonPart(current_user_domain), recent_memories=ListPart(recent_memories))
 
 def get_self_domain_update_prompt (current_self_domain: dict, user_domain: dict, recent_memories: list) -> str:
     """
     自我域更新提示词（基于记忆）
     """
-    return """
+    return build_prompt("self_domain_update", """
     任务：基于最近的对话记忆和用户域信息，更新自我域信息。这是一个总结和反思的过程，类似人类睡前整理一天的经历并调整应对策略。
     当前自我域：{current_self_domain}
     当前用户域信息：{user_domain}
@@ -340,11 +393,67 @@ def get_self_domain_update_prompt (current_self_domain: dict, user_domain: dict,
         "Concrete_Layer": {{...}}
     }}
     ```
-    """.format(current_self_domain=json.dumps(current_self_domain, ensure_ascii=False),user_domain=json.dumps(user_domain, ensure_ascii=False),recent_memories=json.dumps(recent_memories, ensure_ascii=False))
+    """, shrink_order=("user_domain", "recent_memories", "current_self_domain"), current_self_domain=JsonPart(current_self_domain), user_domain=JsonPart(user_domain), recent_memories=ListPart(recent_memories))
+
+def get_user_domain_delta_prompt (current_user_domain: dict, new_memories: list) -> str:
+    """
+    用户域增量更新提示词：只输出基于新记忆的修改（JSON Patch），不重写整个用户域
+    """
+    return build_prompt("user_domain_delta", """
+    任务：基于新增的对话记忆，对用户域做增量修改。这是一个总结和反思的过程，类似人类睡前整理一天的经历。
+    当前用户域：{current_user_domain}
+    新增的对话记忆（此前的记忆已经整理进用户域）：{new_memories}
+    输出要求：
+    必须严格按照以下JSON格式输出修改操作，不要添加任何额外文字！
+    1. JSON内容需严格包裹在 ```json 和 ``` 之间
+    2. 只输出需要新增、修改或删除的字段，没有需要修改的内容时 ops 为空列表
+    3. op 只能是 add（新增字段或向列表追加，列表末尾用 -）、replace（替换已有字段）、remove（删除已有字段）
+    4. path 为 JSON Pointer 路径，第一段必须是 Meta_Layer、Cognitive_Layer、Behavior_Layer、Concrete_Layer 之一
+    5. Meta_Layer一般不发生变化，除非用户明确说了自己名字改了等等这种确定内容。
+
+    输出格式示例：
+    ```json
+    {{
+        "ops": [
+            {{"op": "replace", "path": "/Cognitive_Layer/某字段", "value": "更新后的内容"}},
+            {{"op": "add", "path": "/Concrete_Layer/某列表/-", "value": "新增条目"}},
+            {{"op": "remove", "path": "/Behavior_Layer/过时字段"}}
+        ]
+    }}
+    ```
+    """, shrink_order=("new_memories", "current_user_domain"), current_user_domain=JsonPart(current_user_domain), new_memories=ListPart(new_memories))
+
+def get_self_domain_delta_prompt (current_self_domain: dict, user_domain: dict, new_memories: list) -> str:
+    """
+    自我域增量更新提示词：只输出基于新记忆的修改（JSON Patch），不重写整个自我域
+    """
+    return build_prompt("self_domain_delta", """
+    任务：基于新增的对话记忆和用户域信息，对自我域做增量修改。这是一个总结和反思的过程，类似人类睡前整理一天的经历并调整应对策略。
+    当前自我域：{current_self_domain}
+    当前用户域信息：{user_domain}
+    新增的对话记忆（此前的记忆已经整理进自我域）：{new_memories}
+    输出要求：
+    必须严格按照以下JSON格式输出修改操作，不要添加任何额外文字！
+    1. JSON内容需严格包裹在 ```json 和 ``` 之间
+    2. 只输出需要新增、修改或删除的字段，没有需要修改的内容时 ops 为空列表
+    3. op 只能是 add（新增字段或向列表追加，列表末尾用 -）、replace（替换已有字段）、remove（删除已有字段）
+    4. path 为 JSON Pointer 路径，第一段必须是 Cognitive_Layer、Behavior_Layer、Concrete_Layer 之一
+    5. Meta_Layer稳定保持不变，不允许修改。其他层请根据记忆内容调整对应的策略、推理方式以及表达方式。
+
+    输出格式示例：
+    ```json
+    {{
+        "ops": [
+            {{"op": "replace", "path": "/Cognitive_Layer/某字段", "value": "更新后的内容"}},
+            {{"op": "add", "path": "/Behavior_Layer/某列表/-", "value": "新增条目"}}
+        ]
+    }}
+    ```
+    """, shrink_order=("user_domain", "new_memories", "current_self_domain"), current_self_domain=JsonPart(current_self_domain), user_domain=JsonPart(user_domain), new_memories=ListPart(new_memories))
 
 def get_memory_worthiness_prompt (memory_content: dict, user_domain: dict, self_domain: dict) -> str:
     """判断记忆是否值得保存的提示词"""
-    return """
+    return build_prompt("memory_worthiness", """
     任务：判断一段记忆是否值得保存。只有符合或有助于丰富用户域和自我域的内容才应该被保存。
 
     记忆内容：{memory_content}
@@ -368,14 +477,14 @@ def get_memory_worthiness_prompt (memory_content: dict, user_domain: dict, self_
         "is_worthy": true
     }}
     ```
-    """.format(memory_content=json.dumps(memory_content, ensure_ascii=False),user_domain=json.dumps(user_domain, ensure_ascii=False),self_domain=json.dumps(self_domain, ensure_ascii=False))
+    """, shrink_order=("self_domain", "user_domain", "memory_content"), memory_content=JsonPart(memory_content), user_domain=JsonPart(user_domain), self_domain=JsonPart(self_domain))
 
 def get_trust_scoring_prompt(user_input: str, current_stage: str) -> str:
     """
     专门用于分析用户输入并返回信任值增量（behavior_score）的提示词。
     逻辑：门槛随阶段提升，高级阶段需要更深层的灵魂碰撞。
     """
-    return """
+    return build_prompt("trust_scoring", """
     你现在是孙悟空内心的“情感天平”。你的任务是根据“顾问”说的话，判断孙悟空对他信任值的变化。
     
     ### 核心逻辑：打动门槛动态调整
@@ -406,7 +515,7 @@ def get_trust_scoring_prompt(user_input: str, current_stage: str) -> str:
     ## 你的输出格式：
     请仅输出一个整数（behavior_score）。严禁输出任何解释、标点或多余文字。
     示例：5 或 -10
-    """.format(user_input=user_input, current_stage=current_stage)
+    """, user_input=user_input, current_stage=current_stage)
 
 def get_agent_response_prompt(user_input: str, current_memory: dict, chat_history: str, self_domain: str, user_domain: str, trust: int) -> str:
     # 确定当前关系阶段的文字描述，用于强化人设
@@ -417,7 +526,7 @@ def get_agent_response_prompt(user_input: str, current_memory: dict, chat_histor
     else:
         stage = "最终阶段（生死知己）：你已经完全认可了他，哪怕他预言的是死路，你也愿意护他周全。"
 
-    return """
+    return build_prompt("agent_response", """
     # 角色设定
     你是“孙悟空”。你刚被唐僧从五行山救出来不久，正护送他西行。
     
@@ -451,11 +560,12 @@ def get_agent_response_prompt(user_input: str, current_memory: dict, chat_histor
     # 当前任务
     顾问（用户）刚说："{user_input}"
     请结合你的猴王本色，给出一个**独特、不重复、无套话**的回复：
-    """.format(
-        self_domain=self_domain,
-        user_domain=user_domain,
-        current_memory=current_memory,
-        chat_history=chat_history,
+    """,
+        shrink_order=("chat_history", "current_memory", "user_domain", "self_domain"),
+        self_domain=TextPart(self_domain, keep="head"),
+        user_domain=TextPart(user_domain, keep="head"),
+        current_memory=TextPart(current_memory, keep="head"),
+        chat_history=TextPart(chat_history),
         user_input=user_input,
         trust=trust,
         stage=stage
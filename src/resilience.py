@@ -0,0 +1,253 @@
+"""
+LLM 调用的容错策略：
+- 截止时间：每次调用有总时限，单次尝试的超时不超过剩余时间
+- 重试：仅对可重试错误（超时、连接失败、限流、5xx）做指数退避 + 全抖动重试
+- 熔断：每个提供商一个熔断器，连续失败达到阈值后短路，冷却后放行一次试探请求
+- 对冲：延迟敏感的调用超过历史 p95 延迟仍未返回时，再发一份相同请求，取先成功的结果
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, TypeVar
+import openai
+import config
+from logger import logger
+from metrics import metrics
+
+LLM_MAX_ATTEMPTS = getattr(config, "LLM_MAX_ATTEMPTS", 3)
+LLM_REQUEST_TIMEOUT = getattr(config, "LLM_REQUEST_TIMEOUT", 60)  # 单次尝试超时（秒）
+LLM_CALL_DEADLINE = getattr(config, "LLM_CALL_DEADLINE", 120)  # 含重试的总时限（秒）
+LLM_BACKOFF_BASE = getattr(config, "LLM_BACKOFF_BASE", 0.5)
+LLM_BACKOFF_MAX = getattr(config, "LLM_BACKOFF_MAX", 8.0)
+LLM_BREAKER_FAILURE_THRESHOLD = getattr(config, "LLM_BREAKER_FAILURE_THRESHOLD", 5)
+LLM_BREAKER_RESET_TIMEOUT = getattr(config, "LLM_BREAKER_RESET_TIMEOUT", 30)
+LLM_HEDGING = getattr(config, "LLM_HEDGING", True)
+LLM_HEDGE_MIN_SAMPLES = getattr(config, "LLM_HEDGE_MIN_SAMPLES", 20)  # 样本不足时使用默认对冲延迟
+LLM_HEDGE_DEFAULT_DELAY = getattr(config, "LLM_HEDGE_DEFAULT_DELAY", 10.0)
+
+T = TypeVar("T")
+
+_RETRYABLE_STATUS = {408, 409, 429}
+
+
+class CircuitOpenError(RuntimeError):
+    """熔断器处于打开状态，请求被直接拒绝"""
+
+
+class DeadlineExceeded(TimeoutError):
+    """调用总时限已用完"""
+
+
+def is_retryable(error: BaseException) -> bool:
+    """超时、连接失败、限流与服务端错误可重试；参数错误、鉴权失败等不可重试"""
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in _RETRYABLE_STATUS or error.status_code >= 500
+    return isinstance(error, (TimeoutError, ConnectionError))
+
+
+def backoff_delay(attempt: int) -> float:
+    """第 attempt 次失败后的等待时间（指数退避 + 全抖动）"""
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """熔断器：closed（正常）-> open（短路）-> half-open（放行一次试探）"""
+
+    def __init__(self, name: str, failure_threshold: int = LLM_BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = LLM_BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half-open" if time.monotonic() - self._opened_at >= self.reset_timeout else "open"
+
+    def before_call(self) -> bool:
+        """熔断打开时抛出 CircuitOpenError；冷却期结束后只放行一个试探请求，返回本次调用是否为试探请求"""
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._probing:
+                metrics.incr("llm.circuit_rejected")
+                raise CircuitOpenError(f"LLM 提供商 {self.name} 已熔断")
+            self._probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f"LLM 提供商 {self.name} 已恢复，熔断关闭")
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._probing:
+                    logger.warning(f"LLM 提供商 {self.name} 连续失败 {self._failures} 次，熔断 {self.reset_timeout}s")
+                    metrics.incr("llm.circuit_opened")
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def release_probe(self) -> None:
+        """试探请求因非服务端原因结束（如参数错误、被取消）时，允许下一次试探"""
+        with self._lock:
+            self._probing = False
+
+
+class LatencyTracker:
+    """最近 N 次成功请求的延迟，用于估算对冲延迟"""
+
+    def __init__(self, window: int = 200):
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            if not self._samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def hedge_delay(self) -> float:
+        """样本足够时取 p95 延迟，否则使用默认值"""
+        with self._lock:
+            enough = len(self._samples) >= LLM_HEDGE_MIN_SAMPLES
+        return self.percentile(0.95) if enough else LLM_HEDGE_DEFAULT_DELAY
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_trackers: Dict[str, LatencyTracker] = {}
+_registry_lock = threading.Lock()
+
+
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+    """获取进程内共享的熔断器（按提供商区分）"""
+    with _registry_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def get_latency_tracker(name: str) -> LatencyTracker:
+    """获取进程内共享的延迟统计（按提供商 + 模型区分）"""
+    with _registry_lock:
+        if name not in _trackers:
+            _trackers[name] = LatencyTracker()
+        return _trackers[name]
+
+
+def _handle_failure(error: Exception, breaker: CircuitBreaker, attempt: int, deadline_at: float) -> float:
+    """记录一次失败，返回重试前的等待时间；不应重试时重新抛出异常"""
+    if isinstance(error, CircuitOpenError):
+        raise error
+    if not is_retryable(error):
+        breaker.release_probe()
+        raise error
+    breaker.record_failure()
+    metrics.incr("llm.failures")
+    delay = backoff_delay(attempt)
+    if attempt >= LLM_MAX_ATTEMPTS or time.monotonic() + delay >= deadline_at:
+        raise error
+    metrics.incr("llm.retries")
+    logger.warning(f"LLM 调用失败（第 {attempt} 次）：{str(error)}，{delay:.2f}s 后重试")
+    return delay
+
+
+def _attempt_timeout(deadline_at: float) -> float:
+    remaining = deadline_at - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded("LLM 调用超出总时限")
+    return min(LLM_REQUEST_TIMEOUT, remaining)
+
+
+def call_with_retries(attempt_fn: Callable[[float], T], breaker: CircuitBreaker,
+                      deadline: Optional[float] = None) -> T:
+    """
+    同步执行带重试与熔断的调用
+    :param attempt_fn: 单次尝试，参数为本次尝试的超时秒数
+    :param deadline: 总时限（秒），默认 LLM_CALL_DEADLINE
+    """
+    deadline_at = time.monotonic() + (deadline or LLM_CALL_DEADLINE)
+    attempt = 0
+    while True:
+        attempt += 1
+        timeout = _attempt_timeout(deadline_at)
+        probe = breaker.before_call()
+        try:
+            result = attempt_fn(timeout)
+        except Exception as e:
+            time.sleep(_handle_failure(e, breaker, attempt, deadline_at))
+            continue
+        except BaseException:
+            # 被中断（如 KeyboardInterrupt）的试探请求没有结果，释放试探名额，否则熔断器永远停在 half-open
+            if probe:
+                breaker.release_probe()
+            raise
+        breaker.record_success()
+        return result
+
+
+async def acall_with_retries(attempt_fn: Callable[[float], Awaitable[T]], breaker: CircuitBreaker,
+                             deadline: Optional[float] = None) -> T:
+    """call_with_retries 的异步版本"""
+    deadline_at = time.monotonic() + (deadline or LLM_CALL_DEADLINE)
+    attempt = 0
+    while True:
+        attempt += 1
+        timeout = _attempt_timeout(deadline_at)
+        probe = breaker.before_call()
+        try:
+            result = await attempt_fn(timeout)
+        except Exception as e:
+            await asyncio.sleep(_handle_failure(e, breaker, attempt, deadline_at))
+            continue
+        except BaseException:
+            # 被取消（如对冲请求中落败的一份）的试探请求没有结果，释放试探名额，否则熔断器永远停在 half-open
+            if probe:
+                breaker.release_probe()
+            raise
+        breaker.record_success()
+        return result
+
+
+async def hedged(make_call: Callable[[], Awaitable[T]], delay: float) -> T:
+    """对冲请求：首个请求 delay 秒内未完成时再发一份，返回先成功的结果并取消另一份"""
+    first = asyncio.ensure_future(make_call())
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done:
+        return first.result()
+    metrics.incr("llm.hedged")
+    logger.info(f"LLM 请求超过 {delay:.2f}s 未返回，发送对冲请求")
+    second = asyncio.ensure_future(make_call())
+    pending = {first, second}
+    error: Optional[BaseException] = None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is None:
+                for other in pending:
+                    other.cancel()
+                if task is second:
+                    metrics.incr("llm.hedge_wins")
+                return task.result()
+            error = task.exception()
+    raise error
@@ -0,0 +1,167 @@
+"""
+LLM 非流式响应缓存（默认关闭，config.LLM_RESPONSE_CACHE = True 开启）：
+- 键：sha256(提供商 + 模型 + temperature + max_tokens + 提示词)
+- 内存层：LRU，容量由 config.LLM_RESPONSE_CACHE_SIZE 控制
+- 磁盘层（可选）：SQLite，由 config.LLM_RESPONSE_CACHE_DISK_PATH 指定，重启/回放评估时复用；
+  超过 config.LLM_RESPONSE_CACHE_DISK_MAX_ENTRIES 条时淘汰最久未访问的记录
+- 过期：写入超过 config.LLM_RESPONSE_CACHE_TTL 秒的结果视为未命中（None 表示永不过期）
+只缓存解析成功的结构化结果，命中时完全跳过网络请求。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+import config
+from logger import logger
+from metrics import metrics
+
+LLM_RESPONSE_CACHE = getattr(config, "LLM_RESPONSE_CACHE", False)
+LLM_RESPONSE_CACHE_SIZE = getattr(config, "LLM_RESPONSE_CACHE_SIZE", 2000)
+LLM_RESPONSE_CACHE_DISK_PATH = getattr(config, "LLM_RESPONSE_CACHE_DISK_PATH", None)
+LLM_RESPONSE_CACHE_DISK_MAX_ENTRIES = getattr(config, "LLM_RESPONSE_CACHE_DISK_MAX_ENTRIES", 50000)
+LLM_RESPONSE_CACHE_TTL = getattr(config, "LLM_RESPONSE_CACHE_TTL", 7 * 24 * 3600)
+
+
+def response_cache_key(provider: str, model: str, temperature: float, max_tokens: int, prompt: str) -> str:
+    payload = json.dumps([provider, model, temperature, max_tokens, prompt], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """两级 LLM 响应缓存（内存 LRU + 可选 SQLite），线程安全；值以 JSON 文本存放，每次读取返回新对象"""
+
+    def __init__(self, max_entries: int = LLM_RESPONSE_CACHE_SIZE,
+                 disk_path: Optional[str] = LLM_RESPONSE_CACHE_DISK_PATH,
+                 disk_max_entries: int = LLM_RESPONSE_CACHE_DISK_MAX_ENTRIES,
+                 ttl: Optional[float] = LLM_RESPONSE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.disk_max_entries = disk_max_entries
+        self.ttl = ttl
+        self._lru: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()  # key -> (JSON 文本, 写入时间)
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._disk_entries = 0
+        if disk_path:
+            try:
+                os.makedirs(os.path.dirname(disk_path) or ".", exist_ok=True)
+                self._db = sqlite3.connect(disk_path, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                    "created_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+                self._db.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses(accessed_at)")
+                self._db.commit()
+                self._disk_entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            except Exception as e:
+                logger.error(f"LLM 响应磁盘缓存初始化失败，仅使用内存缓存：{str(e)}", exc_info=True)
+                self._db = None
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+    def _remember(self, key: str, value: str, created_at: float) -> None:
+        """写入内存层并按 LRU 淘汰（调用方持有锁）"""
+        self._lru[key] = (value, created_at)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Any]:
+        """查询缓存，未命中或已过期时返回 None"""
+        with self._lock:
+            expired = False
+            entry = self._lru.get(key)
+            if entry is not None and self._expired(entry[1]):
+                del self._lru[key]
+                expired, entry = True, None
+            if entry is not None:
+                self._lru.move_to_end(key)
+            elif self._db is not None:
+                try:
+                    row = self._db.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+                    if row is not None and self._expired(row[1]):
+                        self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                        self._db.commit()
+                        self._disk_entries -= 1
+                        expired = True
+                    elif row is not None:
+                        self._db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+                        self._db.commit()
+                        entry = (row[0], row[1])
+                        self._remember(key, *entry)
+                        metrics.incr("llm_cache.disk_hit")
+                except Exception as e:
+                    logger.error(f"读取 LLM 响应磁盘缓存失败：{str(e)}", exc_info=True)
+        if expired:
+            metrics.incr("llm_cache.expired")
+        if entry is None:
+            metrics.incr("llm_cache.miss")
+            return None
+        metrics.incr("llm_cache.hit")
+        return json.loads(entry[0])
+
+    def put(self, key: str, value: Any) -> None:
+        """写入缓存（磁盘层超出上限时淘汰最久未访问的记录）"""
+        data = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        now = time.time()
+        with self._lock:
+            self._remember(key, data, now)
+            if self._db is None:
+                return
+            try:
+                # INSERT OR REPLACE 覆盖已有键时 rowcount 同样为 1，先查询是否存在，只有真正新增才计数
+                exists = self._db.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone() is not None
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, data, now, now))
+                if not exists:
+                    self._disk_entries += 1
+                overflow = self._disk_entries - self.disk_max_entries
+                if overflow > 0:
+                    self._db.execute(
+                        "DELETE FROM responses WHERE key IN "
+                        "(SELECT key FROM responses ORDER BY accessed_at LIMIT ?)", (overflow,))
+                    self._disk_entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+                self._db.commit()
+            except Exception as e:
+                logger.error(f"写入 LLM 响应磁盘缓存失败：{str(e)}", exc_info=True)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._lru.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+                self._disk_entries = 0
+
+    def stats(self) -> Dict[str, float]:
+        hits = metrics.get("llm_cache.hit")
+        misses = metrics.get("llm_cache.miss")
+        with self._lock:
+            memory_entries, disk_entries = len(self._lru), self._disk_entries
+        return {
+            "hits": hits,
+            "disk_hits": metrics.get("llm_cache.disk_hit"),
+            "misses": misses,
+            "expired": metrics.get("llm_cache.expired"),
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "memory_entries": memory_entries,
+            "disk_entries": disk_entries,
+        }
+
+
+_cache: Optional[ResponseCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """获取进程内共享的 LLM 响应缓存"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+        return _cache
@@ -0,0 +1,264 @@
+"""
+SQLite 记忆存储后端：与 MemoryStore 相同的 save_memory / load_all_memories /
+get_latest_memory / clear_all_memories 接口，并提供基于索引的查询：
+- 关键词包含 X（关键词关联表）
+- update_time 晚于 T（时间索引）
+- 最新 N 条（主键倒序）
+- topic / content 全文检索（FTS5；不支持 trigram 分词器时改为索引 lexical_index 的字二元组）
+数据库使用 WAL 模式、每线程独立连接，检索读取不会被写入阻塞。
+"""
+import json
+import os
+import sqlite3
+import threading
+from typing import Callable, Dict, List, Optional
+import config
+from logger import logger
+from lexical_index import tokenize
+from memory_store import MemoryStore
+
+MEMORY_SQLITE_PATH = getattr(config, "MEMORY_SQLITE_PATH",
+                             os.path.join(os.path.dirname(config.MEMORY_JSONL_PATH), "memory_sqlite.db"))
+
+_STANDARD_FIELDS = ("topic", "content", "keywords", "create_time", "update_time")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS memories (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    topic TEXT NOT NULL,
+    content TEXT NOT NULL,
+    keywords TEXT NOT NULL,
+    create_time TEXT NOT NULL,
+    update_time TEXT NOT NULL,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_memories_create_time ON memories(create_time);
+CREATE INDEX IF NOT EXISTS idx_memories_update_time ON memories(update_time);
+CREATE TABLE IF NOT EXISTS memory_keywords (
+    keyword TEXT NOT NULL,
+    memory_id INTEGER NOT NULL REFERENCES memories(id) ON DELETE CASCADE,
+    PRIMARY KEY (keyword, memory_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_memory_keywords_memory ON memory_keywords(memory_id);
+"""
+
+
+class SQLiteMemoryStore(MemoryStore):
+    """基于 SQLite 的记忆存储（检索、向量索引逻辑沿用 MemoryStore）"""
+
+    def __init__(self, is_worthy_func: Optional[Callable[[Dict], bool]] = None, db_path: str = MEMORY_SQLITE_PATH):
+        super().__init__(is_worthy_func=is_worthy_func, memory_path=db_path)
+        self.db_path = db_path
+        self._local = threading.local()
+        self._last_id = 0  # 缓存中最大的记忆 id
+        self.fts_enabled = False
+        self.fts_bigram = False  # True 时全文索引存放的是字二元组文本（memories_fts_bigram 表）
+        self._init_schema()
+
+    # ===================== 连接与表结构 =====================
+    def _conn(self) -> sqlite3.Connection:
+        """每个线程使用独立连接（WAL 模式下读不阻塞写）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self) -> None:
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        # 中文没有空格分词，优先使用 trigram 分词器；旧版 SQLite 不支持时，
+        # 按 lexical_index 切成空格分隔的字二元组再交给 unicode61（直接用 unicode61 会把整句中文当成一个词）
+        try:
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS memories_fts USING fts5("
+                "topic, content, content='memories', content_rowid='id', tokenize='trigram')"
+            )
+            self.fts_enabled = True
+        except sqlite3.OperationalError as e:
+            logger.warning(f"FTS5 分词器 trigram 不可用，改用字二元组索引：{str(e)}")
+            try:
+                conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS memories_fts_bigram USING fts5("
+                             "topic, content, tokenize='unicode61')")
+                self.fts_enabled = self.fts_bigram = True
+            except sqlite3.OperationalError as e:
+                logger.warning(f"FTS5 不可用：{str(e)}")
+        conn.commit()
+
+    @staticmethod
+    def _bigram_text(text: str) -> str:
+        return " ".join(tokenize(text))
+
+    @staticmethod
+    def _row_to_memory(row) -> Dict:
+        _, topic, content, keywords, create_time, update_time, extra = row
+        memory = {
+            "topic": topic,
+            "content": content,
+            "keywords": json.loads(keywords),
+            "create_time": create_time,
+            "update_time": update_time,
+        }
+        if extra:
+            memory.update(json.loads(extra))
+        return memory
+
+    # ===================== 缓存同步（覆盖 JSONL 的文件检测逻辑） =====================
+    def _reset_cache(self) -> None:
+        super()._reset_cache()
+        self._last_id = 0
+
+    def _refresh(self) -> None:
+        """
+        通过 PRAGMA data_version 检测其他连接的提交：
+        - 未变化：直接使用缓存
+        - 只有新增：读取 id 大于缓存最大 id 的行
+        - 有删除或改写：全量重读
+        data_version 只在同一连接内可比，而连接是每线程独立的，因此每个线程记录自己上次看到的
+        (缓存代数, data_version)；缓存被重置后代数变化，所有线程都会重新核对
+        """
+        conn = self._conn()
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if getattr(self._local, "data_version", None) == (self._cache_generation, version):
+            return
+        count, max_id = conn.execute("SELECT COUNT(*), COALESCE(MAX(id), 0) FROM memories").fetchone()
+        if max_id < self._last_id:
+            self._reset_cache()
+        rows = conn.execute("SELECT * FROM memories WHERE id > ? ORDER BY id", (self._last_id,)).fetchall()
+        if len(self._memories) + len(rows) != count:
+            self._reset_cache()
+            rows = conn.execute("SELECT * FROM memories ORDER BY id").fetchall()
+        if rows:
+            self._memories.extend(self._row_to_memory(r) for r in rows)
+            self._last_id = rows[-1][0]
+            logger.info(f"已加载 {len(rows)} 条新记忆，共 {len(self._memories)} 条")
+        self._local.data_version = (self._cache_generation, version)
+
+    def compact(self) -> bool:
+        """SQLite 后端无需段快照"""
+        return True
+
+    # ===================== 写入 =====================
+    def _write_memories(self, memory_dicts: List[Dict]) -> None:
+        """在一个事务中批量写入记忆、关键词关联和全文索引"""
+        self._refresh()
+        conn = self._conn()
+        with conn:
+            for memory in memory_dicts:
+                extra = {k: v for k, v in memory.items() if k not in _STANDARD_FIELDS}
+                cur = conn.execute(
+                    "INSERT INTO memories (topic, content, keywords, create_time, update_time, extra) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (memory["topic"], memory["content"], json.dumps(memory["keywords"], ensure_ascii=False),
+                     memory["create_time"], memory["update_time"],
+                     json.dumps(extra, ensure_ascii=False) if extra else None)
+                )
+                memory_id = cur.lastrowid
+                conn.executemany("INSERT OR IGNORE INTO memory_keywords (keyword, memory_id) VALUES (?, ?)",
+                                 [(k, memory_id) for k in memory["keywords"]])
+                if self.fts_bigram:
+                    conn.execute("INSERT INTO memories_fts_bigram (rowid, topic, content) VALUES (?, ?, ?)",
+                                 (memory_id, self._bigram_text(memory["topic"]),
+                                  self._bigram_text(memory["content"])))
+                elif self.fts_enabled:
+                    conn.execute("INSERT INTO memories_fts (rowid, topic, content) VALUES (?, ?, ?)",
+                                 (memory_id, memory["topic"], memory["content"]))
+        if self._last_id == memory_id - len(memory_dicts):
+            # 写入期间没有其他连接插入，直接追加到缓存
+            self._memories.extend(memory_dicts)
+            self._last_id = memory_id
+        else:
+            self._reset_cache()
+
+    def import_jsonl(self, jsonl_path: str, batch_size: int = 500) -> int:
+        """将已有 JSONL 记忆分批导入数据库（不做域约束判断），返回导入条数"""
+        imported = 0
+        batch: List[Dict] = []
+        with open(jsonl_path, "r", encoding="utf-8") as f:
+            for line_num, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    batch.append(json.loads(line))
+                except json.JSONDecodeError as e:
+                    logger.error(f"第 {line_num} 行 JSON 解析失败: {e.msg}，原始内容: {line}")
+                if len(batch) >= batch_size:
+                    with self._lock:
+                        self._write_memories(batch)
+                    imported += len(batch)
+                    batch = []
+        if batch:
+            with self._lock:
+                self._write_memories(batch)
+            imported += len(batch)
+        logger.info(f"已从 {jsonl_path} 导入 {imported} 条记忆")
+        return imported
+
+    def clear_all_memories(self) -> bool:
+        """清空所有记忆"""
+        with self._lock:
+            try:
+                conn = self._conn()
+                with conn:
+                    conn.execute("DELETE FROM memory_keywords")
+                    conn.execute("DELETE FROM memories")
+                    if self.fts_bigram:
+                        conn.execute("DELETE FROM memories_fts_bigram")
+                    elif self.fts_enabled:
+                        conn.execute("INSERT INTO memories_fts (memories_fts) VALUES ('delete-all')")
+                self._reset_cache()
+                self.embedding_index.clear()
+                logger.info("所有记忆已清空")
+                return True
+            except Exception as e:
+                logger.error(f"清空记忆失败：{str(e)}", exc_info=True)
+                return False
+
+    # ===================== 索引查询 =====================
+    def find_by_keyword(self, keyword: str, limit: Optional[int] = None) -> List[Dict]:
+        """关键词包含 keyword 的记忆（按时间从新到旧）"""
+        sql = ("SELECT m.* FROM memory_keywords k JOIN memories m ON m.id = k.memory_id "
+               "WHERE k.keyword = ? ORDER BY m.id DESC")
+        params: list = [keyword]
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [self._row_to_memory(r) for r in self._conn().execute(sql, params)]
+
+    def get_memories_updated_since(self, since: str) -> List[Dict]:
+        """update_time 不早于 since（ISO 格式）的记忆，按更新时间升序"""
+        rows = self._conn().execute(
+            "SELECT * FROM memories WHERE update_time >= ? ORDER BY update_time", (since,))
+        return [self._row_to_memory(r) for r in rows]
+
+    def get_latest_memories(self, n: int) -> List[Dict]:
+        """最新的 n 条记忆（从新到旧）"""
+        rows = self._conn().execute("SELECT * FROM memories ORDER BY id DESC LIMIT ?", (n,))
+        return [self._row_to_memory(r) for r in rows]
+
+    def search_text(self, query: str, limit: int = 20) -> List[Dict]:
+        """
+        topic / content 全文检索；FTS5 不可用或查询过短（trigram 需至少 3 个字符，字二元组需至少 2 个字符）时退化为 LIKE
+        """
+        conn = self._conn()
+        table = "memories_fts_bigram" if self.fts_bigram else "memories_fts"
+        phrase_text = self._bigram_text(query) if self.fts_bigram else query
+        if self.fts_enabled and len(query) >= (2 if self.fts_bigram else 3) and phrase_text:
+            try:
+                # 字二元组按短语匹配，即要求依次相邻出现，与 trigram 的子串匹配语义一致
+                phrase = '"' + phrase_text.replace('"', '""') + '"'
+                rows = conn.execute(
+                    f"SELECT m.* FROM {table} f JOIN memories m ON m.id = f.rowid "
+                    f"WHERE {table} MATCH ? ORDER BY rank LIMIT ?", (phrase, limit)).fetchall()
+                return [self._row_to_memory(r) for r in rows]
+            except sqlite3.OperationalError as e:
+                logger.warning(f"全文检索失败，退化为 LIKE：{str(e)}")
+        pattern = f"%{query}%"
+        rows = conn.execute(
+            "SELECT * FROM memories WHERE topic LIKE ? OR content LIKE ? ORDER BY id DESC LIMIT ?",
+            (pattern, pattern, limit))
+        return [self._row_to_memory(r) for r in rows]
@@ -0,0 +1,186 @@
+"""
+提示词 token 统计与预算：
+- 计数：本地启发式分词（无需联网、无需下载词表），中日韩字符每字计 1，连续字母/数字每 4 个字符计 1，
+  其余非空白符号各计 1；与主流 BPE 分词器的误差在同一量级，足以用于预算与排查
+- 上报：每个提示词构建函数都通过 build_prompt 生成提示词，token 数记入指标 prompt_tokens.<名称>
+- 预算：config.PROMPT_TOKEN_BUDGETS 按名称配置上限（未配置的使用 PROMPT_TOKEN_BUDGET_DEFAULT，None 表示不限），
+  超出时按构建函数给定的顺序依次压缩可裁剪部分，结果只取决于输入，可复现：
+  - TextPart：截断长文本（对话历史保留末尾的最新内容）
+  - ListPart：丢弃列表中最早的元素（如较早的记忆）
+  - JsonPart：从最长的字符串字段开始统一截短，保留字典结构
+"""
+import json
+import math
+import re
+from typing import Any, Dict, List, Optional, Tuple
+import config
+from logger import logger
+from metrics import metrics
+
+# 携带完整域 JSON 与记忆的提示词默认设置上限，其余提示词只统计不裁剪
+PROMPT_TOKEN_BUDGETS: Dict[str, int] = getattr(config, "PROMPT_TOKEN_BUDGETS", {
+    "user_domain_update": 24000,
+    "self_domain_update": 24000,
+    "user_domain_delta": 16000,
+    "self_domain_delta": 16000,
+    "memory_worthiness": 8000,
+})
+PROMPT_TOKEN_BUDGET_DEFAULT: Optional[int] = getattr(config, "PROMPT_TOKEN_BUDGET_DEFAULT", None)
+
+_TOKEN_PATTERN = re.compile(
+    r"[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]"  # 中日韩字符
+    r"|[A-Za-z0-9]+"  # 连续字母/数字
+    r"|[^\sA-Za-z0-9]"  # 其余符号
+)
+_ELLIPSIS = "……"
+
+
+def count_tokens(text: str) -> int:
+    """估算文本的 token 数"""
+    total = 0
+    for match in _TOKEN_PATTERN.finditer(text):
+        piece = match.group(0)
+        total += math.ceil(len(piece) / 4) if piece[0].isascii() and piece[0].isalnum() else 1
+    return total
+
+
+def truncate_text(text: str, max_tokens: int, keep: str = "tail") -> str:
+    """将文本截断到不超过 max_tokens（keep="tail" 保留末尾，"head" 保留开头），被截去的一侧以省略号标记"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    budget = max(0, max_tokens - count_tokens(_ELLIPSIS))
+    # 二分查找能保留的最多字符数
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        piece = text[-mid:] if keep == "tail" else text[:mid]
+        if count_tokens(piece) <= budget:
+            low = mid
+        else:
+            high = mid - 1
+    if keep == "tail":
+        return _ELLIPSIS + (text[-low:] if low else "")
+    return text[:low] + _ELLIPSIS
+
+
+def get_budget(name: str) -> Optional[int]:
+    return PROMPT_TOKEN_BUDGETS.get(name, PROMPT_TOKEN_BUDGET_DEFAULT)
+
+
+# ===================== 可裁剪部分 =====================
+class TextPart:
+    """长文本（如对话历史），超出预算时截断；非字符串按 str() 填入，与 str.format 一致"""
+
+    def __init__(self, text: Any, keep: str = "tail"):
+        self.text = text if isinstance(text, str) else str(text)
+        self.keep = keep
+
+    def render(self) -> str:
+        return self.text
+
+    def shrink(self, excess: int) -> bool:
+        """至少减少 excess 个 token；已无法再压缩时返回 False"""
+        tokens = count_tokens(self.text)
+        if tokens == 0:
+            return False
+        self.text = truncate_text(self.text, max(0, tokens - excess), self.keep)
+        return True
+
+
+class ListPart:
+    """元素列表（如记忆），以 JSON 输出，超出预算时从最早的元素开始丢弃"""
+
+    def __init__(self, items: List[Any]):
+        self.items = list(items or [])
+
+    def render(self) -> str:
+        return json.dumps(self.items, ensure_ascii=False)
+
+    def shrink(self, excess: int) -> bool:
+        if not self.items:
+            return False
+        removed = dropped = 0
+        while dropped < len(self.items) and removed < excess:
+            removed += count_tokens(json.dumps(self.items[dropped], ensure_ascii=False))
+            dropped += 1
+        self.items = self.items[dropped:]
+        return True
+
+
+class JsonPart:
+    """结构化数据（如用户域/自我域），以 JSON 输出，超出预算时截短最长的字符串字段"""
+
+    MIN_FIELD_TOKENS = 8
+
+    def __init__(self, data: Any):
+        self.data = data
+
+    def render(self) -> str:
+        return json.dumps(self.data, ensure_ascii=False)
+
+    @classmethod
+    def _leaf_tokens(cls, data: Any) -> List[int]:
+        if isinstance(data, dict):
+            return [t for value in data.values() for t in cls._leaf_tokens(value)]
+        if isinstance(data, list):
+            return [t for value in data for t in cls._leaf_tokens(value)]
+        return [count_tokens(data)] if isinstance(data, str) else []
+
+    @classmethod
+    def _cap(cls, data: Any, cap: int) -> Any:
+        if isinstance(data, dict):
+            return {key: cls._cap(value, cap) for key, value in data.items()}
+        if isinstance(data, list):
+            return [cls._cap(value, cap) for value in data]
+        return truncate_text(data, cap, keep="head") if isinstance(data, str) else data
+
+    def shrink(self, excess: int) -> bool:
+        leaves = self._leaf_tokens(self.data)
+        if not leaves or max(leaves) <= self.MIN_FIELD_TOKENS:
+            return False
+        # 找到能节省至少 excess 个 token 的最大字段上限（最长的字段先被截短）
+        low, high = self.MIN_FIELD_TOKENS, max(leaves) - 1
+        while low < high:
+            mid = (low + high + 1) // 2
+            if sum(t - mid for t in leaves if t > mid) >= excess:
+                low = mid
+            else:
+                high = mid - 1
+        self.data = self._cap(self.data, low)
+        return True
+
+
+def _render(template: str, parts: Dict[str, Any]) -> str:
+    return template.format(**{key: part.render() if hasattr(part, "render") else part for key, part in parts.items()})
+
+
+def build_prompt(name: str, template: str, shrink_order: Tuple[str, ...] = (), **parts: Any) -> str:
+    """
+    渲染提示词模板，统计 token 数并执行预算
+    :param name: 提示词名称（用于预算配置、指标与日志）
+    :param template: str.format 模板
+    :param shrink_order: 超出预算时依次压缩的部分名称（靠前的先压缩）
+    :param parts: 模板参数，TextPart / ListPart / JsonPart 为可裁剪部分，其余原样填入
+    :return: 完整提示词
+    """
+    prompt = _render(template, parts)
+    tokens = count_tokens(prompt)
+    budget = get_budget(name)
+    if budget is not None and tokens > budget:
+        original = tokens
+        for key in shrink_order:
+            while tokens > budget and parts[key].shrink(tokens - budget):
+                prompt = _render(template, parts)
+                new_tokens = count_tokens(prompt)
+                if new_tokens >= tokens:
+                    break
+                tokens = new_tokens
+            if tokens <= budget:
+                break
+        metrics.incr(f"prompt_truncated.{name}")
+        metrics.observe(f"prompt_tokens_saved.{name}", original - tokens)
+        log = logger.info if tokens <= budget else logger.warning
+        log(f"提示词 {name} 超出预算（{original} > {budget} tokens），裁剪后为 {tokens} tokens")
+    metrics.observe(f"prompt_tokens.{name}", tokens)
+    logger.debug(f"提示词 {name}：{tokens} tokens")
+    return prompt
@@ -0,0 +1,362 @@
+"""
+向量检索后端：
+- exact：暴力矩阵乘（与原有行为一致）
+- ivf：进程内倒排文件索引（球面 k-means 粗量化 + 探测 nprobe 个簇后精排），纯 numpy 实现
+- hnsw：基于可选依赖 hnswlib 的图索引（未安装时不可用）
+
+所有后端都假设向量已归一化，内积即余弦相似度。
+"""
+import argparse
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from logger import logger
+
+try:
+    import hnswlib
+    _HNSWLIB_AVAILABLE = True
+except ImportError:
+    hnswlib = None
+    _HNSWLIB_AVAILABLE = False
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """返回一维分数中前 k 大的下标（降序）"""
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def _exact_search(matrix: np.ndarray, queries: np.ndarray, scores: np.ndarray, indices: np.ndarray, k: int) -> None:
+    """在整个矩阵上精确检索，结果写入 scores / indices"""
+    all_scores = queries @ matrix.T
+    for qi in range(queries.shape[0]):
+        top = _top_k(all_scores[qi], k)
+        indices[qi, :len(top)] = top
+        scores[qi, :len(top)] = all_scores[qi, top]
+
+
+class VectorIndex(ABC):
+    """
+    向量索引基类。
+    约定：update(matrix) 传入的是当前完整矩阵，且前 len(self) 行与上次一致（只会在末尾追加）；
+    矩阵被整体替换（重建/清空）时需先调用 reset()。
+    """
+    name = "base"
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    @abstractmethod
+    def reset(self) -> None:
+        ...
+
+    @abstractmethod
+    def update(self, matrix: np.ndarray) -> None:
+        ...
+
+    @abstractmethod
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        批量检索
+        :param queries: Q x dim 的归一化查询向量
+        :param k: 每个查询返回的数量
+        :return: (scores, indices)，均为 Q x k，数量不足时 indices 填 -1、scores 填 -inf
+        """
+
+    @staticmethod
+    def _empty_result(n_queries: int, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        return (np.full((n_queries, k), -np.inf, dtype=np.float32),
+                np.full((n_queries, k), -1, dtype=np.int64))
+
+
+class ExactIndex(VectorIndex):
+    """精确检索：直接引用向量矩阵，一次矩阵乘得到全部相似度"""
+    name = "exact"
+
+    def __init__(self):
+        self._matrix: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return 0 if self._matrix is None else self._matrix.shape[0]
+
+    def reset(self) -> None:
+        self._matrix = None
+
+    def update(self, matrix: np.ndarray) -> None:
+        self._matrix = matrix
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        scores, indices = self._empty_result(queries.shape[0], k)
+        if len(self):
+            _exact_search(self._matrix, queries, scores, indices, k)
+        return scores, indices
+
+
+class IVFIndex(VectorIndex):
+    """
+    倒排文件索引（IVF-Flat）：
+    - 用球面 k-means 训练 n_lists 个簇中心，每条向量归入最近的簇
+    - 检索时只对最相近的 nprobe 个簇内的向量精排
+    - 数据量小于 min_train_size 时退化为精确检索；数据量增长到训练规模的 retrain_factor 倍时重新训练
+    """
+    name = "ivf"
+
+    def __init__(self, n_lists: Optional[int] = None, nprobe: int = 8, min_train_size: int = 1024,
+                 kmeans_iters: int = 10, retrain_factor: float = 4.0, seed: int = 0):
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.min_train_size = min_train_size
+        self.kmeans_iters = kmeans_iters
+        self.retrain_factor = retrain_factor
+        self.seed = seed
+        self.reset()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def reset(self) -> None:
+        self._matrix: Optional[np.ndarray] = None
+        self._count = 0
+        self._trained_size = 0
+        self._centroids: Optional[np.ndarray] = None
+        self._members: List[List[int]] = []
+        self._member_arrays: Dict[int, np.ndarray] = {}
+
+    def _train(self, matrix: np.ndarray) -> None:
+        """球面 k-means 训练簇中心（在采样子集上训练，再对全量分配）"""
+        n = matrix.shape[0]
+        n_lists = self.n_lists or max(1, int(np.sqrt(n)))
+        n_lists = min(n_lists, n)
+        rng = np.random.default_rng(self.seed)
+        sample_size = min(n, n_lists * 256)
+        sample = np.asarray(matrix[np.sort(rng.choice(n, sample_size, replace=False))], dtype=np.float32)
+        centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+        for _ in range(self.kmeans_iters):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            counts = np.bincount(assign, minlength=n_lists)
+            empty = counts == 0
+            if empty.any():
+                # 空簇重新随机取样，避免簇数塌缩
+                sums[empty] = sample[rng.choice(sample_size, int(empty.sum()), replace=False)]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = sums / np.maximum(norms, 1e-12)
+        self._centroids = centroids.astype(np.float32)
+        self._members = [[] for _ in range(n_lists)]
+        self._member_arrays = {}
+        self._trained_size = n
+        self._count = 0
+        logger.info(f"IVF 索引训练完成：{n} 条向量，{n_lists} 个簇")
+
+    def _assign(self, matrix: np.ndarray, start: int, end: int, chunk: int = 65536) -> None:
+        """将 [start, end) 行分配到最近的簇（分块计算，控制内存）"""
+        for lo in range(start, end, chunk):
+            hi = min(end, lo + chunk)
+            assign = np.argmax(np.asarray(matrix[lo:hi]) @ self._centroids.T, axis=1)
+            for offset, list_id in enumerate(assign.tolist()):
+                self._members[list_id].append(lo + offset)
+                self._member_arrays.pop(list_id, None)
+        self._count = end
+
+    def update(self, matrix: np.ndarray) -> None:
+        self._matrix = matrix
+        n = matrix.shape[0]
+        if n < self.min_train_size:
+            self._count = n
+            return
+        if self._centroids is None or n >= self._trained_size * self.retrain_factor:
+            self._train(matrix)
+        if n > self._count:
+            self._assign(matrix, self._count, n)
+
+    def _list_array(self, list_id: int) -> np.ndarray:
+        arr = self._member_arrays.get(list_id)
+        if arr is None:
+            arr = np.asarray(self._members[list_id], dtype=np.int64)
+            self._member_arrays[list_id] = arr
+        return arr
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        scores, indices = self._empty_result(queries.shape[0], k)
+        if not self._count:
+            return scores, indices
+        if self._centroids is None:
+            # 数据量不足以训练，退化为精确检索
+            _exact_search(self._matrix[:self._count], queries, scores, indices, k)
+            return scores, indices
+        centroid_scores = queries @ self._centroids.T
+        for qi in range(queries.shape[0]):
+            probe = _top_k(centroid_scores[qi], self.nprobe)
+            candidates = np.sort(np.concatenate([self._list_array(int(l)) for l in probe]))
+            if not candidates.size:
+                continue
+            cand_scores = np.asarray(self._matrix[candidates]) @ queries[qi]
+            top = _top_k(cand_scores, k)
+            indices[qi, :len(top)] = candidates[top]
+            scores[qi, :len(top)] = cand_scores[top]
+        return scores, indices
+
+
+class HNSWIndex(VectorIndex):
+    """HNSW 图索引（可选依赖 hnswlib，内积空间）"""
+    name = "hnsw"
+
+    def __init__(self, m: int = 16, ef_construction: int = 200, ef_search: int = 64, initial_capacity: int = 1024):
+        if not _HNSWLIB_AVAILABLE:
+            raise ImportError("HNSW 后端需要安装 hnswlib：pip install hnswlib")
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.initial_capacity = initial_capacity
+        self.reset()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def reset(self) -> None:
+        self._index = None
+        self._count = 0
+
+    def update(self, matrix: np.ndarray) -> None:
+        n = matrix.shape[0]
+        if n <= self._count:
+            return
+        if self._index is None:
+            self._index = hnswlib.Index(space="ip", dim=matrix.shape[1])
+            self._index.init_index(max_elements=max(n, self.initial_capacity),
+                                   ef_construction=self.ef_construction, M=self.m)
+            self._index.set_ef(self.ef_search)
+        if n > self._index.get_max_elements():
+            self._index.resize_index(max(n, self._index.get_max_elements() * 2))
+        self._index.add_items(np.asarray(matrix[self._count:n], dtype=np.float32), np.arange(self._count, n))
+        self._count = n
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        scores, indices = self._empty_result(queries.shape[0], k)
+        if not self._count:
+            return scores, indices
+        kk = min(k, self._count)
+        self._index.set_ef(max(self.ef_search, kk))
+        labels, distances = self._index.knn_query(queries, k=kk)
+        indices[:, :kk] = labels
+        scores[:, :kk] = 1.0 - distances  # ip 空间的距离为 1 - 内积
+        return scores, indices
+
+
+VECTOR_INDEX_BACKENDS = {
+    ExactIndex.name: ExactIndex,
+    IVFIndex.name: IVFIndex,
+    HNSWIndex.name: HNSWIndex,
+}
+
+
+def create_vector_index(backend: str = "exact", params: Optional[Dict] = None) -> VectorIndex:
+    """按名称创建向量索引；未知后端或可选依赖缺失时回退到精确检索"""
+    cls = VECTOR_INDEX_BACKENDS.get(backend)
+    if cls is None:
+        logger.warning(f"未知的向量索引后端：{backend}，使用 exact")
+        return ExactIndex()
+    try:
+        return cls(**(params or {}))
+    except ImportError as e:
+        logger.warning(f"向量索引后端 {backend} 不可用（{str(e)}），使用 exact")
+        return ExactIndex()
+
+
+# ===================== 召回率 / 延迟评估 =====================
+def benchmark_index(index: VectorIndex, matrix: np.ndarray, queries: np.ndarray, k: int = 5) -> Dict:
+    """
+    以精确检索为基准，评估索引的 recall@k 与单查询延迟
+    :return: {"backend", "n", "recall_at_k", "latency_ms_p50", "latency_ms_p95"}
+    """
+    exact = ExactIndex()
+    exact.update(matrix)
+    _, truth = exact.search(queries, k)
+    latencies = []
+    hits, total = 0, 0
+    for qi in range(queries.shape[0]):
+        start = time.perf_counter()
+        _, found = index.search(queries[qi:qi + 1], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        expected = set(truth[qi][truth[qi] >= 0].tolist())
+        hits += len(expected & set(found[0].tolist()))
+        total += len(expected)
+    return {
+        "backend": index.name,
+        "n": int(matrix.shape[0]),
+        "recall_at_k": hits / total if total else 1.0,
+        "latency_ms_p50": float(np.percentile(latencies, 50)) if latencies else 0.0,
+        "latency_ms_p95": float(np.percentile(latencies, 95)) if latencies else 0.0,
+    }
+
+
+def sweep_operating_points(matrix: np.ndarray, queries: np.ndarray, backend: str,
+                           param_name: str, values: List, k: int = 5, base_params: Optional[Dict] = None) -> List[Dict]:
+    """对某个参数（如 ivf 的 nprobe、hnsw 的 ef_search）扫描，输出各取值的召回率与延迟"""
+    report = []
+    for value in values:
+        params = dict(base_params or {}, **{param_name: value})
+        index = create_vector_index(backend, params)
+        index.update(matrix)
+        result = benchmark_index(index, matrix, queries, k)
+        result[param_name] = value
+        report.append(result)
+    return report
+
+
+def _main() -> None:
+    parser = argparse.ArgumentParser(description="向量索引召回率/延迟评估")
+    parser.add_argument("--backend", default="ivf", choices=list(VECTOR_INDEX_BACKENDS))
+    parser.add_argument("--param", default=None, help="扫描的参数名（默认 ivf=nprobe，hnsw=ef_search）")
+    parser.add_argument("--values", default="1,2,4,8,16,32", help="参数取值，逗号分隔")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--synthetic", type=int, default=0, help="使用 N 条随机向量代替已存储的记忆向量")
+    parser.add_argument("--dim", type=int, default=384)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.synthetic:
+        matrix = rng.standard_normal((args.synthetic, args.dim)).astype(np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    else:
+        import config
+        from embedding_index import EmbeddingIndex
+        meta_path = os.path.splitext(config.MEMORY_JSONL_PATH)[0] + ".emb.json"
+        if not os.path.exists(meta_path):
+            print("未找到向量索引，请先运行一次检索或使用 --synthetic")
+            return
+        with open(meta_path, "r", encoding="utf-8") as f:
+            model_id = json.load(f)["model_id"]
+        matrix = np.asarray(EmbeddingIndex(config.MEMORY_JSONL_PATH, model_id=model_id).matrix)
+    if not matrix.shape[0]:
+        print("没有可评估的向量")
+        return
+
+    # 查询取已有向量加扰动，模拟“相近但不相同”的检索请求
+    picks = rng.choice(matrix.shape[0], min(args.queries, matrix.shape[0]), replace=False)
+    queries = matrix[picks] + 0.05 * rng.standard_normal((len(picks), matrix.shape[1])).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    param = args.param or {"ivf": "nprobe", "hnsw": "ef_search"}.get(args.backend)
+    if param:
+        report = sweep_operating_points(matrix, queries, args.backend, param,
+                                        [int(v) for v in args.values.split(",")], args.k)
+    else:
+        index = create_vector_index(args.backend)
+        index.update(matrix)
+        report = [benchmark_index(index, matrix, queries, args.k)]
+    for row in report:
+        print(json.dumps(row, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    _main()